@@ -4,13 +4,19 @@
 @time: 2021/3/19 15:51
 '''
 import os
+import sys
 import numpy as np
 import warnings
 import pickle
 
+import torch
 from tqdm import tqdm
 from torch.utils.data import Dataset
 
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+from libs.pointops2.functions.pointops_cpu import furthestsampling
+
 warnings.filterwarnings('ignore')
 
 
@@ -30,20 +36,24 @@ def farthest_point_sample(point, npoint):
     Return:
         centroids: sampled pointcloud index, [npoint, D]
     """
-    N, D = point.shape
-    xyz = point[:,:3]
-    centroids = np.zeros((npoint,))
-    distance = np.ones((N,)) * 1e10
-    farthest = np.random.randint(0, N)
-    for i in range(npoint):
-        centroids[i] = farthest
-        centroid = xyz[farthest, :]
-        dist = np.sum((xyz - centroid) ** 2, -1)
-        mask = dist < distance
-        distance[mask] = dist[mask]
-        farthest = np.argmax(distance, -1)
-    point = point[centroids.astype(np.int32)]
-    return point
+    return farthest_point_sample_batch([point], npoint)[0]
+
+
+def farthest_point_sample_batch(points, npoint):
+    """
+    Input:
+        points: list of pointcloud data, [N_i, D]
+        npoint: number of samples
+    Return:
+        list of sampled pointclouds, [npoint, D]
+    """
+    # all the clouds in one offset-delimited batch of the batched CPU FPS, random start point as before
+    xyz = torch.from_numpy(np.concatenate([point[:, :3] for point in points]).astype(np.float32))
+    offset = torch.IntTensor(np.cumsum([point.shape[0] for point in points]))
+    new_offset = torch.IntTensor(np.cumsum([min(npoint, point.shape[0]) for point in points]))
+    idx = furthestsampling(xyz, offset, new_offset, random_start=True).numpy()
+    starts_n, starts_m = [0] + offset.tolist()[:-1], [0] + new_offset.tolist()[:-1]
+    return [point[idx[s:e] - n] for point, n, s, e in zip(points, starts_n, starts_m, new_offset.tolist())]
 
 
 class ModelNetDataLoader(Dataset):
@@ -94,14 +104,17 @@ class ModelNetDataLoader(Dataset):
                     cls = np.array([cls]).astype(np.int32)
                     point_set = np.loadtxt(fn[1], delimiter=',').astype(np.float32)
 
-                    if self.uniform:
-                        point_set = farthest_point_sample(point_set, self.npoints)
-                    else:
+                    if not self.uniform:
                         point_set = point_set[0:self.npoints, :]
 
                     self.list_of_points[index] = point_set
                     self.list_of_labels[index] = cls
 
+                if self.uniform:
+                    # sample the clouds in batches, every batch runs on all the cores
+                    for start in tqdm(range(0, len(self.list_of_points), 64)):
+                        self.list_of_points[start:start + 64] = farthest_point_sample_batch(self.list_of_points[start:start + 64], self.npoints)
+
                 with open(self.save_path, 'wb') as f:
                     pickle.dump([self.list_of_points, self.list_of_labels], f)
             else:
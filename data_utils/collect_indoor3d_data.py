@@ -1,25 +1,113 @@
 import os
 import sys
-from indoor3d_util import DATA_PATH, collect_point_label
+import glob
+import time
+import argparse
+import numpy as np
+from multiprocessing import Pool
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-# ROOT_DIR = os.path.dirname(BASE_DIR)
+ROOT_DIR = os.path.dirname(BASE_DIR)
 sys.path.append(BASE_DIR)
+from indoor3d_util import DATA_PATH, g_classes, g_class2label, load_txt_points
 
-anno_paths = [line.rstrip() for line in open(os.path.join(BASE_DIR, 'meta/anno_paths.txt'))]
-anno_paths = [os.path.join(DATA_PATH, p) for p in anno_paths]
 
-# output_folder = os.path.join(ROOT_DIR, 'data/stanford_indoor3d')
-output_folder = '/home/lishuai375/data/stanford_indoor3d'
-if not os.path.exists(output_folder):
-    os.mkdir(output_folder)
+def get_parser():
+    parser = argparse.ArgumentParser(description='Convert the raw S3DIS annotations into one xyzrgbl .npy file per room')
+    parser.add_argument('--data_path', type=str, default=DATA_PATH, help='Stanford3dDataset_v1.2_Aligned_Version folder')
+    parser.add_argument('--output_folder', type=str, default='/home/lishuai375/data/stanford_indoor3d')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='rooms converted in parallel')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'float64'], help='dtype of the xyzrgbl output (float64 is the old layout)')
+    parser.add_argument('--overwrite', action='store_true', help='convert again rooms whose .npy already exists')
+    parser.add_argument('--store_root', type=str, default=None, help='also pack the rooms into a memory-mapped store (util/scene_store.py)')
+    return parser.parse_args()
 
-# Note: there is an extra character in the v1.2 data in Area_5/hallway_6. It's fixed manually.
-for anno_path in anno_paths:
-    print(anno_path)
+
+def convert_room(anno_path, out_filename, dtype='float32'):
+    """ Streaming version of indoor3d_util.collect_point_label(..., 'numpy').
+
+        Every instance is parsed and appended to a temporary file, so the whole room is never
+        held twice in memory. The output is shifted so that the most negative point is at the
+        origin, written to a temporary .npy and renamed, so an interrupted run leaves no partial room.
+    """
+    tmp_raw, tmp_npy = out_filename + '.raw.part', out_filename + '.part'
+    xyz_min, n = np.full(3, np.inf), 0
+    with open(tmp_raw, 'wb') as fout:
+        for f in sorted(glob.glob(os.path.join(anno_path, '*.txt'))):
+            cls = os.path.basename(f).split('_')[0]
+            if cls not in g_classes:  # note: in some room there is 'staris' class..
+                cls = 'clutter'
+            points = load_txt_points(f)
+            if points.shape[0] == 0:
+                continue
+            data = np.empty((points.shape[0], 7), dtype=np.float64)
+            data[:, 0:6], data[:, 6] = points, g_class2label[cls]
+            xyz_min = np.minimum(xyz_min, points[:, 0:3].min(0))
+            data.tofile(fout)
+            n += points.shape[0]
+
+    raw = np.memmap(tmp_raw, dtype=np.float64, mode='r', shape=(n, 7))
+    out = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=dtype, shape=(n, 7))
+    step = 1 << 20
+    for s in range(0, n, step):
+        block = np.array(raw[s:s + step])
+        block[:, 0:3] -= xyz_min
+        out[s:s + step] = block
+    out.flush()
+    del raw, out
+    os.replace(tmp_npy, out_filename)
+    os.remove(tmp_raw)
+    return n
+
+
+def _worker(job):
+    anno_path, out_filename, dtype = job
+    start = time.time()
     try:
+        n = convert_room(anno_path, out_filename, dtype)
+        return anno_path, n, time.time() - start, None
+    except Exception as e:
+        for tmp in (out_filename + '.raw.part', out_filename + '.part'):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return anno_path, 0, time.time() - start, repr(e)
+
+
+def main():
+    args = get_parser()
+    anno_paths = [line.rstrip() for line in open(os.path.join(BASE_DIR, 'meta/anno_paths.txt'))]
+    anno_paths = [os.path.join(args.data_path, p) for p in anno_paths]
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder)
+
+    jobs = []
+    for anno_path in anno_paths:
         elements = anno_path.split('/')
-        out_filename = elements[-3]+'_'+elements[-2]+'.npy' # Area_1_hallway_1.npy
-        collect_point_label(anno_path, os.path.join(output_folder, out_filename), 'numpy')
-    except:
-        print(anno_path, 'ERROR!!')
+        out_filename = os.path.join(args.output_folder, elements[-3] + '_' + elements[-2] + '.npy')  # Area_1_hallway_1.npy
+        if os.path.exists(out_filename) and not args.overwrite:
+            continue
+        jobs.append((anno_path, out_filename, args.dtype))
+    print('{} rooms to convert, {} already done.'.format(len(jobs), len(anno_paths) - len(jobs)))
+
+    failed = []
+    # largest rooms first would be ideal, annotation folder size is a cheap proxy for it
+    jobs.sort(key=lambda job: -sum(os.path.getsize(f) for f in glob.glob(os.path.join(job[0], '*.txt'))))
+    with Pool(max(1, args.workers)) as pool:
+        for i, (anno_path, n, t, error) in enumerate(pool.imap_unordered(_worker, jobs)):
+            if error is None:
+                print('{}/{}: {} ({} points, {:.1f}s)'.format(i + 1, len(jobs), anno_path, n, t))
+            else:
+                print(anno_path, 'ERROR!!', error)
+                failed.append(anno_path)
+    if failed:
+        print('{} rooms failed, run again to retry them:\n{}'.format(len(failed), '\n'.join(failed)))
+
+    if args.store_root is not None:
+        sys.path.append(ROOT_DIR)
+        from util.scene_store import pack_scenes
+        data_paths = sorted(glob.glob(os.path.join(args.output_folder, 'Area_*.npy')))
+        pack_scenes(data_paths, args.store_root, color_mode='rgb', ignore_label=255)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import numpy as np
 import glob
 import os
+import re
 import sys
+import warnings
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # ROOT_DIR = os.path.dirname(BASE_DIR)
@@ -34,6 +36,56 @@ print(f'g_label2color:\n{g_label2color}')
 # CONVERT ORIGINAL DATA TO OUR DATA_LABEL FILES
 # -----------------------------------------------------------------------------
 
+def _parse_chunk(chunk, num_cols):
+    try:
+        with warnings.catch_warnings():
+            # np.fromstring stops at the first token it cannot parse (a warning in numpy 1.x, an error in 2.x)
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = np.fromstring(chunk, dtype=np.float64, sep=' ')
+    except ValueError:
+        values = np.zeros(0)
+    num_lines = chunk.count(b'\n') + (not chunk.endswith(b'\n'))
+    if values.size == num_lines * num_cols:
+        return values.reshape(-1, num_cols)
+    # malformed chunk (e.g. the stray character in Area_5/hallway_6 of v1.2): drop non-numeric
+    # characters, then keep only the lines that still have num_cols values
+    chunk = re.sub(rb'[^0-9eE+\-.\s]', b'', chunk)
+    rows = []
+    for line in chunk.splitlines():
+        try:
+            row = [float(x) for x in line.split()]
+        except ValueError:
+            continue
+        if len(row) == num_cols:
+            rows.append(row)
+    return np.array(rows, dtype=np.float64).reshape(-1, num_cols)
+
+
+def load_txt_points(filename, num_cols=6, chunk_size=64 * 1024 * 1024):
+    """ Fast replacement of np.loadtxt for the whitespace separated S3DIS instance files.
+        The file is parsed in chunks of whole lines with np.fromstring.
+    """
+    blocks = []
+    with open(filename, 'rb') as f:
+        tail = b''
+        while True:
+            buf = f.read(chunk_size)
+            if not buf:
+                break
+            buf = tail + buf
+            end = buf.rfind(b'\n') + 1
+            if end == 0:
+                tail = buf
+                continue
+            tail = buf[end:]
+            blocks.append(_parse_chunk(buf[:end], num_cols))
+        if tail.strip():
+            blocks.append(_parse_chunk(tail, num_cols))
+    if not blocks:
+        return np.zeros((0, num_cols), dtype=np.float64)
+    return np.concatenate(blocks, 0)
+
+
 def collect_point_label(anno_path, out_filename, file_format='txt'):
     """ Convert original dataset files to data_label file (each line is XYZRGBL).
         We aggregated all the points from each instance in the room.
@@ -54,7 +106,7 @@ def collect_point_label(anno_path, out_filename, file_format='txt'):
         if cls not in g_classes: # note: in some room there is 'staris' class..
             cls = 'clutter'
 
-        points = np.loadtxt(f)
+        points = load_txt_points(f)
         labels = np.ones((points.shape[0],1)) * g_class2label[cls]
         points_list.append(np.concatenate([points, labels], 1)) # Nx7
     
@@ -63,13 +115,7 @@ def collect_point_label(anno_path, out_filename, file_format='txt'):
     data_label[:, 0:3] -= xyz_min
     
     if file_format=='txt':
-        fout = open(out_filename, 'w')
-        for i in range(data_label.shape[0]):
-            fout.write('%f %f %f %d %d %d %d\n' % \
-                          (data_label[i,0], data_label[i,1], data_label[i,2],
-                           data_label[i,3], data_label[i,4], data_label[i,5],
-                           data_label[i,6]))
-        fout.close()
+        np.savetxt(out_filename, data_label, fmt='%f %f %f %d %d %d %d')
     elif file_format=='numpy':
         np.save(out_filename, data_label)
     else:
@@ -1,7 +1,48 @@
 import torch
 from torch.autograd import Function
 
-import cuda_sparse_ops
+try:
+  import cuda_sparse_ops
+except ImportError:  # CPU-only install, the ops run the *_cpu implementations below
+  cuda_sparse_ops = None
+
+# mappings gathered at once by the CPU implementations, bounds their memory to
+# CHUNK_SIZE x h x c instead of m x h x c
+CHUNK_SIZE = 1 << 16
+
+
+def dot_product_forward_cpu(query, pos_enc, out_F, kq_map):
+  # out_F[i, h] += <query[kq_map[1][i], h], pos_enc[kq_map[0][i] % kkk, h]>
+  kkk = pos_enc.shape[0]
+  for s in range(0, kq_map.shape[1], CHUNK_SIZE):
+    query_idx, kernel_idx = kq_map[1, s:s + CHUNK_SIZE].long(), kq_map[0, s:s + CHUNK_SIZE].long() % kkk
+    out_F[s:s + CHUNK_SIZE] += (query[query_idx] * pos_enc[kernel_idx]).sum(-1)
+  return out_F
+
+
+def dot_product_backward_cpu(query, pos_enc, kq_map, grad_query, grad_pos, grad_out_F):
+  kkk = pos_enc.shape[0]
+  for s in range(0, kq_map.shape[1], CHUNK_SIZE):
+    query_idx, kernel_idx = kq_map[1, s:s + CHUNK_SIZE].long(), kq_map[0, s:s + CHUNK_SIZE].long() % kkk
+    grad = grad_out_F[s:s + CHUNK_SIZE].unsqueeze(-1)
+    grad_query.index_add_(0, query_idx, grad * pos_enc[kernel_idx])
+    grad_pos.index_add_(0, kernel_idx, grad * query[query_idx])
+
+
+def scalar_attention_forward_cpu(weight, value, out_F, kq_indices):
+  # out_F[kq_indices[1][i], h] += weight[i, h] * value[kq_indices[0][i], h]
+  for s in range(0, kq_indices.shape[1], CHUNK_SIZE):
+    value_idx, out_idx = kq_indices[0, s:s + CHUNK_SIZE].long(), kq_indices[1, s:s + CHUNK_SIZE].long()
+    out_F.index_add_(0, out_idx, weight[s:s + CHUNK_SIZE].unsqueeze(-1) * value[value_idx])
+  return out_F
+
+
+def scalar_attention_backward_cpu(weight, value, kq_indices, grad_weight, grad_value, grad_out_F):
+  for s in range(0, kq_indices.shape[1], CHUNK_SIZE):
+    value_idx, out_idx = kq_indices[0, s:s + CHUNK_SIZE].long(), kq_indices[1, s:s + CHUNK_SIZE].long()
+    grad = grad_out_F[out_idx]
+    grad_weight[s:s + CHUNK_SIZE] += (grad * value[value_idx]).sum(-1)
+    grad_value.index_add_(0, value_idx, weight[s:s + CHUNK_SIZE].unsqueeze(-1) * grad)
 
 
 class DotProduct(Function):
@@ -12,6 +53,8 @@ class DotProduct(Function):
     _, ctx.h, ctx.c = query.shape
     ctx.kkk = pos_enc.shape[0]
     ctx.save_for_backward(query, pos_enc, kq_map)
+    if not query.is_cuda:
+      return dot_product_forward_cpu(query, pos_enc, out_F, kq_map)
     cuda_sparse_ops.dot_product_forward(ctx.m, ctx.h, ctx.kkk, ctx.c, query, pos_enc,
                                         out_F, kq_map)
     return out_F
@@ -21,6 +64,9 @@ class DotProduct(Function):
     query, pos_enc, kq_map = ctx.saved_tensors
     grad_query = torch.zeros_like(query)
     grad_pos = torch.zeros_like(pos_enc)
+    if not query.is_cuda:
+      dot_product_backward_cpu(query, pos_enc, kq_map, grad_query, grad_pos, grad_out_F.contiguous())
+      return grad_query, grad_pos, None, None
     cuda_sparse_ops.dot_product_backward(ctx.m, ctx.h, ctx.kkk, ctx.c, query, pos_enc,
                                          kq_map, grad_query, grad_pos, grad_out_F)
     return grad_query, grad_pos, None, None
@@ -35,6 +81,8 @@ class ScalarAttention(Function):
     ctx.m = kq_indices.shape[1]
     _, ctx.h, ctx.c = value.shape
     ctx.save_for_backward(weight, value, kq_indices)
+    if not value.is_cuda:
+      return scalar_attention_forward_cpu(weight, value, out_F, kq_indices)
     cuda_sparse_ops.scalar_attention_forward(ctx.m, ctx.h, ctx.c, weight, value, out_F,
                                              kq_indices)
     return out_F
@@ -44,9 +92,51 @@ class ScalarAttention(Function):
     weight, value, kq_indices = ctx.saved_tensors
     grad_weight = torch.zeros_like(weight)
     grad_value = torch.zeros_like(value)
+    if not value.is_cuda:
+      scalar_attention_backward_cpu(weight, value, kq_indices, grad_weight, grad_value, grad_out_F.contiguous())
+      return grad_weight, grad_value, None, None
     cuda_sparse_ops.scalar_attention_backward(ctx.m, ctx.h, ctx.c, weight, value,
                                               kq_indices, grad_weight, grad_value,
                                               grad_out_F)
     return grad_weight, grad_value, None, None
 
 scalar_attention_cuda = ScalarAttention.apply
+
+
+if __name__ == '__main__':
+  # parity of the CPU implementations with a dense reference (and the CUDA kernels when available),
+  # kq_map laid out like LocalSelfAttentionBase.key_query_map_from_kernel_map
+  from torch.autograd import gradcheck
+
+  torch.manual_seed(0)
+  n, h, c, kkk, m = 50, 4, 8, 27, 600
+  in_idx, out_idx, kernel_idx = torch.randint(0, n, (m,)), torch.randint(0, n, (m,)), torch.randint(0, kkk, (m,))
+  kq_map = torch.stack([in_idx * kkk + kernel_idx, out_idx]).int()
+  kq_indices = torch.stack([in_idx, out_idx]).int()
+
+  query, pos_enc = torch.randn(n, h, c, dtype=torch.float64), torch.randn(kkk, h, c, dtype=torch.float64)
+  weight, value = torch.randn(m, h, dtype=torch.float64), torch.randn(n, h, c, dtype=torch.float64)
+  ref_attn = (query[out_idx] * pos_enc[kernel_idx]).sum(-1)
+  ref_out = torch.zeros(n, h, c, dtype=torch.float64).index_add_(0, out_idx, weight.unsqueeze(-1) * value[in_idx])
+
+  CHUNK_SIZE = 128  # exercise the chunking
+  assert torch.allclose(dot_product_cuda(query, pos_enc, torch.zeros(m, h, dtype=torch.float64), kq_map), ref_attn)
+  assert torch.allclose(scalar_attention_cuda(weight, value, torch.zeros(n, h, c, dtype=torch.float64), kq_indices), ref_out)
+  inputs = [x.requires_grad_() for x in (query, pos_enc, weight, value)]
+  assert gradcheck(lambda q, p: dot_product_cuda(q, p, torch.zeros(m, h, dtype=torch.float64), kq_map), inputs[:2])
+  assert gradcheck(lambda w, v: scalar_attention_cuda(w, v, torch.zeros(n, h, c, dtype=torch.float64), kq_indices), inputs[2:])
+  print('cpu: forward and gradcheck ok')
+
+  if cuda_sparse_ops is not None and torch.cuda.is_available():
+    cuda = [x.detach().float().cuda().requires_grad_() for x in (query, pos_enc, weight, value)]
+    cpu = [x.detach().float().requires_grad_() for x in (query, pos_enc, weight, value)]
+    outputs = []
+    for (q, p, w, v), device in ((cuda, 'cuda'), (cpu, 'cpu')):
+      attn = dot_product_cuda(q, p, torch.zeros(m, h, device=device), kq_map.to(device))
+      out = scalar_attention_cuda(w, v, torch.zeros(n, h, c, device=device), kq_indices.to(device))
+      (attn.pow(2).sum() + out.pow(2).sum()).backward()
+      outputs.append((attn.detach().cpu(), out.detach().cpu()))
+    for x, y in zip(outputs[0] + tuple(cuda), outputs[1] + tuple(cpu)):
+      x, y = (x.grad, y.grad) if x.requires_grad else (x, y)
+      assert torch.allclose(x.cpu(), y, atol=1e-4)
+    print('cuda: outputs and gradients match the cpu implementation')
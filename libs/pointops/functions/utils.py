@@ -90,10 +90,8 @@ def query_and_group(nsample,
 
 
 def offset2batch(offset):
-    return torch.cat([
-        torch.tensor([i] * (o - offset[i - 1])) if i > 0 else torch.tensor([i] * o)
-        for i, o in enumerate(offset)
-    ], dim=0).long().to(offset.device)
+    count = torch.diff(offset.long(), prepend=offset.new_zeros(1, dtype=torch.long))
+    return torch.repeat_interleave(torch.arange(count.shape[0], device=offset.device), count)
 
 
 def batch2offset(batch):
@@ -2,15 +2,36 @@
 The part of attention operations is written by Xin Lai.
 Email: xinlai@cse.cuhk.edu.hk
 '''
+import functools
 from typing import Tuple
 
 import torch
 from torch.autograd import Function
 import torch.nn as nn
 
-import pointops2_cuda as pointops_cuda
+try:
+    import pointops2_cuda as pointops_cuda
+except ImportError:  # CPU-only install, every op runs the pointops_cpu implementation
+    pointops_cuda = None
+try:
+    from . import pointops_cpu
+except ImportError:
+    import pointops_cpu
+try:
+    from torch.amp import custom_fwd as _custom_fwd, custom_bwd as _custom_bwd
+    custom_fwd, custom_bwd = functools.partial(_custom_fwd, device_type='cuda'), functools.partial(_custom_bwd, device_type='cuda')
+except ImportError:  # torch < 2.4
+    from torch.cuda.amp import custom_fwd, custom_bwd
 import time
 
+
+# Mixed precision: the attention, relative position and interpolation ops take half or bfloat16
+# inputs, save them for backward in their own dtype, run the kernels on fp32 copies (accumulation in
+# fp32) and return outputs / gradients in the dtype of the inputs. custom_fwd / custom_bwd run the
+# backward under the autocast state of the forward.
+def _fp32(*tensors):
+    return [t.float() if t.dtype in (torch.float16, torch.bfloat16) else t for t in tensors]
+
 class FurthestSampling(Function):
     @staticmethod
     def forward(ctx, xyz, offset, new_offset):
@@ -19,10 +40,12 @@ class FurthestSampling(Function):
         output: idx: (m)
         """
         assert xyz.is_contiguous()
-        n, b, n_max = xyz.shape[0], offset.shape[0], offset[0]
-        for i in range(1, b):
-            n_max = max(offset[i] - offset[i-1], n_max)
-        idx = torch.cuda.IntTensor(new_offset[b-1].item()).zero_()
+        if not xyz.is_cuda:
+            return pointops_cpu.furthestsampling(xyz, offset, new_offset)
+        n, b = xyz.shape[0], offset.shape[0]
+        # the largest sample and the number of samples read back in a single sync
+        n_max, m = torch.stack([torch.diff(offset, prepend=offset.new_zeros(1)).max(), new_offset[-1]]).tolist()
+        idx = torch.cuda.IntTensor(m).zero_()
         tmp = torch.cuda.FloatTensor(n).fill_(1e10)
         pointops_cuda.furthestsampling_cuda(b, n_max, xyz, offset, new_offset, tmp, idx)
         del tmp
@@ -41,9 +64,12 @@ class KNNQuery(Function):
         if new_xyz is None: new_xyz = xyz
         assert xyz.is_contiguous() and new_xyz.is_contiguous()
         m = new_xyz.shape[0]
-        idx = torch.cuda.IntTensor(m, nsample).zero_()
-        dist2 = torch.cuda.FloatTensor(m, nsample).zero_()
-        pointops_cuda.knnquery_cuda(m, nsample, xyz, new_xyz, offset, new_offset, idx, dist2)
+        if xyz.is_cuda:
+            idx = torch.cuda.IntTensor(m, nsample).zero_()
+            dist2 = torch.cuda.FloatTensor(m, nsample).zero_()
+            pointops_cuda.knnquery_cuda(m, nsample, xyz, new_xyz, offset, new_offset, idx, dist2)
+        else:
+            idx, dist2 = pointops_cpu.knnquery(nsample, xyz, new_xyz, offset, new_offset)
         return idx, torch.sqrt(dist2)
 
 knnquery = KNNQuery.apply
@@ -58,8 +84,11 @@ class Grouping(Function):
         """
         assert input.is_contiguous() and idx.is_contiguous()
         m, nsample, n, c = idx.shape[0], idx.shape[1], input.shape[0], input.shape[1]
-        output = torch.cuda.FloatTensor(m, nsample, c)
-        pointops_cuda.grouping_forward_cuda(m, nsample, c, input, idx, output)
+        if input.is_cuda:
+            output = torch.cuda.FloatTensor(m, nsample, c)
+            pointops_cuda.grouping_forward_cuda(m, nsample, c, input, idx, output)
+        else:
+            output = pointops_cpu.grouping_forward(input, idx)
         ctx.n = n
         ctx.save_for_backward(idx)
         return output
@@ -73,8 +102,11 @@ class Grouping(Function):
         n = ctx.n
         idx, = ctx.saved_tensors
         m, nsample, c = grad_output.shape
-        grad_input = torch.cuda.FloatTensor(n, c).zero_()
-        pointops_cuda.grouping_backward_cuda(m, nsample, c, grad_output, idx, grad_input)
+        if grad_output.is_cuda:
+            grad_input = torch.cuda.FloatTensor(n, c).zero_()
+            pointops_cuda.grouping_backward_cuda(m, nsample, c, grad_output, idx, grad_input)
+        else:
+            grad_input = pointops_cpu.grouping_backward(grad_output, idx, n)
         return grad_input, None
 
 grouping = Grouping.apply
@@ -93,8 +125,11 @@ class AttentionStep1(Function):
         M = index0.shape[0]
         C = int(C_div_h * h)
 
-        output = torch.cuda.FloatTensor(M, h).zero_()
-        pointops_cuda.attention_step1_forward_cuda(N_k, M, h, C, q, k, index0, index1, output)
+        if q.is_cuda:
+            output = torch.cuda.FloatTensor(M, h).zero_()
+            pointops_cuda.attention_step1_forward_cuda(N_k, M, h, C, q, k, index0, index1, output)
+        else:
+            output = pointops_cpu.attention_step1_forward(q, k, index0, index1)
         ctx.N_q = N_q
         ctx.N_k = N_k
         ctx.C = C
@@ -122,6 +157,10 @@ class AttentionStep1(Function):
 
         # print("attn.shape: {} v.shape: {}, index0.shape: {}, index1.shape: {}".format(attn.shape, v.shape, index0.shape, index1.shape))
 
+        if not grad_output.is_cuda:
+            grad_q, grad_k = pointops_cpu.attention_step1_backward(grad_output, index0, index1, q, k)
+            return grad_q, grad_k, None, None
+
         grad_q = torch.cuda.FloatTensor(N_q, h, C//h).zero_()
         grad_k = torch.cuda.FloatTensor(N_k, h, C//h).zero_()
 
@@ -141,6 +180,7 @@ attention_step1 = AttentionStep1.apply
 
 class AttentionStep1_v2(Function):
     @staticmethod
+    @custom_fwd
     def forward(ctx, q, k, index1, index0_offsets, n_max):
         """
         input: q: (N, h, C//h), k: (N, h, C//h), index0: (M), index1: (M)
@@ -153,17 +193,23 @@ class AttentionStep1_v2(Function):
         N_k = k.shape[0]
         M = index1.shape[0]
         C = int(C_div_h * h)
+        dtype = q.dtype
+        ctx.save_for_backward(q, k, index0_offsets, index1)
+        q, k = _fp32(q, k)
 
-        output = torch.cuda.FloatTensor(M, h).zero_()
-        pointops_cuda.attention_step1_forward_cuda_v2(N_k, M, h, C, n_max, q, k, index0_offsets, index1, output)
+        if q.is_cuda:
+            output = torch.cuda.FloatTensor(M, h).zero_()
+            pointops_cuda.attention_step1_forward_cuda_v2(N_k, M, h, C, n_max, q, k, index0_offsets, index1, output)
+        else:
+            output = pointops_cpu.attention_step1_forward_v2(q, k, index1, index0_offsets)
         ctx.N_q = N_q
         ctx.N_k = N_k
         ctx.C = C
         ctx.n_max = n_max
-        ctx.save_for_backward(q, k, index0_offsets, index1)
-        return output
+        return output.to(dtype)
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         """
         input: grad_output: (N, h, C//h)
@@ -176,8 +222,10 @@ class AttentionStep1_v2(Function):
         n_max = ctx.n_max
         q, k, index0_offsets, index1 = ctx.saved_tensors
         M, h = grad_output.shape
+        dtype_q, dtype_k = q.dtype, k.dtype
+        q, k = _fp32(q, k)
         
-        grad_output = grad_output.contiguous()
+        grad_output = grad_output.float().contiguous()
         # print("grad_output.is_contiguous(): ", grad_output.is_contiguous())
         assert q.is_contiguous() and k.is_contiguous() and index0_offsets.is_contiguous() and index1.is_contiguous() and grad_output.is_contiguous()
 
@@ -185,6 +233,10 @@ class AttentionStep1_v2(Function):
 
         # print("attn.shape: {} v.shape: {}, index0.shape: {}, index1.shape: {}".format(attn.shape, v.shape, index0.shape, index1.shape))
 
+        if not grad_output.is_cuda:
+            grad_q, grad_k = pointops_cpu.attention_step1_backward_v2(grad_output, index0_offsets, index1, q, k)
+            return grad_q.to(dtype_q), grad_k.to(dtype_k), None, None, None
+
         grad_q = torch.cuda.FloatTensor(N_q, h, C//h).zero_()
         grad_k = torch.cuda.FloatTensor(N_k, h, C//h).zero_()
 
@@ -198,7 +250,7 @@ class AttentionStep1_v2(Function):
         # print("time v7: {}".format(end - start))
         # # input()
         
-        return grad_q, grad_k, None, None, None
+        return grad_q.to(dtype_q), grad_k.to(dtype_k), None, None, None
 
 attention_step1_v2 = AttentionStep1_v2.apply
 
@@ -206,6 +258,7 @@ attention_step1_v2 = AttentionStep1_v2.apply
 
 class AttentionStep2(Function):
     @staticmethod
+    @custom_fwd
     def forward(ctx, attn, v, index0, index1):
         """
         input: attn: (M, h), v: (N, h, C//h), index0: (M), index1: (M)
@@ -217,17 +270,23 @@ class AttentionStep2(Function):
         N_q = index0.max().item() + 1
         N_v, h, C_div_h = v.shape
         C = int(C_div_h * h)
+        dtype = v.dtype
+        ctx.save_for_backward(attn, v, index0, index1)
+        attn, v = _fp32(attn, v)
 
-        output = torch.cuda.FloatTensor(N_q, h, C//h).zero_()
-        pointops_cuda.attention_step2_forward_cuda(N_q, M, h, C, attn, v, index0, index1, output)
+        if attn.is_cuda:
+            output = torch.cuda.FloatTensor(N_q, h, C//h).zero_()
+            pointops_cuda.attention_step2_forward_cuda(N_q, M, h, C, attn, v, index0, index1, output)
+        else:
+            output = pointops_cpu.attention_step2_forward(attn, v, index0, index1, N_q)
         ctx.M = M
 
         # print("attn[:5,:5]: ", attn[:5, :5])
 
-        ctx.save_for_backward(attn, v, index0, index1)
-        return output
+        return output.to(dtype)
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         """
         input: grad_output: (N, h, C//h)
@@ -238,8 +297,10 @@ class AttentionStep2(Function):
         N_v = v.shape[0]
         N_q, h, C_div_h = grad_output.shape
         C = h * C_div_h
+        dtype_attn, dtype_v = attn.dtype, v.dtype
+        attn, v = _fp32(attn, v)
         
-        grad_output = grad_output.contiguous()
+        grad_output = grad_output.float().contiguous()
         # print("grad_output.is_contiguous(): ", grad_output.is_contiguous())
         assert attn.is_contiguous() and v.is_contiguous() and index0.is_contiguous() and index1.is_contiguous() and grad_output.is_contiguous()
 
@@ -247,6 +308,10 @@ class AttentionStep2(Function):
 
         # print("attn.shape: {} v.shape: {}, index0.shape: {}, index1.shape: {}".format(attn.shape, v.shape, index0.shape, index1.shape))
 
+        if not grad_output.is_cuda:
+            grad_attn, grad_v = pointops_cpu.attention_step2_backward(grad_output, index0, index1, attn, v)
+            return grad_attn.to(dtype_attn), grad_v.to(dtype_v), None, None
+
         grad_attn = torch.cuda.FloatTensor(M, h).zero_()
         grad_v = torch.cuda.FloatTensor(N_v, h, C//h).zero_()
 
@@ -260,7 +325,7 @@ class AttentionStep2(Function):
         # print("time v8: {}".format(end - start))
         # # input()
         
-        return grad_attn, grad_v, None, None
+        return grad_attn.to(dtype_attn), grad_v.to(dtype_v), None, None
 
 attention_step2 = AttentionStep2.apply
 
@@ -280,8 +345,11 @@ class AttentionStep2_v2(Function):
         N, h, C_div_h = v.shape
         C = int(C_div_h * h)
 
-        output = torch.cuda.FloatTensor(L, h, C//h).zero_()
-        pointops_cuda.attention_step2_forward_cuda(N, M, h, C, attn, v, index0, index1, output)
+        if attn.is_cuda:
+            output = torch.cuda.FloatTensor(L, h, C//h).zero_()
+            pointops_cuda.attention_step2_forward_cuda(N, M, h, C, attn, v, index0, index1, output)
+        else:
+            output = pointops_cpu.attention_step2_forward(attn, v, index0, index1, L)
         ctx.M = M
 
         # print("attn[:5,:5]: ", attn[:5, :5])
@@ -309,6 +377,10 @@ class AttentionStep2_v2(Function):
 
         # print("attn.shape: {} v.shape: {}, index0.shape: {}, index1.shape: {}".format(attn.shape, v.shape, index0.shape, index1.shape))
 
+        if not grad_output.is_cuda:
+            grad_attn, grad_v = pointops_cpu.attention_step2_backward(grad_output, index0, index1, attn, v)
+            return grad_attn, grad_v, None, None
+
         grad_attn = torch.cuda.FloatTensor(M, h).zero_()
         grad_v = torch.cuda.FloatTensor(N, h, C//h).zero_()
 
@@ -319,6 +391,7 @@ attention_step2_v2 = AttentionStep2_v2.apply
 
 class DotProdWithIdx(Function):
     @staticmethod
+    @custom_fwd
     def forward(ctx, q, index, table, rel_idx):
         """
         input: q: (N, h, hdim), index: (M), table: (L, h, hdim, 3), rel_idx: (M, 3)
@@ -328,13 +401,19 @@ class DotProdWithIdx(Function):
 
         N, h, hdim = q.shape
         M = index.shape[0]
-
-        output = torch.cuda.FloatTensor(M, h).zero_()
-        pointops_cuda.dot_prod_with_idx_forward_cuda(N, M, h, hdim, q, index, table, rel_idx, output)
+        dtype = q.dtype
         ctx.save_for_backward(q, index, table, rel_idx)
-        return output
+        q, table = _fp32(q, table)
+
+        if q.is_cuda:
+            output = torch.cuda.FloatTensor(M, h).zero_()
+            pointops_cuda.dot_prod_with_idx_forward_cuda(N, M, h, hdim, q, index, table, rel_idx, output)
+        else:
+            output = pointops_cpu.dot_prod_with_idx_forward(q, index, table, rel_idx)
+        return output.to(dtype)
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         """
         input: grad_output: [M, h]
@@ -344,14 +423,20 @@ class DotProdWithIdx(Function):
         M, h = grad_output.shape
         N, _, hdim = q.shape
         L = table.shape[0]
+        dtype_q, dtype_table = q.dtype, table.dtype
+        q, table = _fp32(q, table)
         
-        grad_output = grad_output.contiguous()
+        grad_output = grad_output.float().contiguous()
         assert q.is_contiguous() and index.is_contiguous() and table.is_contiguous() and rel_idx.is_contiguous() and grad_output.is_contiguous()
 
         # print("back: attn[:5,:5]: ", attn[:5, :5])
 
         # print("attn.shape: {} v.shape: {}, index0.shape: {}, index1.shape: {}".format(attn.shape, v.shape, index0.shape, index1.shape))
 
+        if not grad_output.is_cuda:
+            grad_q, grad_table = pointops_cpu.dot_prod_with_idx_backward(grad_output, q, index, table, rel_idx)
+            return grad_q.to(dtype_q), None, grad_table.to(dtype_table), None
+
         grad_q = torch.cuda.FloatTensor(N, h, hdim).zero_()
         grad_table = torch.cuda.FloatTensor(L, h, hdim, 3).zero_()
 
@@ -365,7 +450,7 @@ class DotProdWithIdx(Function):
         # print("time v9: {}".format(end - start))
         # # input()
         
-        return grad_q, None, grad_table, None
+        return grad_q.to(dtype_q), None, grad_table.to(dtype_table), None
 
 dot_prod_with_idx = DotProdWithIdx.apply
 
@@ -445,6 +530,7 @@ dot_prod_with_idx_v2 = DotProdWithIdx_v2.apply
 
 class DotProdWithIdx_v3(Function):
     @staticmethod
+    @custom_fwd
     def forward(ctx, q, index_q_offsets, n_max, k, index_k, table_q, table_k, rel_idx):
         """
         input: q: (N, h, hdim), index_q: (M), k: (N, h, hdim), index_k: (M), table_q: (L, h, hdim, 3), table_k: (L, h, hdim, 3), rel_idx: (M, 3)
@@ -456,6 +542,9 @@ class DotProdWithIdx_v3(Function):
         M = index_k.shape[0]
         L = table_q.shape[0]
         assert table_k.shape[0] == L
+        dtype = q.dtype
+        ctx.save_for_backward(q, index_q_offsets, k, index_k, table_q, table_k, rel_idx)
+        q, k, table_q, table_k = _fp32(q, k, table_q, table_k)
 
         # # obtain the mapping from block_idx to m_idx
         # rel_idx_merge = rel_idx[:, 0] + rel_idx[:, 1] * L + rel_idx[:, 2] * (L ** 2) #[M, ]
@@ -472,16 +561,19 @@ class DotProdWithIdx_v3(Function):
 
         # print("M: {}, L: {}, n_max: {}".format(M, L, n_max))
 
-        output = torch.cuda.FloatTensor(M, h).zero_()
-        # pointops_cuda.dot_prod_with_idx_forward_cuda(N, M, h, hdim, q, index, table, rel_idx, output)
-        pointops_cuda.dot_prod_with_idx_forward_cuda_v3(N, M, h, hdim, n_max, q, index_q_offsets, k, index_k, table_q, table_k, rel_idx, output)
+        if q.is_cuda:
+            output = torch.cuda.FloatTensor(M, h).zero_()
+            # pointops_cuda.dot_prod_with_idx_forward_cuda(N, M, h, hdim, q, index, table, rel_idx, output)
+            pointops_cuda.dot_prod_with_idx_forward_cuda_v3(N, M, h, hdim, n_max, q, index_q_offsets, k, index_k, table_q, table_k, rel_idx, output)
+        else:
+            output = pointops_cpu.dot_prod_with_idx_forward_v3(q, index_q_offsets, k, index_k, table_q, table_k, rel_idx)
         
         ctx.n_max = n_max
         # ctx.T = T
-        ctx.save_for_backward(q, index_q_offsets, k, index_k, table_q, table_k, rel_idx)
-        return output
+        return output.to(dtype)
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         """
         input: grad_output: [M, h]
@@ -492,14 +584,20 @@ class DotProdWithIdx_v3(Function):
         N, _, hdim = q.shape
         L = table_q.shape[0]
         n_max = ctx.n_max
+        dtypes = q.dtype, k.dtype, table_q.dtype, table_k.dtype
+        q, k, table_q, table_k = _fp32(q, k, table_q, table_k)
         
-        grad_output = grad_output.contiguous()
+        grad_output = grad_output.float().contiguous()
         assert q.is_contiguous() and index_q_offsets.is_contiguous() and k.is_contiguous() and index_k.is_contiguous() and table_q.is_contiguous() and table_k.is_contiguous() and rel_idx.is_contiguous() and grad_output.is_contiguous()
 
         # print("back: attn[:5,:5]: ", attn[:5, :5])
 
         # print("attn.shape: {} v.shape: {}, index0.shape: {}, index1.shape: {}".format(attn.shape, v.shape, index0.shape, index1.shape))
 
+        if not grad_output.is_cuda:
+            grad_q, grad_k, grad_table_q, grad_table_k = pointops_cpu.dot_prod_with_idx_backward_v3(grad_output, q, index_q_offsets, k, index_k, table_q, table_k, rel_idx)
+            return grad_q.to(dtypes[0]), None, None, grad_k.to(dtypes[1]), None, grad_table_q.to(dtypes[2]), grad_table_k.to(dtypes[3]), None
+
         grad_q = torch.cuda.FloatTensor(N, h, hdim).zero_()
         grad_table_q = torch.cuda.FloatTensor(L, h, hdim, 3).zero_()
         grad_k = torch.cuda.FloatTensor(N, h, hdim).zero_()
@@ -514,7 +612,7 @@ class DotProdWithIdx_v3(Function):
         # end = time.time()
         # print("time v9: {}".format(end - start))
         # # input()
-        return grad_q, None, None, grad_k, None, grad_table_q, grad_table_k, None
+        return grad_q.to(dtypes[0]), None, None, grad_k.to(dtypes[1]), None, grad_table_q.to(dtypes[2]), grad_table_k.to(dtypes[3]), None
 
 dot_prod_with_idx_v3 = DotProdWithIdx_v3.apply
 
@@ -531,8 +629,11 @@ class AttentionStep2WithRelPosValue(Function):
         N_v, h, hdim = v.shape
         N_q = index0.max().item() + 1
 
-        output = torch.cuda.FloatTensor(N_q, h, hdim).zero_()
-        pointops_cuda.attention_step2_with_rel_pos_value_forward_cuda(N_q, M, h, hdim, attn, v, index0, index1, table, rel_idx, output)
+        if attn.is_cuda:
+            output = torch.cuda.FloatTensor(N_q, h, hdim).zero_()
+            pointops_cuda.attention_step2_with_rel_pos_value_forward_cuda(N_q, M, h, hdim, attn, v, index0, index1, table, rel_idx, output)
+        else:
+            output = pointops_cpu.attention_step2_with_rel_pos_value_forward(attn, v, index0, index1, table, rel_idx, N_q)
 
         # print("attn[:5,:5]: ", attn[:5, :5])
 
@@ -559,6 +660,10 @@ class AttentionStep2WithRelPosValue(Function):
 
         # print("attn.shape: {} v.shape: {}, index0.shape: {}, index1.shape: {}".format(attn.shape, v.shape, index0.shape, index1.shape))
 
+        if not grad_output.is_cuda:
+            grad_attn, grad_v, grad_table = pointops_cpu.attention_step2_with_rel_pos_value_backward(grad_output, index0, index1, attn, v, table, rel_idx)
+            return grad_attn, grad_v, None, None, grad_table, None
+
         grad_attn = torch.cuda.FloatTensor(M, h).zero_()
         grad_v = torch.cuda.FloatTensor(N_v, h, hdim).zero_()
         grad_table = torch.cuda.FloatTensor(L, h, hdim, 3).zero_()
@@ -583,6 +688,7 @@ attention_step2_with_rel_pos_value = AttentionStep2WithRelPosValue.apply
 
 class AttentionStep2WithRelPosValue_v2(Function):
     @staticmethod
+    @custom_fwd
     def forward(ctx, attn, v, index0_offsets, n_max, index1, table, rel_idx):
         """
         input: attn: (M, h), v: (N, h, hdim), index0_offsets: (M), index1: (M), table: (L, h, hdim, 3), rel_idx: (M, 3)
@@ -593,17 +699,23 @@ class AttentionStep2WithRelPosValue_v2(Function):
         M, h = attn.shape
         N, h, hdim = v.shape
         # N_q = int(index0_offsets.max().item()) + 1
+        dtype = v.dtype
+        ctx.save_for_backward(attn, v, index0_offsets, index1, table, rel_idx)
+        attn, v, table = _fp32(attn, v, table)
 
-        output = torch.cuda.FloatTensor(N, h, hdim).zero_()
-        pointops_cuda.attention_step2_with_rel_pos_value_forward_cuda_v2(N, M, h, hdim, n_max, attn, v, index0_offsets, index1, table, rel_idx, output)
+        if attn.is_cuda:
+            output = torch.cuda.FloatTensor(N, h, hdim).zero_()
+            pointops_cuda.attention_step2_with_rel_pos_value_forward_cuda_v2(N, M, h, hdim, n_max, attn, v, index0_offsets, index1, table, rel_idx, output)
+        else:
+            output = pointops_cpu.attention_step2_with_rel_pos_value_forward_v2(attn, v, index0_offsets, index1, table, rel_idx)
 
         # print("attn[:5,:5]: ", attn[:5, :5])
 
         ctx.n_max = n_max
-        ctx.save_for_backward(attn, v, index0_offsets, index1, table, rel_idx)
-        return output
+        return output.to(dtype)
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         """
         input: grad_output: (N, h, C//h)
@@ -615,8 +727,10 @@ class AttentionStep2WithRelPosValue_v2(Function):
         N = v.shape[0]
         M = attn.shape[0]
         L = table.shape[0]
+        dtypes = attn.dtype, v.dtype, table.dtype
+        attn, v, table = _fp32(attn, v, table)
 
-        # grad_output = grad_output.contiguous()
+        grad_output = grad_output.float().contiguous()
         # print("grad_output.is_contiguous(): ", grad_output.is_contiguous())
         assert attn.is_contiguous() and v.is_contiguous() and index0_offsets.is_contiguous() and index1.is_contiguous() and grad_output.is_contiguous() and table.is_contiguous() and rel_idx.is_contiguous()
 
@@ -624,6 +738,10 @@ class AttentionStep2WithRelPosValue_v2(Function):
 
         # print("attn.shape: {} v.shape: {}, index0_offsets.shape: {}, index1.shape: {}".format(attn.shape, v.shape, index0_offsets.shape, index1.shape))
 
+        if not grad_output.is_cuda:
+            grad_attn, grad_v, grad_table = pointops_cpu.attention_step2_with_rel_pos_value_backward_v2(grad_output, index0_offsets, index1, attn, v, table, rel_idx)
+            return grad_attn.to(dtypes[0]), grad_v.to(dtypes[1]), None, None, None, grad_table.to(dtypes[2]), None
+
         grad_attn = torch.cuda.FloatTensor(M, h).zero_()
         grad_v = torch.cuda.FloatTensor(N, h, hdim).zero_()
         grad_table = torch.cuda.FloatTensor(L, h, hdim, 3).zero_()
@@ -641,10 +759,106 @@ class AttentionStep2WithRelPosValue_v2(Function):
         # end = time.time()
         # print("time v10: {}".format(end - start))
         
-        return grad_attn, grad_v, None, None, None, grad_table, None
+        return grad_attn.to(dtypes[0]), grad_v.to(dtypes[1]), None, None, None, grad_table.to(dtypes[2]), None
 
 attention_step2_with_rel_pos_value_v2 = AttentionStep2WithRelPosValue_v2.apply
 
+
+# Relative position encoding with the relative index computed from the quantized coordinates of the
+# points: rel_idx[m] = xyz_quant[index0[m]] - xyz_quant[index1[m]] + L // 2 is formed per chunk of
+# pairs inside the ops, so the [M, 3] relative position never exists. index0 / index1 are the query /
+# key of every pair. There is no pointops2_cuda kernel for them: the chunked pointops_cpu implementation
+# is plain PyTorch and runs on the device of its inputs, CUDA tensors included.
+
+
+class DotProdWithQuant(Function):
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, q, index, index0, index1, table, xyz_quant):
+        """
+        input: q: (N, h, hdim), index: (M) (row of q of every pair, index0 or index1), index0: (M), index1: (M),
+               table: (L, h, hdim, 3), xyz_quant: (N, 3) int
+        output: output: [M, h]
+        """
+        assert q.is_contiguous() and index.is_contiguous() and table.is_contiguous() and xyz_quant.is_contiguous()
+        ctx.save_for_backward(q, index, index0, index1, table, xyz_quant)
+        q_, table_ = _fp32(q, table)
+        output = pointops_cpu.dot_prod_with_quant_forward(q_, index, index0, index1, table_, xyz_quant)
+        return output.to(q.dtype)
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad_output):
+        """
+        input: grad_output: [M, h]
+        output: (N, h, hdim), None, None, None, (L, h, hdim, 3), None
+        """
+        q, index, index0, index1, table, xyz_quant = ctx.saved_tensors
+        q_, table_ = _fp32(q, table)
+        grad_q, grad_table = pointops_cpu.dot_prod_with_quant_backward(grad_output.float().contiguous(), q_, index, index0, index1, table_, xyz_quant)
+        return grad_q.to(q.dtype), None, None, None, grad_table.to(table.dtype), None
+
+dot_prod_with_quant = DotProdWithQuant.apply
+
+
+class DotProdWithQuant_v3(Function):
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, q, index0, k, index1, table_q, table_k, xyz_quant):
+        """
+        input: q: (N, h, hdim), index0: (M), k: (N, h, hdim), index1: (M), table_q: (L, h, hdim, 3), table_k: (L, h, hdim, 3), xyz_quant: (N, 3) int
+        output: output: [M, h]
+        """
+        assert q.is_contiguous() and k.is_contiguous() and table_q.is_contiguous() and table_k.is_contiguous() and xyz_quant.is_contiguous()
+        assert table_k.shape[0] == table_q.shape[0]
+        ctx.save_for_backward(q, index0, k, index1, table_q, table_k, xyz_quant)
+        q_, k_, table_q_, table_k_ = _fp32(q, k, table_q, table_k)
+        output = pointops_cpu.dot_prod_with_quant_forward_v3(q_, index0, k_, index1, table_q_, table_k_, xyz_quant)
+        return output.to(q.dtype)
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad_output):
+        """
+        input: grad_output: [M, h]
+        output: (N, h, hdim), None, (N, h, hdim), None, (L, h, hdim, 3), (L, h, hdim, 3), None
+        """
+        q, index0, k, index1, table_q, table_k, xyz_quant = ctx.saved_tensors
+        q_, k_, table_q_, table_k_ = _fp32(q, k, table_q, table_k)
+        grad_q, grad_k, grad_table_q, grad_table_k = pointops_cpu.dot_prod_with_quant_backward_v3(grad_output.float().contiguous(), q_, index0, k_, index1, table_q_, table_k_, xyz_quant)
+        return grad_q.to(q.dtype), None, grad_k.to(k.dtype), None, grad_table_q.to(table_q.dtype), grad_table_k.to(table_k.dtype), None
+
+dot_prod_with_quant_v3 = DotProdWithQuant_v3.apply
+
+
+class AttentionStep2WithRelPosValueQuant(Function):
+    @staticmethod
+    @custom_fwd
+    def forward(ctx, attn, v, index0, index1, table, xyz_quant):
+        """
+        input: attn: (M, h), v: (N, h, hdim), index0: (M), index1: (M), table: (L, h, hdim, 3), xyz_quant: (N, 3) int
+        output: output: [N, h, hdim]
+        """
+        assert attn.is_contiguous() and v.is_contiguous() and table.is_contiguous() and xyz_quant.is_contiguous()
+        ctx.save_for_backward(attn, v, index0, index1, table, xyz_quant)
+        attn_, v_, table_ = _fp32(attn, v, table)
+        output = pointops_cpu.attention_step2_with_rel_pos_value_quant_forward(attn_, v_, index0, index1, table_, xyz_quant)
+        return output.to(v.dtype)
+
+    @staticmethod
+    @custom_bwd
+    def backward(ctx, grad_output):
+        """
+        input: grad_output: (N, h, hdim)
+        output: (M, h), (N, h, hdim), None, None, (L, h, hdim, 3), None
+        """
+        attn, v, index0, index1, table, xyz_quant = ctx.saved_tensors
+        attn_, v_, table_ = _fp32(attn, v, table)
+        grad_attn, grad_v, grad_table = pointops_cpu.attention_step2_with_rel_pos_value_quant_backward(grad_output.float().contiguous(), index0, index1, attn_, v_, table_, xyz_quant)
+        return grad_attn.to(attn.dtype), grad_v.to(v.dtype), None, None, grad_table.to(table.dtype), None
+
+attention_step2_with_rel_pos_value_quant = AttentionStep2WithRelPosValueQuant.apply
+
 def queryandgroup(nsample, xyz, new_xyz, feat, idx, offset, new_offset, use_xyz=True, return_indx=False):
     """
     input: xyz: (n, 3), new_xyz: (m, 3), feat: (n, c), idx: (m, nsample), offset: (b), new_offset: (b)
@@ -675,15 +889,30 @@ def queryandgroup(nsample, xyz, new_xyz, feat, idx, offset, new_offset, use_xyz=
             return grouped_feat
 
 
+def downsample_offset(offset, ratio=None, scale=None):
+    """ Offsets of a batch downsampled sample by sample, computed on the device of offset (no host sync).
+
+    Args:
+        offset: int tensor [B], end of every sample.
+        ratio: sample sizes floor(n_i * ratio) + 1, as TransitionDown. Like its former loop, only the
+            first size is floored before the sum, the offsets are floor(sum_j<=i (n_j * ratio + 1)).
+        scale: sample sizes n_i // scale, as Divide2Patch.
+    Returns:
+        int tensor [B], offsets of the downsampled batch.
+    """
+    assert (ratio is None) != (scale is None)
+    count = torch.diff(offset.long(), prepend=offset.new_zeros(1, dtype=torch.long))
+    if scale is not None:
+        return torch.cumsum(count // scale, dim=0).int()
+    size = count.double() * ratio + 1
+    size[0] = torch.floor(size[0])
+    return torch.floor(torch.cumsum(size, dim=0)).int()
+
+
 def Divide2Patch(nsample, xyz, offset, return_offset=False, anchor_scale=None):
     # nsample: 16  xyz: (n, 3)  offset: (b)
     downsample_scale = anchor_scale or nsample
-    new_offset, count = [offset[0].item() // downsample_scale], offset[0].item() // downsample_scale
-    for i in range(1, offset.shape[0]):
-        count += (offset[i].item() - offset[i-1].item()) // downsample_scale
-        new_offset.append(count)
-    # print("donw sample scale:", downsample_scale,"offset:", offset, "newoffset:", new_offset)
-    new_offset = torch.cuda.IntTensor(new_offset)
+    new_offset = downsample_offset(offset, scale=downsample_scale)
     idx = furthestsampling(xyz, offset, new_offset) # (m)
     new_xyz = xyz[idx.long()]
     p_idx, _ = knnquery(nsample, xyz, new_xyz, offset, new_offset) # (m, nsample)
@@ -701,8 +930,11 @@ class Subtraction(Function):
         """
         assert input1.is_contiguous() and input2.is_contiguous()
         n, c = input1.shape; nsample = idx.shape[-1]
-        output = torch.cuda.FloatTensor(n, nsample, c).zero_()
-        pointops_cuda.subtraction_forward_cuda(n, nsample, c, input1, input2, idx, output)
+        if input1.is_cuda:
+            output = torch.cuda.FloatTensor(n, nsample, c).zero_()
+            pointops_cuda.subtraction_forward_cuda(n, nsample, c, input1, input2, idx, output)
+        else:
+            output = pointops_cpu.subtraction_forward(input1, input2, idx)
         ctx.save_for_backward(idx)
         return output
 
@@ -714,9 +946,12 @@ class Subtraction(Function):
         """
         idx, = ctx.saved_tensors
         n, nsample, c = grad_output.shape
-        grad_input1 = torch.cuda.FloatTensor(n, c).zero_()
-        grad_input2 = torch.cuda.FloatTensor(n, c).zero_()
-        pointops_cuda.subtraction_backward_cuda(n, nsample, c, idx, grad_output, grad_input1, grad_input2)
+        if grad_output.is_cuda:
+            grad_input1 = torch.cuda.FloatTensor(n, c).zero_()
+            grad_input2 = torch.cuda.FloatTensor(n, c).zero_()
+            pointops_cuda.subtraction_backward_cuda(n, nsample, c, idx, grad_output, grad_input1, grad_input2)
+        else:
+            grad_input1, grad_input2 = pointops_cpu.subtraction_backward(grad_output, idx)
         return grad_input1, grad_input2, None
 
 subtraction = Subtraction.apply
@@ -731,8 +966,11 @@ class Aggregation(Function):
         """
         assert input.is_contiguous() and position.is_contiguous() and weight.is_contiguous()
         n, nsample, c = position.shape; w_c = weight.shape[-1]
-        output = torch.cuda.FloatTensor(n, c).zero_()
-        pointops_cuda.aggregation_forward_cuda(n, nsample, c, w_c, input, position, weight, idx, output)
+        if input.is_cuda:
+            output = torch.cuda.FloatTensor(n, c).zero_()
+            pointops_cuda.aggregation_forward_cuda(n, nsample, c, w_c, input, position, weight, idx, output)
+        else:
+            output = pointops_cpu.aggregation_forward(input, position, weight, idx)
         ctx.save_for_backward(input, position, weight, idx)
         return output
 
@@ -744,6 +982,9 @@ class Aggregation(Function):
         """
         input, position, weight, idx = ctx.saved_tensors
         n, nsample, c = position.shape; w_c = weight.shape[-1]
+        if not grad_output.is_cuda:
+            grad_input, grad_position, grad_weight = pointops_cpu.aggregation_backward(grad_output, input, position, weight, idx)
+            return grad_input, grad_position, grad_weight, None
         grad_input = torch.cuda.FloatTensor(n, c).zero_()
         grad_position = torch.cuda.FloatTensor(n, nsample, c).zero_()
         grad_weight = torch.cuda.FloatTensor(n, nsample, w_c).zero_()
@@ -764,10 +1005,10 @@ def interpolation(xyz, new_xyz, feat, offset, new_offset, k=3):
     norm = torch.sum(dist_recip, dim=1, keepdim=True)
     weight = dist_recip / norm # (n, 3)
 
-    new_feat = torch.cuda.FloatTensor(new_xyz.shape[0], feat.shape[1]).zero_()
+    new_feat = feat.new_zeros(new_xyz.shape[0], feat.shape[1], dtype=torch.promote_types(feat.dtype, torch.float)) # fp32 accumulation for half inputs
     for i in range(k):
         new_feat += feat[idx[:, i].long(), :] * weight[:, i].unsqueeze(-1)
-    return new_feat
+    return new_feat.to(feat.dtype)
 
 
 def interpolation_v2(xyz, new_xyz, feat, offset, new_offset, k=3):
@@ -791,14 +1032,15 @@ def interpolation_v2(xyz, new_xyz, feat, offset, new_offset, k=3):
     norm = torch.sum(dist_recip, dim=1, keepdim=True)
     weight = dist_recip / norm # (n, 3)
 
-    new_feat = torch.cuda.FloatTensor(new_xyz.shape[0], feat.shape[1]).zero_()
+    new_feat = feat.new_zeros(new_xyz.shape[0], feat.shape[1], dtype=torch.promote_types(feat.dtype, torch.float)) # fp32 accumulation for half inputs
     for i in range(k):
         new_feat += feat[idx[:, i].long(), :] * weight[:, i].unsqueeze(-1)
-    return new_feat
+    return new_feat.to(feat.dtype)
 
 
 class Interpolation(Function):
     @staticmethod
+    @custom_fwd
     def forward(ctx, xyz, new_xyz, input, offset, new_offset, k=3):
         """
         input: xyz: (m, 3), new_xyz: (n, 3), input: (m, c), offset: (b), new_offset: (b)
@@ -811,13 +1053,19 @@ class Interpolation(Function):
         weight = dist_recip / norm # (n, k)
 
         n, c, m = new_xyz.shape[0], input.shape[1], input.shape[0]
-        output = torch.cuda.FloatTensor(n, c).zero_()
-        pointops_cuda.interpolation_forward_cuda(n, c, k, input, idx, weight, output)
-        ctx.m, ctx.k = m, k
+        dtype = input.dtype
+        input, weight = _fp32(input, weight)
+        if input.is_cuda:
+            output = torch.cuda.FloatTensor(n, c).zero_()
+            pointops_cuda.interpolation_forward_cuda(n, c, k, input, idx, weight, output)
+        else:
+            output = pointops_cpu.interpolation_forward(input, idx, weight)
+        ctx.m, ctx.k, ctx.dtype = m, k, dtype
         ctx.save_for_backward(idx, weight)
-        return output
+        return output.to(dtype)
 
     @staticmethod
+    @custom_bwd
     def backward(ctx, grad_output):
         """
         input: xyz: (m, 3), new_xyz: (n, 3), input: (m, c), offset: (b), new_offset: (b)
@@ -826,8 +1074,12 @@ class Interpolation(Function):
         m, k = ctx.m, ctx.k
         idx, weight = ctx.saved_tensors
         n, c = grad_output.shape
-        grad_input = torch.cuda.FloatTensor(m, c).zero_()
-        pointops_cuda.interpolation_backward_cuda(n, c, k, grad_output, idx, weight, grad_input)
-        return None, None, grad_input, None, None, None
+        grad_output = grad_output.float().contiguous()
+        if grad_output.is_cuda:
+            grad_input = torch.cuda.FloatTensor(m, c).zero_()
+            pointops_cuda.interpolation_backward_cuda(n, c, k, grad_output, idx, weight, grad_input)
+        else:
+            grad_input = pointops_cpu.interpolation_backward(grad_output, idx, weight, m)
+        return None, None, grad_input.to(ctx.dtype), None, None, None
 
 interpolation2 = Interpolation.apply
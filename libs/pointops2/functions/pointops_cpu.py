@@ -0,0 +1,585 @@
+'''
+CPU implementations of the pointops2 kernels, in plain PyTorch.
+
+Every function mirrors one pointops2_cuda kernel (same arguments, same output layout) and is
+called by the autograd Functions of pointops.py when the inputs are not on a GPU. The pair
+operations gather rows for CHUNK_SIZE pairs at a time and accumulate with index_add_, so the
+memory stays bounded by the chunk instead of [M, h, hdim].
+'''
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import torch
+
+
+CHUNK_SIZE = 1 << 16
+# fixed cost of one padded FPS iteration in distance updates: ~35us of op launches against ~6ns a point on one core
+FPS_ITER_POINTS = 4096
+
+
+def _chunks(m):
+    for s in range(0, m, CHUNK_SIZE):
+        yield s, min(s + CHUNK_SIZE, m)
+
+
+def offsets2index(index0_offsets):
+    """ index0 [M] from the query offsets [N+1] of the *_v2 kernels """
+    counts = torch.diff(index0_offsets.long())
+    return torch.repeat_interleave(torch.arange(counts.shape[0], device=index0_offsets.device), counts)
+
+
+def _table_sum(table, rel_idx):
+    # table: (L, h, hdim, 3), rel_idx: (m, 3) -> (m, h, hdim), sum_d table[rel_idx[:, d], :, :, d]
+    return table[rel_idx[:, 0], :, :, 0] + table[rel_idx[:, 1], :, :, 1] + table[rel_idx[:, 2], :, :, 2]
+
+
+def _table_add(grad_table, rel_idx, grad):
+    # adjoint of _table_sum, grad_table: (3, L, h, hdim)
+    for d in range(3):
+        grad_table[d].index_add_(0, rel_idx[:, d], grad)
+
+
+def _table_grad(table):
+    return table.new_zeros((3,) + table.shape[:3])
+
+
+def _table_layout(grad_table):
+    return grad_table.permute(1, 2, 3, 0).contiguous()
+
+
+# ---------------------------------------------------------------- sampling / knn / grouping
+
+def _fps_batch(points, num_samples, start=None):
+    """ Furthest point sampling of several clouds at once, padded to the largest one.
+
+        points: list of (n_i, 3), num_samples: list of m_i <= n_i, start: list of first local picks
+        (default 0) -> list of (m_i) local indices.
+        Every iteration updates the distances of all the clouds with a few [B, n_max] ops,
+        the padding has distance -1 and is never picked.
+    """
+    B, n_max, m_max = len(points), max(p.shape[0] for p in points), max(num_samples)
+    planes = points[0].new_zeros(B, 3, n_max)
+    dist = points[0].new_full((B, n_max), -1.0)
+    for b, p in enumerate(points):
+        planes[b, :, :p.shape[0]] = p.t()
+        dist[b, :p.shape[0]] = 1e10
+    if start is not None:
+        old = torch.tensor(start, dtype=torch.long, device=planes.device)
+    else:
+        old = torch.zeros(B, dtype=torch.long, device=planes.device)
+    batch = torch.arange(B, device=planes.device)
+    idx = torch.empty(B, m_max, dtype=torch.long, device=planes.device)
+    d, tmp = torch.empty_like(dist), torch.empty_like(dist)
+    for j in range(m_max):
+        idx[:, j] = old
+        if j + 1 == m_max:
+            break
+        # squared distance to the last pick, in place on preallocated buffers; dx * dx + dy * dy + dz * dz
+        # rounded step by step like the CUDA kernel (a fused multiply-add can flip near ties of the argmax)
+        center = planes[batch, :, old].unsqueeze(-1)
+        torch.sub(planes[:, 0], center[:, 0], out=d).mul_(d)
+        for axis in (1, 2):
+            torch.sub(planes[:, axis], center[:, axis], out=tmp).mul_(tmp)
+            d.add_(tmp)
+        torch.minimum(dist, d, out=dist)
+        old = dist.argmax(1)
+    return [idx[b, :m] for b, m in enumerate(num_samples)]
+
+
+def _voxel_representatives(points, voxel_size):
+    """ First point (lowest index) of every occupied voxel, sorted """
+    key = torch.floor((points - points.min(0)[0]) / voxel_size).long()
+    _, inverse = torch.unique(key, dim=0, return_inverse=True)
+    first = torch.full((int(inverse.max()) + 1,), points.shape[0], dtype=torch.long, device=points.device)
+    first.scatter_reduce_(0, inverse, torch.arange(points.shape[0], device=points.device), reduce='amin')
+    return first.sort()[0]
+
+
+def _fps_groups(sizes, num_samples, num_threads):
+    """ Split segments sorted by size into contiguous groups minimizing the padded FPS cost,
+        sum over groups of max(m) * (FPS_ITER_POINTS + len(group) * max(n)), then split the
+        largest groups until every thread has one. Returns (start, end) ranges, largest first.
+    """
+    best, cut = [0], [0]
+    for j in range(1, len(sizes) + 1):
+        m_max, cost = 0, None
+        for i in range(j - 1, -1, -1):
+            m_max = max(m_max, num_samples[i])
+            c = best[i] + m_max * (FPS_ITER_POINTS + (j - i) * sizes[j - 1])
+            if cost is None or c < cost:
+                cost, arg = c, i
+        best.append(cost), cut.append(arg)
+    groups, j = [], len(sizes)
+    while j:
+        groups.append((cut[j], j))
+        j = cut[j]
+    while len(groups) < num_threads:
+        s, e = max(groups, key=lambda g: g[1] - g[0])
+        if e - s < 2:
+            break
+        groups.remove((s, e))
+        groups += [(s, (s + e) // 2), ((s + e) // 2, e)]
+    return sorted(groups, key=lambda g: -g[1])
+
+
+def furthestsampling(xyz, offset, new_offset, num_threads=None, voxel_size=None, random_start=False):
+    """ Same layout as furthestsampling_cuda: the picks of sample i are new_offset[i-1]:new_offset[i],
+        global indices, starting at the first point of the sample and then always the point farthest
+        from the picked set (first index on ties).
+
+        The samples are sorted by size and split into groups of similar sizes (_fps_groups), each
+        group runs the padded batch FPS above, on a pool of num_threads threads (torch releases the
+        GIL in the kernels), torch.get_num_threads() by default.
+        voxel_size: approximate mode for very large samples, the FPS only runs on the first point of
+        every occupied voxel (samples with fewer voxels than picks stay exact).
+        random_start: start at a random point instead (ModelNet preprocessing), drawn with
+        np.random.randint(0, n) sample by sample like the original farthest_point_sample, so the
+        picks follow np.random.seed.
+    """
+    offset, new_offset = offset.tolist(), new_offset.tolist()
+    starts_n, starts_m = [0] + offset[:-1], [0] + new_offset[:-1]
+    idx = torch.zeros(new_offset[-1] if new_offset else 0, dtype=torch.int32, device=xyz.device)
+    segments = [b for b in range(len(offset)) if new_offset[b] > starts_m[b]]
+    if not segments:
+        return idx
+
+    # drawn in sample order, before the samples are regrouped by size
+    start = {b: np.random.randint(0, offset[b] - starts_n[b]) if random_start else 0 for b in segments}
+
+    def run(group):
+        points, candidates, num_samples, firsts = [], [], [], []
+        for b in group:
+            p, m, first = xyz[starts_n[b]:offset[b]], new_offset[b] - starts_m[b], start[b]
+            candidate = None
+            if voxel_size is not None:
+                candidate = _voxel_representatives(p, voxel_size)
+                if candidate.shape[0] < m:
+                    candidate = None
+                else:
+                    if random_start:
+                        # the start point is a candidate too (point 0 always is, as the first of its voxel)
+                        candidate = torch.unique(torch.cat([candidate, candidate.new_tensor([first])]))
+                        first = int(torch.searchsorted(candidate, first))
+                    p = p[candidate]
+            points.append(p), candidates.append(candidate), num_samples.append(m), firsts.append(first)
+        for b, candidate, local in zip(group, candidates, _fps_batch(points, num_samples, firsts)):
+            if candidate is not None:
+                local = candidate[local]
+            idx[starts_m[b]:new_offset[b]] = (local + starts_n[b]).int()
+
+    segments.sort(key=lambda b: offset[b] - starts_n[b])
+    num_threads = torch.get_num_threads() if num_threads is None else num_threads
+    sizes = [offset[b] - starts_n[b] for b in segments]
+    groups = [segments[s:e] for s, e in _fps_groups(sizes, [new_offset[b] - starts_m[b] for b in segments], num_threads)]
+    if len(groups) > 1 and num_threads > 1:
+        with ThreadPool(min(num_threads, len(groups))) as pool:
+            pool.map(run, groups, chunksize=1)
+    else:
+        for group in groups:
+            run(group)
+    return idx
+
+
+def knnquery(nsample, xyz, new_xyz, offset, new_offset):
+    """ (idx, dist2) like knnquery_cuda: nearest first, missing neighbors are the first point of the
+        sample with dist2 1e10 """
+    m = new_xyz.shape[0]
+    idx = torch.zeros(m, nsample, dtype=torch.int32, device=xyz.device)
+    dist2 = new_xyz.new_full((m, nsample), 1e10)
+    start_n, start_m = 0, 0
+    for end_n, end_m in zip(offset.tolist(), new_offset.tolist()):
+        k = min(nsample, end_n - start_n)
+        idx[start_m:end_m] = start_n
+        for s in range(start_m, end_m, 4096):
+            e = min(s + 4096, end_m)
+            d2 = torch.cdist(new_xyz[s:e], xyz[start_n:end_n]) ** 2
+            d2, i = torch.topk(d2, k, dim=1, largest=False, sorted=True)
+            dist2[s:e, :k], idx[s:e, :k] = d2, i.int() + start_n
+        start_n, start_m = end_n, end_m
+    return idx, dist2
+
+
+def grouping_forward(input, idx):
+    return input[idx.long()]
+
+
+def grouping_backward(grad_output, idx, n):
+    m, nsample, c = grad_output.shape
+    grad_input = grad_output.new_zeros(n, c)
+    grad_input.index_add_(0, idx.long().view(-1), grad_output.reshape(-1, c))
+    return grad_input
+
+
+# ---------------------------------------------------------------- attention
+
+def attention_step1_forward(q, k, index0, index1):
+    """ attn[m, h] = <q[index0[m], h], k[index1[m], h]> """
+    M, h = index0.shape[0], q.shape[1]
+    output = q.new_zeros(M, h)
+    for s, e in _chunks(M):
+        output[s:e] = (q[index0[s:e].long()] * k[index1[s:e].long()]).sum(-1)
+    return output
+
+
+def attention_step1_backward(grad_output, index0, index1, q, k):
+    grad_q, grad_k = torch.zeros_like(q), torch.zeros_like(k)
+    for s, e in _chunks(index0.shape[0]):
+        i0, i1, g = index0[s:e].long(), index1[s:e].long(), grad_output[s:e].unsqueeze(-1)
+        grad_q.index_add_(0, i0, g * k[i1])
+        grad_k.index_add_(0, i1, g * q[i0])
+    return grad_q, grad_k
+
+
+def attention_step1_forward_v2(q, k, index1, index0_offsets):
+    return attention_step1_forward(q, k, offsets2index(index0_offsets), index1)
+
+
+def attention_step1_backward_v2(grad_output, index0_offsets, index1, q, k):
+    return attention_step1_backward(grad_output, offsets2index(index0_offsets), index1, q, k)
+
+
+def attention_step2_forward(attn, v, index0, index1, n):
+    """ output[index0[m], h] += attn[m, h] * v[index1[m], h] """
+    output = v.new_zeros(n, v.shape[1], v.shape[2])
+    for s, e in _chunks(index0.shape[0]):
+        output.index_add_(0, index0[s:e].long(), attn[s:e].unsqueeze(-1) * v[index1[s:e].long()])
+    return output
+
+
+def attention_step2_backward(grad_output, index0, index1, attn, v):
+    grad_attn, grad_v = torch.zeros_like(attn), torch.zeros_like(v)
+    for s, e in _chunks(index0.shape[0]):
+        i0, i1 = index0[s:e].long(), index1[s:e].long()
+        g = grad_output[i0]
+        grad_attn[s:e] = (g * v[i1]).sum(-1)
+        grad_v.index_add_(0, i1, attn[s:e].unsqueeze(-1) * g)
+    return grad_attn, grad_v
+
+
+# ---------------------------------------------------------------- relative position encoding
+
+def _gather_rel_idx(rel_idx):
+    # rel_idx of the pairs s:e, from the [M, 3] tensor
+    return lambda s, e: rel_idx[s:e].long()
+
+
+def _quant_rel_idx(xyz_quant, index0, index1, table):
+    # rel_idx of the pairs s:e, computed from the quantized coordinates [N, 3] of their points;
+    # the table has 2 * quant_grid_length - 1 rows, relative position 0 is row quant_grid_length - 1
+    shift = table.shape[0] // 2
+    def rel_idx(s, e):
+        return (xyz_quant[index0[s:e].long()] - xyz_quant[index1[s:e].long()]).long() + shift
+    return rel_idx
+
+
+def _dot_prod_forward(q, index, table, rel):
+    M, h = index.shape[0], q.shape[1]
+    output = q.new_zeros(M, h)
+    for s, e in _chunks(M):
+        output[s:e] = (q[index[s:e].long()] * _table_sum(table, rel(s, e))).sum(-1)
+    return output
+
+
+def _dot_prod_backward(grad_output, q, index, table, rel):
+    grad_q, grad_table = torch.zeros_like(q), _table_grad(table)
+    for s, e in _chunks(index.shape[0]):
+        i, r, g = index[s:e].long(), rel(s, e), grad_output[s:e].unsqueeze(-1)
+        grad_q.index_add_(0, i, g * _table_sum(table, r))
+        _table_add(grad_table, r, g * q[i])
+    return grad_q, _table_layout(grad_table)
+
+
+def _dot_prod_forward_v3(q, index_q, k, index_k, table_q, table_k, rel):
+    M, h = index_k.shape[0], q.shape[1]
+    output = q.new_zeros(M, h)
+    for s, e in _chunks(M):
+        r = rel(s, e)
+        output[s:e] = (q[index_q[s:e].long()] * _table_sum(table_q, r) + k[index_k[s:e].long()] * _table_sum(table_k, r)).sum(-1)
+    return output
+
+
+def _dot_prod_backward_v3(grad_output, q, index_q, k, index_k, table_q, table_k, rel):
+    grad_q, grad_k = torch.zeros_like(q), torch.zeros_like(k)
+    grad_table_q, grad_table_k = _table_grad(table_q), _table_grad(table_k)
+    for s, e in _chunks(index_k.shape[0]):
+        iq, ik, r, g = index_q[s:e].long(), index_k[s:e].long(), rel(s, e), grad_output[s:e].unsqueeze(-1)
+        grad_q.index_add_(0, iq, g * _table_sum(table_q, r))
+        grad_k.index_add_(0, ik, g * _table_sum(table_k, r))
+        _table_add(grad_table_q, r, g * q[iq])
+        _table_add(grad_table_k, r, g * k[ik])
+    return grad_q, grad_k, _table_layout(grad_table_q), _table_layout(grad_table_k)
+
+
+def _step2_rel_value_forward(attn, v, index0, index1, table, rel, n):
+    output = v.new_zeros(n, v.shape[1], v.shape[2])
+    for s, e in _chunks(index0.shape[0]):
+        value = v[index1[s:e].long()] + _table_sum(table, rel(s, e))
+        output.index_add_(0, index0[s:e].long(), attn[s:e].unsqueeze(-1) * value)
+    return output
+
+
+def _step2_rel_value_backward(grad_output, index0, index1, attn, v, table, rel):
+    grad_attn, grad_v, grad_table = torch.zeros_like(attn), torch.zeros_like(v), _table_grad(table)
+    for s, e in _chunks(index0.shape[0]):
+        i0, i1, r = index0[s:e].long(), index1[s:e].long(), rel(s, e)
+        g = grad_output[i0]
+        grad_attn[s:e] = (g * (v[i1] + _table_sum(table, r))).sum(-1)
+        g = attn[s:e].unsqueeze(-1) * g
+        grad_v.index_add_(0, i1, g)
+        _table_add(grad_table, r, g)
+    return grad_attn, grad_v, _table_layout(grad_table)
+
+
+def dot_prod_with_idx_forward(q, index, table, rel_idx):
+    """ output[m, h] = <q[index[m], h], sum_d table[rel_idx[m, d], h, :, d]> """
+    return _dot_prod_forward(q, index, table, _gather_rel_idx(rel_idx))
+
+
+def dot_prod_with_idx_backward(grad_output, q, index, table, rel_idx):
+    return _dot_prod_backward(grad_output, q, index, table, _gather_rel_idx(rel_idx))
+
+
+def dot_prod_with_idx_forward_v3(q, index_q_offsets, k, index_k, table_q, table_k, rel_idx):
+    """ output[m, h] = <q[index_q[m], h], table_q term> + <k[index_k[m], h], table_k term> """
+    return _dot_prod_forward_v3(q, offsets2index(index_q_offsets), k, index_k, table_q, table_k, _gather_rel_idx(rel_idx))
+
+
+def dot_prod_with_idx_backward_v3(grad_output, q, index_q_offsets, k, index_k, table_q, table_k, rel_idx):
+    return _dot_prod_backward_v3(grad_output, q, offsets2index(index_q_offsets), k, index_k, table_q, table_k, _gather_rel_idx(rel_idx))
+
+
+def attention_step2_with_rel_pos_value_forward(attn, v, index0, index1, table, rel_idx, n):
+    """ output[index0[m], h] += attn[m, h] * (v[index1[m], h] + sum_d table[rel_idx[m, d], h, :, d]) """
+    return _step2_rel_value_forward(attn, v, index0, index1, table, _gather_rel_idx(rel_idx), n)
+
+
+def attention_step2_with_rel_pos_value_backward(grad_output, index0, index1, attn, v, table, rel_idx):
+    return _step2_rel_value_backward(grad_output, index0, index1, attn, v, table, _gather_rel_idx(rel_idx))
+
+
+def attention_step2_with_rel_pos_value_forward_v2(attn, v, index0_offsets, index1, table, rel_idx):
+    return attention_step2_with_rel_pos_value_forward(attn, v, offsets2index(index0_offsets), index1, table, rel_idx, v.shape[0])
+
+
+def attention_step2_with_rel_pos_value_backward_v2(grad_output, index0_offsets, index1, attn, v, table, rel_idx):
+    return attention_step2_with_rel_pos_value_backward(grad_output, offsets2index(index0_offsets), index1, attn, v, table, rel_idx)
+
+
+# ---------------------------------------------------------------- relative position encoding from quantized coordinates
+# Same as above, with rel_idx[m] = xyz_quant[index0[m]] - xyz_quant[index1[m]] + L // 2 computed per chunk
+# from the quantized coordinates of the points (int [N, 3]) instead of read from an [M, 3] tensor.
+# There is no pointops2_cuda kernel for them, pointops.py runs these on CUDA tensors as well.
+
+def dot_prod_with_quant_forward(q, index, index0, index1, table, xyz_quant):
+    """ output[m, h] = <q[index[m], h], sum_d table[rel_idx[m, d], h, :, d]> """
+    return _dot_prod_forward(q, index, table, _quant_rel_idx(xyz_quant, index0, index1, table))
+
+
+def dot_prod_with_quant_backward(grad_output, q, index, index0, index1, table, xyz_quant):
+    return _dot_prod_backward(grad_output, q, index, table, _quant_rel_idx(xyz_quant, index0, index1, table))
+
+
+def dot_prod_with_quant_forward_v3(q, index0, k, index1, table_q, table_k, xyz_quant):
+    return _dot_prod_forward_v3(q, index0, k, index1, table_q, table_k, _quant_rel_idx(xyz_quant, index0, index1, table_q))
+
+
+def dot_prod_with_quant_backward_v3(grad_output, q, index0, k, index1, table_q, table_k, xyz_quant):
+    return _dot_prod_backward_v3(grad_output, q, index0, k, index1, table_q, table_k, _quant_rel_idx(xyz_quant, index0, index1, table_q))
+
+
+def attention_step2_with_rel_pos_value_quant_forward(attn, v, index0, index1, table, xyz_quant):
+    return _step2_rel_value_forward(attn, v, index0, index1, table, _quant_rel_idx(xyz_quant, index0, index1, table), v.shape[0])
+
+
+def attention_step2_with_rel_pos_value_quant_backward(grad_output, index0, index1, attn, v, table, xyz_quant):
+    return _step2_rel_value_backward(grad_output, index0, index1, attn, v, table, _quant_rel_idx(xyz_quant, index0, index1, table))
+
+
+# ---------------------------------------------------------------- point transformer ops
+
+def subtraction_forward(input1, input2, idx):
+    return input1.unsqueeze(1) - input2[idx.long()]
+
+
+def subtraction_backward(grad_output, idx):
+    n, nsample, c = grad_output.shape
+    grad_input2 = grad_output.new_zeros(n, c)
+    grad_input2.index_add_(0, idx.long().view(-1), -grad_output.reshape(-1, c))
+    return grad_output.sum(1), grad_input2
+
+
+def aggregation_forward(input, position, weight, idx):
+    """ output[n, c] = sum_i (input[idx[n, i], c] + position[n, i, c]) * weight[n, i, c % w_c] """
+    n, nsample, c = position.shape
+    w_c = weight.shape[-1]
+    value = (input[idx.long()] + position).view(n, nsample, c // w_c, w_c)
+    return (value * weight.unsqueeze(2)).sum(1).view(n, c)
+
+
+def aggregation_backward(grad_output, input, position, weight, idx):
+    n, nsample, c = position.shape
+    w_c = weight.shape[-1]
+    g = grad_output.view(n, 1, c // w_c, w_c)
+    grad_position = (g * weight.unsqueeze(2)).view(n, nsample, c)
+    grad_input = torch.zeros_like(input)
+    grad_input.index_add_(0, idx.long().view(-1), grad_position.view(-1, c))
+    value = (input[idx.long()] + position).view(n, nsample, c // w_c, w_c)
+    grad_weight = (g * value).sum(2)
+    return grad_input, grad_position, grad_weight
+
+
+def interpolation_forward(input, idx, weight):
+    return (input[idx.long()] * weight.unsqueeze(-1)).sum(1)
+
+
+def interpolation_backward(grad_output, idx, weight, m):
+    grad_input = grad_output.new_zeros(m, grad_output.shape[1])
+    grad_input.index_add_(0, idx.long().view(-1), (grad_output.unsqueeze(1) * weight.unsqueeze(-1)).view(-1, grad_output.shape[1]))
+    return grad_input
+
+
+if __name__ == '__main__':
+    # gradcheck of the autograd Functions of pointops.py on CPU (double, small inputs)
+    import pointops
+    from torch.autograd import gradcheck
+
+    torch.manual_seed(0)
+    N, h, hdim, L, K = 12, 2, 4, 5, 3
+    # pairs of query / key points grouped by query, as built by the window attention
+    counts = torch.randint(1, 5, (N,))
+    index0 = torch.repeat_interleave(torch.arange(N), counts)
+    M = index0.shape[0]
+    index1 = torch.randint(0, N, (M,)).int()
+    index0_offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)]).int()
+    n_max = int(counts.max())
+    index0 = index0.int()
+    rel_idx = torch.randint(0, L, (M, 3)).int()
+
+    def rand(*shape):
+        return torch.randn(*shape, dtype=torch.float64, requires_grad=True)
+
+    q, k, v, attn = rand(N, h, hdim), rand(N, h, hdim), rand(N, h, hdim), rand(M, h)
+    table, table_k = rand(L, h, hdim, 3), rand(L, h, hdim, 3)
+
+    checks = {
+        'attention_step1': (pointops.attention_step1, (q, k, index0, index1)),
+        'attention_step1_v2': (pointops.attention_step1_v2, (q, k, index1, index0_offsets, n_max)),
+        'attention_step2': (pointops.attention_step2, (attn, v, index0, index1)),
+        'dot_prod_with_idx': (pointops.dot_prod_with_idx, (q, index0, table, rel_idx)),
+        'dot_prod_with_idx_v3': (pointops.dot_prod_with_idx_v3, (q, index0_offsets, n_max, k, index1, table, table_k, rel_idx)),
+        'attention_step2_with_rel_pos_value': (pointops.attention_step2_with_rel_pos_value, (attn, v, index0, index1, table, rel_idx)),
+        'attention_step2_with_rel_pos_value_v2': (pointops.attention_step2_with_rel_pos_value_v2, (attn, v, index0_offsets, n_max, index1, table, rel_idx)),
+    }
+    # the fused relative position ops, from quantized coordinates in [0, quant_grid_length)
+    xyz_quant = torch.randint(0, L // 2 + 1, (N, 3)).int()
+    quant_idx = xyz_quant[index0.long()] - xyz_quant[index1.long()] + L // 2
+    checks['dot_prod_with_quant'] = (pointops.dot_prod_with_quant, (k, index1, index0, index1, table, xyz_quant))
+    checks['dot_prod_with_quant_v3'] = (pointops.dot_prod_with_quant_v3, (q, index0, k, index1, table, table_k, xyz_quant))
+    checks['attention_step2_with_rel_pos_value_quant'] = (pointops.attention_step2_with_rel_pos_value_quant, (attn, v, index0, index1, table, xyz_quant))
+    idx = torch.randint(0, N, (N, K)).int()
+    feat, position, weight = rand(N, hdim), rand(N, K, hdim), rand(N, K, 2)
+    checks['grouping'] = (pointops.grouping, (feat, idx))
+    checks['subtraction'] = (pointops.subtraction, (feat, rand(N, hdim), idx))
+    checks['aggregation'] = (pointops.aggregation, (feat, position, weight, idx))
+    for name, (fn, inputs) in checks.items():
+        assert gradcheck(fn, inputs, eps=1e-6, atol=1e-4), name
+        print('gradcheck {}: ok'.format(name))
+
+    # forward against a dense reference
+    dense = (q[index0.long()] * k[index1.long()]).sum(-1)
+    assert torch.allclose(pointops.attention_step1_v2(q, k, index1, index0_offsets, n_max), dense)
+    value = v[index1.long()] + sum(table[rel_idx[:, d].long(), :, :, d] for d in range(3))
+    dense = torch.zeros(N, h, hdim, dtype=torch.float64).index_add(0, index0.long(), attn.unsqueeze(-1) * value)
+    assert torch.allclose(pointops.attention_step2_with_rel_pos_value_v2(attn, v, index0_offsets, n_max, index1, table, rel_idx), dense)
+
+    # the fused ops against the [M, 3] rel_idx ops
+    assert torch.allclose(pointops.dot_prod_with_quant(k, index1, index0, index1, table, xyz_quant), pointops.dot_prod_with_idx(k, index1, table, quant_idx))
+    assert torch.allclose(pointops.dot_prod_with_quant_v3(q, index0, k, index1, table, table_k, xyz_quant), pointops.dot_prod_with_idx_v3(q, index0_offsets, n_max, k, index1, table, table_k, quant_idx))
+    assert torch.allclose(pointops.attention_step2_with_rel_pos_value_quant(attn, v, index0, index1, table, xyz_quant), pointops.attention_step2_with_rel_pos_value_v2(attn, v, index0_offsets, n_max, index1, table, quant_idx))
+
+    # mixed precision: half / bfloat16 activations (the tables stay fp32 parameters, as under autocast)
+    # against fp32, outputs and gradients in the dtype of their input
+    for dtype, tol in [(torch.float16, 2e-3), (torch.bfloat16, 2e-2)]:
+        for name in ['attention_step1_v2', 'attention_step2', 'dot_prod_with_idx', 'dot_prod_with_idx_v3', 'attention_step2_with_rel_pos_value_v2',
+                     'dot_prod_with_quant', 'dot_prod_with_quant_v3', 'attention_step2_with_rel_pos_value_quant']:
+            fn, inputs = checks[name]
+            low = [x.detach().to(dtype if x.dim() < 4 else torch.float).requires_grad_() if torch.is_tensor(x) and x.is_floating_point() else x for x in inputs]
+            ref = [x.detach().to(y.dtype).float().requires_grad_() if torch.is_tensor(x) and x.is_floating_point() else x for x, y in zip(inputs, low)]
+            out_low, out_ref = fn(*low), fn(*ref)
+            grad = torch.randn_like(out_ref)
+            out_low.backward(grad.to(dtype))
+            out_ref.backward(grad)
+            assert out_low.dtype == dtype, name
+            assert (out_low.float() - out_ref).abs().max() <= tol * out_ref.abs().max(), name
+            for x, y in zip(low, ref):
+                if torch.is_tensor(x) and x.requires_grad:
+                    assert x.grad.dtype == x.dtype and (x.grad.float() - y.grad).abs().max() <= tol * y.grad.abs().max(), name
+        print('mixed precision {}: ok'.format(dtype))
+
+    # sampling, knn and interpolation against brute force, two samples in the batch
+    xyz = torch.rand(200, 3)
+    offset, new_offset = torch.IntTensor([120, 200]), torch.IntTensor([30, 50])
+    fps_idx = pointops.furthestsampling(xyz, offset, new_offset)
+    assert fps_idx[0] == 0 and fps_idx[30] == 120 and (fps_idx[:30] < 120).all() and (fps_idx[30:] >= 120).all()
+    assert fps_idx.unique().shape[0] == 50
+    new_xyz = xyz[fps_idx.long()]
+    knn_idx, dist = pointops.knnquery(8, xyz, new_xyz, offset, new_offset)
+    ref = torch.cdist(new_xyz[:30], xyz[:120]).topk(8, largest=False)
+    assert (knn_idx[:30] == ref.indices).all() and torch.allclose(dist[:30], ref.values, atol=1e-5)
+    knn_idx, dist = pointops.knnquery(100, xyz, new_xyz, offset, new_offset)
+    assert (knn_idx[30:, 80:] == 120).all() and (dist[30:, 80:] > 1e4).all()
+    feat = torch.randn(50, 6, dtype=torch.float64, requires_grad=True)
+    assert gradcheck(lambda f: pointops.interpolation2(new_xyz, xyz, f, new_offset, offset), (feat,), eps=1e-6, atol=1e-4)
+    assert torch.allclose(pointops.interpolation2(new_xyz, xyz, feat.float(), new_offset, offset), pointops.interpolation(new_xyz, xyz, feat.float(), new_offset, offset), atol=1e-5)
+    for dtype in (torch.float16, torch.bfloat16):
+        ref = pointops.interpolation(new_xyz, xyz, feat.float(), new_offset, offset)
+        for fn in (pointops.interpolation, pointops.interpolation2):
+            out = fn(new_xyz, xyz, feat.detach().to(dtype), new_offset, offset)
+            assert out.dtype == dtype and torch.allclose(out.float(), ref, rtol=2e-2, atol=2e-2)
+    print('sampling / knn / interpolation: ok')
+
+    # batched FPS against a one-cloud-at-a-time loop, and the voxel approximate mode on a large batch
+    import time
+
+    def fps_loop(xyz, offset, new_offset):
+        idx, start_n, start_m = [], 0, 0
+        for end_n, end_m in zip(offset.tolist(), new_offset.tolist()):
+            points, dist, old = xyz[start_n:end_n], torch.full((end_n - start_n,), 1e10), 0
+            idx.append(start_n)
+            for _ in range(start_m + 1, end_m):
+                diff = points - points[old]
+                dist = torch.minimum(dist, diff[:, 0] * diff[:, 0] + diff[:, 1] * diff[:, 1] + diff[:, 2] * diff[:, 2])
+                old = int(torch.argmax(dist))
+                idx.append(start_n + old)
+            start_n, start_m = end_n, end_m
+        return torch.IntTensor(idx)
+
+    # many small clouds (ModelNet preprocessing) and a few large ones of different sizes (TransitionDown)
+    torch.manual_seed(0)
+    for num, low, high, ratio in [(64, 1024, 1025, 2), (8, 5000, 20000, 8)]:
+        counts = torch.randint(low, high, (num,))
+        xyz, offset = torch.rand(int(counts.sum()), 3) * 5, counts.cumsum(0).int()
+        new_offset = (counts // ratio + 1).cumsum(0).int()
+        t = time.time()
+        ref = fps_loop(xyz, offset, new_offset)
+        t_loop = time.time() - t
+        t = time.time()
+        fps_idx = furthestsampling(xyz, offset, new_offset)
+        t_batch = time.time() - t
+        assert (fps_idx == ref).all()
+        print('fps of {} points in {} samples: loop {:.2f}s, batched {:.2f}s'.format(xyz.shape[0], num, t_loop, t_batch))
+    t = time.time()
+    fps_idx = furthestsampling(xyz, offset, new_offset, voxel_size=0.25)
+    t_voxel = time.time() - t
+    assert (torch.repeat_interleave(torch.arange(8), torch.diff(new_offset, prepend=new_offset.new_zeros(1))) == torch.bucketize(fps_idx, offset, right=True)).all()
+    print('fps of {} points in {} samples, voxel approximate: {:.2f}s'.format(xyz.shape[0], 8, t_voxel))
+
+    # random_start draws the start points from np.random in sample order, as the original ModelNet farthest_point_sample
+    counts, num_samples = torch.diff(offset, prepend=offset.new_zeros(1)), torch.diff(new_offset, prepend=new_offset.new_zeros(1))
+    first = (new_offset - num_samples).long()
+    np.random.seed(0)
+    ref = torch.IntTensor([np.random.randint(0, n) for n in counts.tolist()]) + offset - counts
+    for voxel_size in (None, 0.25):
+        np.random.seed(0)
+        assert (furthestsampling(xyz, offset, new_offset, voxel_size=voxel_size, random_start=True)[first] == ref).all()
+    print('fps random start: ok')
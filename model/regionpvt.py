@@ -4,39 +4,17 @@ from torch_points3d.modules.KPConv.kernels import KPConvLayer
 from torch_scatter import scatter_softmax
 from timm.models.layers import DropPath, trunc_normal_
 from torch_points3d.core.common_modules import FastBatchNorm1d
-from torch_geometric.nn import voxel_grid
 from libs.pointops2.functions import pointops
 
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import MinkowskiEngine as ME
 
 from model.transformer_base import LocalSelfAttentionBase
-from model.common import stride_centroids, downsample_points, downsample_embeddings
+from model.common import stride_centroids
 import libs.cuda_ops.functions.sparse_ops as ops
-
-
-def grid_sample(pos, batch, size, start, return_p2v=True):
-    # pos: float [N, 3]
-    # batch: long [N]
-    # size: float [3, ]
-    # start: float [3, ] / None
-
-    cluster = voxel_grid(pos, batch, size, start=start) #[N, ]
-
-    if return_p2v == False:
-        unique, cluster = torch.unique(cluster, sorted=True, return_inverse=True)
-        return cluster
-
-    unique, cluster, counts = torch.unique(cluster, sorted=True, return_inverse=True, return_counts=True)
-
-    # obtain p2v_map
-    n = unique.shape[0]
-    k = counts.max().item()
-    p2v_map = cluster.new_zeros(n, k) #[n, k]
-    mask = torch.arange(k).cuda().unsqueeze(0) < counts.unsqueeze(-1) #[n, k]
-    p2v_map[mask] = torch.argsort(cluster)
-
-    return cluster, p2v_map, counts
+from util.batch_util import offset2batch
+from model.window_ops import grid_sample, segment_mean, RegionVoxelization, AttentionPlanCache
 
 
 class Mlp(nn.Module):
@@ -71,11 +49,7 @@ class TransitionDown(nn.Module):
 
     def forward(self, feats, xyz, offset):
 
-        n_offset, count = [int(offset[0].item()*self.ratio)+1], int(offset[0].item()*self.ratio)+1
-        for i in range(1, offset.shape[0]):
-            count += ((offset[i].item() - offset[i-1].item())*self.ratio) + 1
-            n_offset.append(count)
-        n_offset = torch.cuda.IntTensor(n_offset)
+        n_offset = pointops.downsample_offset(offset, ratio=self.ratio)
         idx = pointops.furthestsampling(xyz, offset, n_offset)  # (m)
         n_xyz = xyz[idx.long(), :]  # (m, 3)
 
@@ -102,9 +76,12 @@ class WindowAttention(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set
         attn_drop (float, optional): Dropout ratio of attention weight. Default: 0.0
         proj_drop (float, optional): Dropout ratio of output. Default: 0.0
+        fused_rpe (bool, optional): If True, the relative position index of the pairs is computed inside the
+            pointops ops from the quantized coordinates of the points, without the [M, 3] gather. The ops have
+            no CUDA kernel, on GPU they run the chunked PyTorch implementation. Default: False
     """
 
-    def __init__(self, dim, window_size, num_heads, quant_size, rel_query=True, rel_key=False, rel_value=False, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, window_size, num_heads, quant_size, rel_query=True, rel_key=False, rel_value=False, qkv_bias=True, qk_scale=None, attn_drop=0., proj_drop=0., fused_rpe=False):
 
         super().__init__()
         self.dim = dim
@@ -117,6 +94,7 @@ class WindowAttention(nn.Module):
         self.rel_query = rel_query
         self.rel_key = rel_key
         self.rel_value = rel_value
+        self.fused_rpe = fused_rpe
 
         quant_grid_length = int(window_size / quant_size)
         if rel_query:
@@ -153,35 +131,40 @@ class WindowAttention(nn.Module):
 
         N, C = feats.shape
         
-        # Query, Key, Value
+        # Query, Key, Value, in the autocast dtype under AMP: the pointops ops accumulate in fp32
+        # and return that dtype, only the softmax is computed in fp32
         qkv = self.qkv(feats).reshape(N, 3, self.num_heads, C // self.num_heads).permute(1, 0, 2, 3).contiguous()
         query, key, value = qkv[0], qkv[1], qkv[2] #[N, num_heads, C//num_heads]
         query = query * self.scale
         
-        attn_flat = pointops.attention_step1_v2(query.float(), key.float(), index_1.int(), index_0_offsets.int(), n_max)
+        attn_flat = pointops.attention_step1_v2(query, key, index_1.int(), index_0_offsets.int(), n_max)
 
         xyz_quant = (xyz - xyz.min(0)[0] + shift_size) % self.window_size
         xyz_quant = xyz_quant // self.quant_size #[N, 3]
-        relative_position = xyz_quant[index_0] - xyz_quant[index_1] #[M, 3]
-        relative_position_index = self.map_func(relative_position) #[M, 3]
-        
+        if self.fused_rpe:
+            # the *_quant ops form the relative index of every pair from xyz_quant chunk by chunk
+            rpe = xyz_quant.int()
+        else:
+            relative_position = xyz_quant[index_0] - xyz_quant[index_1] #[M, 3]
+            rpe = self.map_func(relative_position).int() #[M, 3]
+
         if self.rel_query and self.rel_key:
-            relative_position_bias = pointops.dot_prod_with_idx_v3(query.float(), index_0_offsets.int(), n_max, key.float(), index_1.int(), self.relative_pos_query_table.float(), self.relative_pos_key_table.float(), relative_position_index.int())
+            relative_position_bias = self.rel_pos_bias_v3(query, index_0, index_0_offsets, n_max, key, index_1, rpe)
         elif self.rel_query:
-            relative_position_bias = pointops.dot_prod_with_idx(query.float(), index_0.int(), self.relative_pos_query_table.float(), relative_position_index.int()) #[M, num_heads]
+            relative_position_bias = self.rel_pos_bias(query, index_0, index_0, index_1, self.relative_pos_query_table, rpe) #[M, num_heads]
         elif self.rel_key:
-            relative_position_bias = pointops.dot_prod_with_idx(key.float(), index_1.int(), self.relative_pos_key_table.float(), relative_position_index.int()) #[M, num_heads]
+            relative_position_bias = self.rel_pos_bias(key, index_1, index_0, index_1, self.relative_pos_key_table, rpe) #[M, num_heads]
         else:
             relative_position_bias = 0
             
         attn_flat = attn_flat + relative_position_bias #[M, num_heads]
         
-        softmax_attn_flat = scatter_softmax(src=attn_flat, index=index_0, dim=0) #[M, num_heads]
+        softmax_attn_flat = scatter_softmax(src=attn_flat.float(), index=index_0, dim=0).type_as(value) #[M, num_heads]
 
         if self.rel_value:
-            x = pointops.attention_step2_with_rel_pos_value_v2(softmax_attn_flat.float(), value.float(), index_0_offsets.int(), n_max, index_1.int(), self.relative_pos_value_table.float(), relative_position_index.int())
+            x = self.rel_pos_value(softmax_attn_flat, value, index_0, index_0_offsets, n_max, index_1, rpe)
         else:
-            x = pointops.attention_step2(softmax_attn_flat.float(), value.float(), index_0.int(), index_1.int())
+            x = pointops.attention_step2(softmax_attn_flat, value, index_0.int(), index_1.int())
         x = x.view(N, C)
 
         x = self.proj(x)
@@ -189,6 +172,23 @@ class WindowAttention(nn.Module):
 
         return x
 
+    # relative position ops, rpe is the [M, 3] relative position index of the pairs, or the [N, 3]
+    # quantized coordinates of the points with fused_rpe
+    def rel_pos_bias(self, feats, index, index_0, index_1, table, rpe):
+        if self.fused_rpe:
+            return pointops.dot_prod_with_quant(feats, index.int(), index_0.int(), index_1.int(), table, rpe)
+        return pointops.dot_prod_with_idx(feats, index.int(), table, rpe)
+
+    def rel_pos_bias_v3(self, query, index_0, index_0_offsets, n_max, key, index_1, rpe):
+        if self.fused_rpe:
+            return pointops.dot_prod_with_quant_v3(query, index_0.int(), key, index_1.int(), self.relative_pos_query_table, self.relative_pos_key_table, rpe)
+        return pointops.dot_prod_with_idx_v3(query, index_0_offsets.int(), n_max, key, index_1.int(), self.relative_pos_query_table, self.relative_pos_key_table, rpe)
+
+    def rel_pos_value(self, attn, value, index_0, index_0_offsets, n_max, index_1, rpe):
+        if self.fused_rpe:
+            return pointops.attention_step2_with_rel_pos_value_quant(attn, value, index_0.int(), index_1.int(), self.relative_pos_value_table, rpe)
+        return pointops.attention_step2_with_rel_pos_value_v2(attn, value, index_0_offsets.int(), n_max, index_1.int(), self.relative_pos_value_table, rpe)
+
 
 ####################################
 # Regional Attention Layer
@@ -252,9 +252,8 @@ class LightweightSelfAttentionLayer(LocalSelfAttentionBase):
         q = torch.as_tensor(q, dtype=dtype)
         v = torch.as_tensor(v, dtype=dtype)
 
-        # key-query map
-        kernel_map, out_key = self.get_kernel_map_and_out_key(stensor)
-        kq_map = self.key_query_map_from_kernel_map(kernel_map)
+        # key-query map, shared by the layers over the same voxels
+        kq_map, kq_indices, out_key = self.get_key_query_maps(stensor)
 
         # attention weights with cosine similarity
         attn = torch.zeros((kq_map.shape[1], self.num_heads), dtype=dtype, device=device)
@@ -266,7 +265,6 @@ class LightweightSelfAttentionLayer(LocalSelfAttentionBase):
         out_F = torch.zeros((len(q), self.num_heads, self.attn_channels),
                             dtype=dtype,
                             device=device)
-        kq_indices = self.key_query_indices_from_key_query_map(kq_map)
         out_F = ops.scalar_attention_cuda(attn, v, out_F, kq_indices)
         out_F = self.to_out(out_F.view(-1, self.out_channels).contiguous())
         return ME.SparseTensor(out_F,
@@ -287,12 +285,13 @@ class R2LEncoderBlock(nn.Module):
         drop_path (float, optional): Stochastic depth rate. Default: 0.0
         act_layer (nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
+        fused_rpe (bool, optional): Relative position index computed inside the pointops ops. Default: False
     """
     QMODE = ME.SparseTensorQuantizationMode.UNWEIGHTED_AVERAGE
 
     def __init__(self, dim, num_heads, window_size, quant_size,
             rel_query=True, rel_key=False, rel_value=False, drop_path=0.0, \
-            mlp_ratio=4.0, qkv_bias=True, qk_scale=None, act_alyer=nn.GELU, norm_layer=nn.LayerNorm, mode=4):    # mode=4:mean
+            mlp_ratio=4.0, qkv_bias=True, qk_scale=None, act_alyer=nn.GELU, norm_layer=nn.LayerNorm, mode=4, fused_rpe=False):    # mode=4:mean
         super().__init__()
 
         self.window_size = window_size
@@ -300,7 +299,7 @@ class R2LEncoderBlock(nn.Module):
 
         self.norm1 = norm_layer(dim)
         self.local_attn = WindowAttention(dim, window_size=self.window_size, num_heads=num_heads, quant_size=quant_size,
-            rel_query=rel_query, rel_key=rel_key, rel_value=rel_value, qkv_bias=qkv_bias, qk_scale=qk_scale)
+            rel_query=rel_query, rel_key=rel_key, rel_value=rel_value, qkv_bias=qkv_bias, qk_scale=qk_scale, fused_rpe=fused_rpe)
         
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -322,146 +321,109 @@ class R2LEncoderBlock(nn.Module):
         )
 
 
-    @torch.no_grad()
-    def normalize_points(self, points, centroids, tensor_map):
-        tensor_map = tensor_map if tensor_map.dtype == torch.int64 else tensor_map.long()
-        norm_points = points - centroids[tensor_map]
-        return norm_points
-
+    def voxelize(self, xyz, batch, plan_cache):
+        """ Voxelization of the points at the window size, built by the first block of the stage """
+        voxelization = plan_cache.get_voxelization(xyz, self.window_size)
+        if voxelization is not None:
+            return voxelization
 
-    @torch.no_grad()
-    def normalize_centroids(self, down_points, coordinates, tensor_stride):
-        norm_points = (down_points - coordinates[:, 1:]) / tensor_stride - 0.5
-        return norm_points
-
-
-    def voxelize_with_centroids(self, x: ME.TensorField):
-        cm = x.coordinate_manager
-        points = x.C[:, 1:]
+        xyz_ = xyz / self.window_size
+        batch_coordinates = torch.cat([batch.unsqueeze(-1), xyz_], dim=1)      # [N, 4]
+        batch_coordinates_ = torch.as_tensor(batch_coordinates, dtype=torch.float32)
+        # only the coordinates are needed, the features of the voxels are averaged in voxelize_with_centroids
+        field = ME.TensorField(
+            features=batch_coordinates_.new_ones(batch_coordinates_.shape[0], 1),
+            coordinates=batch_coordinates_,
+            quantization_mode=self.QMODE
+        )
+        return plan_cache.add_voxelization(self.window_size, RegionVoxelization(field, field.sparse(), xyz))
 
-        out = x.sparse()
-        size = torch.Size([len(out), len(x)])
-        tensor_map, field_map = cm.field_to_sparse_map(x.coordinate_key, out.coordinate_key)    # tensor_map: v2p_map as "cluster" in the function grid_sample of stratified transformer
-        points_p1, count_p1 = downsample_points(points, tensor_map, field_map, size)            # centroid coordinates of voxels
-        norm_points = self.normalize_points(points, points_p1, tensor_map)
 
-        pos_embs = self.enc_mlp(norm_points)
+    def voxelize_with_centroids(self, feats, voxelization):
+        # tensor_map (voxelization.inverse): v2p_map as "cluster" in the function grid_sample of stratified transformer
+        pos_embs = self.enc_mlp(voxelization.norm_points)
         pos_embs = torch.as_tensor(pos_embs, dtype=torch.float32)
-        down_pos_embs = downsample_embeddings(pos_embs, tensor_map, size, mode="avg")
-        out_F = out.F + down_pos_embs
+        # mean(feats) + mean(pos_embs) of every voxel in a single segmented reduction
+        out_F = segment_mean(feats + pos_embs, voxelization.inverse, voxelization.counts)
         out = ME.SparseTensor(out_F,
-                            coordinate_map_key=out.coordinate_key,
-                            coordinate_manager=cm)
-
-        norm_points_p1 = self.normalize_centroids(points_p1, out.C, out.tensor_stride[0])
-        return out, norm_points_p1, points_p1, count_p1, pos_embs
+                            coordinate_map_key=voxelization.coordinate_key,
+                            coordinate_manager=voxelization.coordinate_manager)
+        return out, voxelization.norm_centroids, voxelization.centroids, voxelization.counts, pos_embs
 
     
-    def forward(self, feats, xyz, offset):
+    def forward(self, feats, xyz, offset, plan_cache=None):
         """ Forward function.
         
         Args:
             feats: N, C
             xyz: N, 3
             offset: N
-            window_size (float): Window size
+            plan_cache (AttentionPlanCache): attention plans and voxelizations shared by the blocks of the stage
         """
-        xyz_ = xyz / self.window_size
-        batch_coordinates = torch.cat([offset.unsqueeze(-1), xyz_], dim=1)      # [N, 4]
-        batch_coordinates_ = torch.as_tensor(batch_coordinates, dtype=torch.float32)
+        plan_cache = plan_cache if plan_cache is not None else AttentionPlanCache()
         feats_ = torch.as_tensor(feats, dtype=torch.float32)
-
-        in_data = ME.TensorField(
-            features=feats_,
-            coordinates=batch_coordinates_,
-            quantization_mode=self.QMODE
-        )
+        voxelization = self.voxelize(xyz, offset, plan_cache)
 
         # RSA:: y_r = ReLU(BN(RSA(x_r)))
-        out, norm_points_p1, _, _, _ = self.voxelize_with_centroids(in_data)
+        out, norm_points_p1, _, _, _ = self.voxelize_with_centroids(feats_, voxelization)
         regional_tokens = self.relu(self.bn(self.regional_attn(out, norm_points_p1)))
 
         # CAT:: y = x_l || y_r
-        voxel_point_coordinates = torch.cat([in_data.coordinates, regional_tokens.coordinates], dim=0)
-        voxel_point_features = torch.cat([in_data.features, regional_tokens.features], dim=0)
-
-        coords_dim = voxel_point_coordinates.shape[1]
-        feats_dim = voxel_point_features.shape[1]
-        voxel_point = torch.cat([voxel_point_coordinates, voxel_point_features], dim=1)
-        # torch.cat()以后的batch是杂乱的(in_data's batch, regional_tokens's batch)，需要对voxel_point按照batch大小重新进行排序，并获取排序后的索引
-        _, indices_ = torch.sort(voxel_point[:, 0])
-        batch_voxel_point = voxel_point[indices_]
-        batch_voxel_point_coordinates, batch_voxel_point_features = torch.split(batch_voxel_point, [coords_dim, feats_dim], dim=1)
-        batch_voxel_point_coordinates_, batch_voxel_point_features_ = batch_voxel_point_coordinates.contiguous(), batch_voxel_point_features.contiguous()
-
-        xyz_new = batch_voxel_point_coordinates_[:, 1:] * self.window_size
-        xyz_new = xyz_new.type_as(xyz).to(xyz.device)
-        feats_new = batch_voxel_point_features_.type_as(feats).to(feats.device)
-        window_size = torch.tensor([self.window_size]*3).type_as(xyz).to(xyz.device)
-        batch_new = batch_voxel_point_coordinates_[:, 0].long()
-
-        # region
-        # obtain p2v_map
-        v2p_map, p2v_map, counts = grid_sample(xyz_new, batch_new, window_size, start=None)
-        
-        # pre-compute all paired index of query and key that need to perform dot product
-        N, C = feats_new.shape
-        n, k = p2v_map.shape
-        mask = torch.arange(k).unsqueeze(0).cuda() < counts.unsqueeze(-1)   # [n, k]
-        mask_mat = (mask.unsqueeze(-1) & mask.unsqueeze(-2))                # [n, k, k]
-        index_0 = p2v_map.unsqueeze(-1).expand(-1, -1, k)[mask_mat]         # [M, ]
-        index_1 = p2v_map.unsqueeze(1).expand(-1, k, -1)[mask_mat]          # [M, ]
-        M = index_0.shape[0]
-
-        # rearrange index for acceleration
-        index_0, indices = torch.sort(index_0) #[M,]
-        index_1 = index_1[indices] #[M,]
-        index_0_counts = index_0.bincount()
-        n_max = index_0_counts.max()
-        index_0_offsets = index_0_counts.cumsum(dim=-1) #[N]
-        index_0_offsets = torch.cat([torch.zeros(1, dtype=torch.long).cuda(), index_0_offsets], 0) #[N+1]
-
-        assert index_0.shape[0] == index_1.shape[0]
-        assert index_0.shape[0] == (counts ** 2).sum()
+        plan = plan_cache.get(voxelization.point_coords, regional_tokens.coordinates, self.window_size, xyz.dtype)
+        feats_new = torch.cat([feats_, regional_tokens.features], dim=0).type_as(feats)
 
         shift_size = 0
-        # endregion
 
         # LSA:: z = y + LSA(LN(y))
         short_cut = feats_new
         feats = self.norm1(feats_new)
-        feats = self.local_attn(feats, xyz_new, index_0, index_0_offsets, n_max, index_1, shift_size)    # [N, c]
+        feats = self.local_attn(feats, plan.xyz, plan.index_0, plan.index_0_offsets, plan.n_max, plan.index_1, shift_size)    # [N, c]
 
         feats = short_cut + self.drop_path(feats)
         feats = feats + self.drop_path(self.mlp(self.norm2(feats)))
 
-        batch_voxel_point_new = torch.cat([xyz_new, feats], dim=1)
-        # 变回原来的 point || voxel 的顺序
-        rearranged_batch_voxel_point = batch_voxel_point_new[torch.argsort(indices_)]
-        rearranged_batch_voxel_point_coordinates, rearranged_batch_voxel_point_features = torch.split(rearranged_batch_voxel_point, [xyz_new.shape[1], feats.shape[1]], dim=1)
+        # only the points are kept, they are the first rows
+        feats = feats[:plan.num_points]
 
-        rearranged_in_data_coordinates, rearranged_regional_tokens_coordinates = torch.split(rearranged_batch_voxel_point_coordinates, [in_data.coordinates.shape[0], regional_tokens.coordinates.shape[0]], dim=0)
-        rearranged_Local_point_features, rearrange_regional_tokens_features = torch.split(rearranged_batch_voxel_point_features, [in_data.features.shape[0], regional_tokens.features.shape[0]], dim=0)
+        return feats
 
-        # assert rearranged_in_data_coordinates == in_data.coordinates[:, 1:]
-        # assert rearranged_regional_tokens_coordinates == regional_tokens.coordinates
+def checkpoint_block(blk, *inputs):
+    """ Activation checkpointing of one block. The recompute in backward runs the batch norms of the
+        block on the same batch a second time, their running statistics are saved before it and
+        restored after it so they are updated once per step, as without checkpointing.
+    """
+    calls = []
 
-        feats = rearranged_Local_point_features.contiguous()
+    def run(*inputs):
+        if not calls:
+            calls.append(True)
+            return blk(*inputs)
+        bns = [m for m in blk.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+        saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in bns]
+        try:
+            return blk(*inputs)
+        finally:
+            # also when the recompute is stopped early once the saved tensors are rebuilt (torch >= 2.1)
+            with torch.no_grad():
+                for m, (mean, var, num) in zip(bns, saved):
+                    m.running_mean.copy_(mean), m.running_var.copy_(var), m.num_batches_tracked.copy_(num)
+
+    return checkpoint(run, *inputs, use_reentrant=False)
 
-        return feats
 
 class BasicLayer(nn.Module):
     def __init__(self, depth, channel, num_heads, window_size, grid_size, quant_size, 
             rel_query=True, rel_key=False, rel_value=False, drop_path=0.0, mlp_ratio=4.0, qkv_bias=True, \
-            qk_scale=None, norm_layer=nn.LayerNorm, downsample=None, ratio=0.25, k=16, out_channels=None):
+            qk_scale=None, norm_layer=nn.LayerNorm, downsample=None, ratio=0.25, k=16, out_channels=None, fused_rpe=False, use_checkpoint=False):
         super().__init__()
         self.window_size = window_size
         self.depth = depth
         self.grid_size = grid_size
+        self.use_checkpoint = use_checkpoint
 
         self.blocks = nn.ModuleList([R2LEncoderBlock(channel, num_heads, window_size, quant_size, 
             rel_query=rel_query, rel_key=rel_key, rel_value=rel_value, drop_path=drop_path[i] if isinstance(drop_path, list) else drop_path,\
-            mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, norm_layer=norm_layer) for i in range(depth)])
+            mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale, norm_layer=norm_layer, fused_rpe=fused_rpe) for i in range(depth)])
 
         self.downsample = downsample(channel, out_channels, ratio, k) if downsample else None
 
@@ -470,12 +432,19 @@ class BasicLayer(nn.Module):
         # xyz: N, 3
         # offset: [batch_size]
         
-        offset_ = offset.clone()
-        offset_[1:] = offset_[1:] - offset_[:-1]
-        batch = torch.cat([torch.tensor([ii]*o) for ii, o in enumerate(offset_)], 0).long().cuda()
-
-        for i, blk in enumerate(self.blocks):
-            feats = blk(feats, xyz, batch) #[N, C]
+        batch = offset2batch(offset)
+
+        # the voxelization and the window-attention index plan are built by the first block and reused by the others
+        plan_cache = AttentionPlanCache()
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            # activation checkpointing: only the input of every block is kept and the rest of its forward is
+            # recomputed in backward; the recompute gets the same plan cache, which keeps the voxelization and
+            # the index plan alive until then (as the saved tensors of the attention do without checkpointing)
+            for i, blk in enumerate(self.blocks):
+                feats = checkpoint_block(blk, feats, xyz, batch, plan_cache) #[N, C]
+        else:
+            for i, blk in enumerate(self.blocks):
+                feats = blk(feats, xyz, batch, plan_cache) #[N, C]
 
         if self.downsample:
             feats_down, xyz_down, offset_down = self.downsample(feats, xyz, offset)
@@ -555,7 +524,8 @@ class KPConvResBlock(nn.Module):
 class RegionPVT(nn.Module):
     def __init__(self, depths, channels, num_heads, window_sizes, up_k, \
             grid_sizes, quant_sizes, rel_query=True, rel_key=False, rel_value=False, drop_path_rate=0.2, \
-            num_layers=4, concat_xyz=False, num_classes=13, ratio=0.25, k=16, prev_grid_size=0.04, sigma=1.0, stem_transformer=False):
+            num_layers=4, concat_xyz=False, num_classes=13, ratio=0.25, k=16, prev_grid_size=0.04, sigma=1.0, stem_transformer=False, fused_rpe=False, \
+            checkpoint_stages=()):
         super().__init__()
         
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, sum(depths))]  # stochastic depth decay rule
@@ -576,7 +546,8 @@ class RegionPVT(nn.Module):
         self.layers = nn.ModuleList([BasicLayer(depths[i], channels[i], num_heads[i], window_sizes[i], grid_sizes[i], \
             quant_sizes[i], rel_query=rel_query, rel_key=rel_key, rel_value=rel_value, \
             drop_path=dpr[sum(depths[:i]):sum(depths[:i+1])], downsample=TransitionDown if i < num_layers-1 else None, \
-            ratio=ratio, k=k, out_channels=channels[i+1] if i < num_layers-1 else None) for i in range(self.layer_start, num_layers)])
+            ratio=ratio, k=k, out_channels=channels[i+1] if i < num_layers-1 else None, fused_rpe=fused_rpe, \
+            use_checkpoint=i in checkpoint_stages) for i in range(self.layer_start, num_layers)])
 
         self.upsamples = nn.ModuleList([Upsample(up_k, channels[i], channels[i-1]) for i in range(num_layers-1, 0, -1)])
         
@@ -641,4 +612,68 @@ class RegionPVT(nn.Module):
                 nn.init.constant_(m.bias, 0)
                 nn.init.constant_(m.weight, 1.0)
 
-        self.apply(_init_weights)
\ No newline at end of file
+        self.apply(_init_weights)
+
+if __name__ == '__main__':
+    # memory vs speed of activation checkpointing on one stage (stage 3 of the S3DIS config: 6 blocks),
+    # forward + backward on random points, same weights with and without checkpointing
+    import time
+    import argparse
+    import resource
+    from model.window_ops import plan_stats
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_points', type=int, default=40000)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--channel', type=int, default=192)
+    parser.add_argument('--num_heads', type=int, default=12)
+    parser.add_argument('--window_size', type=float, default=16)
+    parser.add_argument('--quant_size', type=float, default=0.04)
+    parser.add_argument('--steps', type=int, default=3)
+    opt = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    torch.manual_seed(0)
+    counts = torch.full((opt.batch_size,), opt.num_points // opt.batch_size)
+    offset = counts.cumsum(0).int().to(device)
+    xyz = (torch.rand(int(counts.sum()), 3) * torch.tensor([120.0, 120.0, 40.0])).to(device)
+    feats = torch.randn(xyz.shape[0], opt.channel, device=device)
+
+    def peak_memory():
+        if device.type == 'cuda':
+            return torch.cuda.max_memory_allocated() / 2 ** 20
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    results = {}
+    state_dict = None
+    for use_checkpoint in (False, True):
+        layer = BasicLayer(opt.depth, opt.channel, opt.num_heads, opt.window_size, 1, opt.quant_size,
+            rel_query=True, rel_key=True, rel_value=True, use_checkpoint=use_checkpoint).to(device).train()
+        if state_dict is None:
+            state_dict = layer.state_dict()
+        layer.load_state_dict(state_dict)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        base, times = peak_memory(), []
+        plan_stats.clear()
+        for _ in range(opt.steps):
+            layer.zero_grad()
+            t = time.time()
+            out = layer(feats, xyz, offset)[0]
+            out.square().mean().backward()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            times.append(time.time() - t)
+        grads = torch.cat([p.grad.flatten() for p in layer.parameters() if p.grad is not None])
+        stats = torch.cat([b.float().flatten() for b in layer.buffers()])
+        results[use_checkpoint] = (out.detach(), grads, stats)
+        # on CPU ru_maxrss is the peak of the process, so the checkpointed run only shows a lower peak when run alone
+        print('checkpoint={}: {:.3f}s / step, peak memory {:.0f} MB ({} +{:.0f} MB), plans built {} / reused {} per step'.format(use_checkpoint, min(times),
+            peak_memory(), 'max_memory_allocated' if device.type == 'cuda' else 'ru_maxrss', peak_memory() - base,
+            plan_stats['miss'] // opt.steps, plan_stats['hit'] // opt.steps))
+    assert torch.allclose(results[False][0], results[True][0], atol=1e-4)
+    assert torch.allclose(results[False][1], results[True][1], rtol=1e-3, atol=1e-4)
+    # batch norm running statistics updated once per step in both runs
+    assert torch.allclose(results[False][2], results[True][2], atol=1e-5)
@@ -48,6 +48,36 @@ class LocalSelfAttentionBase(nn.Module):
             kq_indices = torch.cat(kq_indices, -1)
         return kq_indices
 
+    def key_query_maps_from_kernel_map(self, kernel_map):
+        """ kq_map (key * kernel_volume + kernel index, query) and kq_indices (key, query) [2, M] of a
+            kernel map, concatenated once without changing the kernel map.
+        """
+        in_out = list(kernel_map.values())
+        kq_indices = torch.cat(in_out, -1)
+        sizes = torch.tensor([x.shape[1] for x in in_out], device=kq_indices.device)
+        kernel_idx = torch.tensor(list(kernel_map.keys()), dtype=kq_indices.dtype, device=kq_indices.device)
+        kernel_idx = torch.repeat_interleave(kernel_idx, sizes, output_size=kq_indices.shape[1])
+        kq_map = torch.stack([kq_indices[0] * self.kernel_volume + kernel_idx, kq_indices[1]])
+        return kq_map, kq_indices
+
+    def get_key_query_maps(self, stensor):
+        """ kq_map, kq_indices and out_key of stensor.
+
+            They only depend on the coordinates, so they are built once per coordinate map and
+            cached on its coordinate manager: the blocks of a stage share the voxelization (and
+            its manager), and the cached tensors are the ones saved for backward.
+        """
+        cm = stensor.coordinate_manager
+        cache = getattr(cm, 'kq_map_cache', None)
+        if cache is None:
+            cache = cm.kq_map_cache = {}
+        key = (str(stensor.coordinate_key), self.kernel_size, self.stride, self.dilation)
+        if key not in cache:
+            kernel_map, out_key = self.get_kernel_map_and_out_key(stensor)
+            kq_map, kq_indices = self.key_query_maps_from_kernel_map(kernel_map)
+            cache[key] = (kq_map, kq_indices, out_key)
+        return cache[key]
+
     def key_query_indices_from_key_query_map(self, kq_map):
         kq_indices = kq_map.clone()
         kq_indices[0] = kq_indices[0] // self.kernel_volume
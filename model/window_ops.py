@@ -0,0 +1,308 @@
+import collections
+
+import torch
+from torch_geometric.nn import voxel_grid
+
+
+# hits / misses (plans, voxelizations) of all the AttentionPlanCache instances of the process
+plan_stats = collections.Counter()
+
+
+def grid_sample(pos, batch, size, start, return_p2v=True):
+    # pos: float [N, 3]
+    # batch: long [N]
+    # size: float [3, ]
+    # start: float [3, ] / None
+
+    cluster = voxel_grid(pos, batch, size, start=start) #[N, ]
+
+    if return_p2v == False:
+        unique, cluster = torch.unique(cluster, sorted=True, return_inverse=True)
+        return cluster
+
+    unique, cluster, counts = torch.unique(cluster, sorted=True, return_inverse=True, return_counts=True)
+
+    # obtain p2v_map
+    n = unique.shape[0]
+    k = counts.max().item()
+    p2v_map = cluster.new_zeros(n, k) #[n, k]
+    mask = torch.arange(k, device=counts.device).unsqueeze(0) < counts.unsqueeze(-1) #[n, k]
+    p2v_map[mask] = torch.argsort(cluster)
+
+    return cluster, p2v_map, counts
+
+
+def window_pairs(cluster):
+    """ All the (query, key) pairs of points that share a window, built from the window sizes.
+
+    Args:
+        cluster: long [N], window of every point (0 .. n-1, all used).
+    Returns:
+        index_0 [M] (query, non-decreasing), index_1 [M] (key), index_0_offsets [N+1], n_max,
+        where M = sum(counts ** 2).
+
+        The keys of query i are the points of its window: with the points sorted by window and
+        the prefix sums of the window sizes, pair m of query i reads key number
+        m - index_0_offsets[i] of that window. No [n, k, k] mask and no sort of the M pairs.
+    """
+    N = cluster.shape[0]
+    counts = torch.bincount(cluster)
+    _, members = torch.sort(cluster, stable=True)                       # points grouped by window
+    window_start = torch.cumsum(counts, dim=0) - counts                 # [n]
+
+    index_0_counts = counts[cluster]                                    # [N], every point queries its whole window
+    index_0_offsets = torch.cat([index_0_counts.new_zeros(1), torch.cumsum(index_0_counts, dim=0)], 0) #[N+1]
+    M = int(index_0_offsets[-1])
+    index_0 = torch.repeat_interleave(torch.arange(N, device=cluster.device), index_0_counts, output_size=M) #[M]
+    key_base = window_start[cluster] - index_0_offsets[:-1]             # [N]
+    index_1 = members[torch.arange(M, device=cluster.device) + key_base[index_0]] #[M]
+    return index_0, index_1, index_0_offsets, counts.max()
+
+
+def segment_mean(values, inverse, counts):
+    """ Mean of the rows of values [N, C] per segment, given the segment of every row (inverse [N])
+        and the segment sizes (counts [n], all > 0). A single index_add_ over the inverse map, so the
+        rows need not be sorted by segment.
+    """
+    out = values.new_zeros(counts.shape[0], values.shape[1]).index_add_(0, inverse, values)
+    return out / counts.unsqueeze(1).type_as(out)
+
+
+class RegionVoxelization(object):
+    """ The voxels of the points at the window size (the regional tokens), which only depend on the
+        coordinates: the inverse map point -> voxel, the voxel sizes and centroids, the points relative
+        to their centroid and the centroids relative to their voxel.
+
+    Args:
+        field (ME.TensorField): points, coordinates (batch, xyz / window_size).
+        voxels (ME.SparseTensor): field.sparse(), in the coordinate manager of field.
+        xyz: the xyz the field was built from, the cache key.
+    """
+    def __init__(self, field, voxels, xyz):
+        self.xyz = xyz
+        self.coordinate_manager = field.coordinate_manager
+        self.coordinate_key = voxels.coordinate_key
+        self.point_coords = field.coordinates
+
+        tensor_map, field_map = self.coordinate_manager.field_to_sparse_map(field.coordinate_key, voxels.coordinate_key)
+        with torch.no_grad():
+            self.inverse = tensor_map.new_empty(self.point_coords.shape[0], dtype=torch.long)
+            self.inverse[field_map.long()] = tensor_map.long()
+            self.counts = torch.bincount(self.inverse, minlength=len(voxels))
+            points = self.point_coords[:, 1:]
+            self.centroids = segment_mean(points, self.inverse, self.counts)
+            self.norm_points = points - self.centroids[self.inverse]
+            self.norm_centroids = (self.centroids - voxels.C[:, 1:]) / voxels.tensor_stride[0] - 0.5
+
+
+class AttentionPlan(object):
+    """ Everything the window attention of a R2LEncoderBlock needs that only depends on the coordinates:
+        the xyz of the points || regional tokens and the query / key pairs of every window grouped by
+        query (index_0, index_0_offsets, n_max, index_1).
+
+        The rows are the points followed by the regional tokens, as concatenated. They do not need
+        to be sorted by batch: the windows are keyed by (batch, cell), so pairs never cross samples
+        and the output of the points is the first num_points rows.
+    """
+    def __init__(self, point_coords, voxel_coords, window_size, dtype):
+        self.num_points = point_coords.shape[0]
+        self.voxel_coords = voxel_coords
+
+        voxel_point_coordinates = torch.cat([point_coords, voxel_coords.type_as(point_coords)], dim=0)
+        self.xyz = (voxel_point_coordinates[:, 1:] * window_size).to(dtype)
+        window_size = torch.tensor([window_size]*3, dtype=dtype, device=self.xyz.device)
+        batch = voxel_point_coordinates[:, 0].long()
+
+        # window of every point and all the paired index of query and key that need to perform dot product
+        cluster = grid_sample(self.xyz, batch, window_size, start=None, return_p2v=False)
+        self.index_0, self.index_1, self.index_0_offsets, self.n_max = window_pairs(cluster)
+
+
+class AttentionPlanCache(object):
+    """ Attention plans and voxelizations shared by the blocks of one BasicLayer forward.
+
+        All the blocks of a stage attend over the same xyz, and their regional tokens are the
+        voxelization of that xyz at the window size, so the first block builds the plan and the others
+        reuse it. A plan is only reused for the same window size, number of points and identical
+        regional token coordinates, so a cache must not outlive the xyz it was created for.
+        A voxelization is reused for the same window size and the same xyz tensor.
+    """
+    def __init__(self):
+        self.plans = {}
+        self.voxelizations = {}
+        self.hits, self.misses = 0, 0
+
+    def get_voxelization(self, xyz, window_size):
+        voxelization = self.voxelizations.get(window_size)
+        if voxelization is not None and voxelization.xyz is xyz:
+            plan_stats['voxelization_hit'] += 1
+            return voxelization
+        plan_stats['voxelization_miss'] += 1
+        return None
+
+    def add_voxelization(self, window_size, voxelization):
+        self.voxelizations[window_size] = voxelization
+        return voxelization
+
+    def get(self, point_coords, voxel_coords, window_size, dtype):
+        plan = self.plans.get(window_size)
+        if plan is not None and plan.num_points == point_coords.shape[0] and torch.equal(plan.voxel_coords, voxel_coords):
+            self.hits += 1
+            plan_stats['hit'] += 1
+            return plan
+        self.misses += 1
+        plan_stats['miss'] += 1
+        plan = AttentionPlan(point_coords, voxel_coords, window_size, dtype)
+        self.plans[window_size] = plan
+        return plan
+
+
+if __name__ == '__main__':
+    # peak memory / time of the pair construction, dense [n, k, k] mask (previous code) vs window_pairs,
+    # each run in a fresh process so that ru_maxrss measures its own peak
+    import time
+    import resource
+    import numpy as np
+    import multiprocessing as mp
+
+    def dense_window_pairs(cluster):
+        unique, cluster, counts = torch.unique(cluster, sorted=True, return_inverse=True, return_counts=True)
+        n, k = unique.shape[0], counts.max().item()
+        p2v_map = cluster.new_zeros(n, k)
+        mask = torch.arange(k).unsqueeze(0) < counts.unsqueeze(-1)
+        p2v_map[mask] = torch.argsort(cluster)
+        mask_mat = (mask.unsqueeze(-1) & mask.unsqueeze(-2))
+        index_0 = p2v_map.unsqueeze(-1).expand(-1, -1, k)[mask_mat]
+        index_1 = p2v_map.unsqueeze(1).expand(-1, k, -1)[mask_mat]
+        index_0, indices = torch.sort(index_0)
+        index_1 = index_1[indices]
+        index_0_counts = index_0.bincount()
+        index_0_offsets = torch.cat([torch.zeros(1, dtype=torch.long), index_0_counts.cumsum(dim=-1)], 0)
+        return index_0, index_1, index_0_offsets, index_0_counts.max()
+
+    def make_cluster(num_points, num_windows, hotspot):
+        # uniform windows, plus a fraction hotspot of the points in 20 windows (walls, floors, dense clutter)
+        torch.manual_seed(0)
+        cluster = torch.randint(0, num_windows, (num_points,))
+        hot = torch.rand(num_points) < hotspot
+        cluster[hot] = torch.randint(0, 20, (int(hot.sum()),))
+        return cluster.unique(return_inverse=True)[1]
+
+    def run(method, num_points, num_windows, hotspot, queue):
+        cluster = make_cluster(num_points, num_windows, hotspot)
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t = time.time()
+        index_0, index_1, index_0_offsets, n_max = (dense_window_pairs if method == 'dense' else window_pairs)(cluster)
+        t = time.time() - t
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+        queue.put((t, peak, index_0.shape[0], int(n_max), index_0.numpy(), index_1.numpy(), index_0_offsets.numpy()))
+
+    ctx = mp.get_context('fork')
+    for num_points, num_windows, hotspot in [(100000, 5000, 0.0), (100000, 5000, 0.02), (100000, 5000, 0.08)]:
+        results = {}
+        for method in ['dense', 'window_pairs']:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run, args=(method, num_points, num_windows, hotspot, queue))
+            proc.start()
+            results[method] = queue.get()
+            proc.join()
+            t, peak, M, n_max = results[method][:4]
+            print('N={} windows={} hotspot={:.0%}: {:>12s} {:.3f}s, peak +{:.0f} MB (M={}, n_max={})'.format(num_points, num_windows, hotspot, method, t, peak / 1024, M, n_max))
+        # same offsets and the same key set for every query (the key order within a query is free)
+        dense, sparse = results['dense'][4:], results['window_pairs'][4:]
+        assert (dense[0] == sparse[0]).all() and (dense[2] == sparse[2]).all()
+        key = lambda index_0, index_1: np.sort(index_0 * num_points + index_1)
+        assert (key(dense[0], dense[1]) == key(sparse[0], sparse[1])).all()
+
+    # relative position bias + value of one window attention (rel_query, rel_key, rel_value), forward and
+    # backward: [M, 3] relative index gathered from xyz_quant (previous path) vs fused_rpe; on CPU in fresh
+    # processes (ru_maxrss), on CUDA in this process (max_memory_allocated) when a GPU is available
+    from libs.pointops2.functions import pointops
+
+    def rpe_step(method, device):
+        torch.manual_seed(0)
+        N, h, hdim, window_size, quant_size = 60000, 3, 16, 0.16, 0.01
+        L = 2 * int(window_size / quant_size) - 1
+        xyz = torch.cat([torch.rand(N, 2) * 6, torch.rand(N, 1) * 0.3], 1)
+        cluster = grid_sample(xyz, torch.zeros(N, dtype=torch.long), torch.tensor([window_size] * 3), None, return_p2v=False)
+        index_0, index_1, index_0_offsets, n_max = window_pairs(cluster)
+        index_0, index_1, index_0_offsets, n_max = index_0.int().to(device), index_1.int().to(device), index_0_offsets.int().to(device), int(n_max)
+        xyz = xyz.to(device)
+        q, k, v = [torch.randn(N, h, hdim).to(device).requires_grad_() for _ in range(3)]
+        table_q, table_k, table_v = [torch.randn(L, h, hdim, 3).to(device).requires_grad_() for _ in range(3)]
+        attn = torch.rand(index_0.shape[0], h).to(device).requires_grad_()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+        else:
+            base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t = time.time()
+        xyz_quant = ((xyz - xyz.min(0)[0]) % window_size) // quant_size
+        if method == 'fused_rpe':
+            xyz_quant = xyz_quant.int()
+            bias = pointops.dot_prod_with_quant_v3(q, index_0, k, index_1, table_q, table_k, xyz_quant)
+            x = pointops.attention_step2_with_rel_pos_value_quant(attn, v, index_0, index_1, table_v, xyz_quant)
+        else:
+            relative_position_index = (xyz_quant[index_0.long()] - xyz_quant[index_1.long()] + L // 2).int()
+            bias = pointops.dot_prod_with_idx_v3(q, index_0_offsets, n_max, k, index_1, table_q, table_k, relative_position_index)
+            x = pointops.attention_step2_with_rel_pos_value_v2(attn, v, index_0_offsets, n_max, index_1, table_v, relative_position_index)
+        torch.autograd.backward([bias, x], [torch.ones_like(bias), torch.ones_like(x)])
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            peak = (torch.cuda.max_memory_allocated() - base) / 1024
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+        t = time.time() - t
+        return (t, peak, index_0.shape[0]) + tuple(a.detach().cpu().numpy() for a in (bias, x, table_q.grad, table_v.grad))
+
+    for device in ['cpu'] + (['cuda'] if torch.cuda.is_available() else []):
+        results = {}
+        for method in ['gather', 'fused_rpe']:
+            if device == 'cuda':
+                rpe_step(method, device)  # warm-up
+                results[method] = rpe_step(method, device)
+            else:
+                queue = ctx.Queue()
+                proc = ctx.Process(target=lambda method, queue: queue.put(rpe_step(method, 'cpu')), args=(method, queue))
+                proc.start()
+                results[method] = queue.get()
+                proc.join()
+            t, peak, M = results[method][:3]
+            print('relative position bias + value M={} ({}): {:>9s} {:.3f}s, peak +{:.0f} MB'.format(M, device, method, t, peak / 1024))
+        for a, b in zip(results['gather'][3:], results['fused_rpe'][3:]):
+            assert np.allclose(a, b, atol=1e-4)
+
+    # bytes allocated by the merge / unmerge of the points and the regional tokens around the attention
+    # of one block (stood in by feats + 1): concat-sort-split-argsort round trip vs concatenation + slice
+    from torch.profiler import profile, ProfilerActivity
+
+    N, V, C, window_size = 200000, 20000, 96, 0.16
+    point_coords = torch.cat([torch.randint(0, 4, (N, 1)).sort(0)[0].float(), torch.rand(N, 3) * 30], 1)
+    voxel_coords = torch.cat([torch.randint(0, 4, (V, 1)), torch.randint(0, 200, (V, 3))], 1).int()
+    point_feats, voxel_feats = torch.randn(N, C), torch.randn(V, C)
+
+    def round_trip():
+        voxel_point = torch.cat([torch.cat([point_coords, voxel_coords], 0), torch.cat([point_feats, voxel_feats], 0)], 1)
+        _, indices_ = torch.sort(voxel_point[:, 0])
+        coords, feats = torch.split(voxel_point[indices_], [4, C], 1)
+        coords, feats = coords.contiguous(), feats.contiguous()
+        xyz_new = coords[:, 1:] * window_size
+        feats = feats + 1
+        rearranged = torch.cat([xyz_new, feats], 1)[torch.argsort(indices_)]
+        _, feats = torch.split(rearranged, [3, C], 1)
+        return torch.split(feats, [N, V], 0)[0].contiguous()
+
+    def concat_slice():
+        feats = torch.cat([point_feats, voxel_feats], 0)
+        feats = feats + 1
+        return feats[:N]
+
+    assert torch.equal(round_trip(), concat_slice())
+    for fn in (round_trip, concat_slice):
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            t = time.time()
+            fn()
+            t = time.time() - t
+        allocated = sum(e.cpu_memory_usage for e in prof.events() if e.cpu_memory_usage > 0 and e.cpu_parent is None)
+        print('merge / unmerge N={} V={} C={}: {:>12s} {:.3f}s (profiled), {:.0f} MB allocated'.format(N, V, C, fn.__name__, t, allocated / 2 ** 20))
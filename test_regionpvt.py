@@ -6,6 +6,9 @@ import logging
 import pickle
 import argparse
 import collections
+import itertools
+import queue
+import threading
 
 import torch
 import torch.nn as nn
@@ -16,7 +19,9 @@ import torch.utils.data
 from util import config, transform
 from util.common_util import AverageMeter, intersectionAndUnion, check_makedirs
 from util.voxelize import voxelize
-import torch_points_kernels as tp
+from util.data_util import plan_crops
+from util.batch_util import offset2batch
+from util.neighbor import radius_neighbors
 import torch.nn.functional as F
 from util.logger import get_logger
 
@@ -74,7 +79,8 @@ def main():
             args.window_sizes, args.up_k, args.grid_sizes, args.quant_sizes, rel_query=args.rel_query, \
             rel_key=args.rel_key, rel_value=args.rel_value, drop_path_rate=args.drop_path_rate, \
             concat_xyz=args.concat_xyz, num_classes=args.classes, \
-            ratio=args.ratio, k=args.k, prev_grid_size=args.grid_size, sigma=1.0, num_layers=args.num_layers, stem_transformer=args.stem_transformer)
+            ratio=args.ratio, k=args.k, prev_grid_size=args.grid_size, sigma=1.0, num_layers=args.num_layers, stem_transformer=args.stem_transformer, \
+            fused_rpe=args.get('fused_rpe', False), checkpoint_stages=args.get('checkpoint_stages', None) or ())
 
     else:
         raise Exception('architecture {} not supported yet'.format(args.arch))
@@ -187,6 +193,127 @@ def input_normalize(coord, feat):
     return coord, feat
 
 
+def plan_fragments(coord, idx_data):
+    """ Scene indices of every fragment fed to the model: one per voxel part, or its covering crops """
+    fragments = []
+    for idx_part in idx_data:
+        if args.voxel_max and idx_part.shape[0] > args.voxel_max:
+            fragments += [idx_part[idx_crop] for idx_crop in plan_crops(coord[idx_part], args.voxel_max)]
+        else:
+            fragments.append(idx_part)
+    return fragments
+
+
+def tta_batches(item, coord, feat, idx_data, fragments, test_transform_set):
+    """ Host batches of fragments of all the augmentations, packed batch_size_test at a time.
+
+        coord, feat, idx_data and fragments are the identity pass of the scene (data_load(item, None)).
+        A rotation is loaded and voxelized again in its own pass, when the batches reach it, as in the
+        original loop. A shift only translates the scene, which data_load and input_normalize move back
+        to the origin, so it is the identity pass again: like the repeated None it adds its weight to the
+        identity pass instead of a forward pass. When the scene is cropped, such a repeat gets its own
+        random crop plan, as the separate pass of the original loop.
+        The votes of a pass are weighted by 1 / (number of its fragments covering the point), so the
+        sum over passes is the sum of the per-pass normalized predictions.
+    """
+    cropped = len(fragments) > len(idx_data)
+    passes, identity = [], []  # [transform, weight, fragments], rotations are planned when reached
+    for t in test_transform_set:
+        if t is not None and not isinstance(t, transform.RandomShift_test):
+            passes.append([t, 1, None])
+        elif not identity:
+            identity.append([None, 1, fragments])
+            passes.append(identity[0])
+        elif not cropped:
+            identity[0][1] += 1
+        else:
+            passes.append([None, 1, plan_fragments(coord, idx_data)])
+
+    def fragment_iter():
+        for aug_id, (test_transform, weight, aug_fragments) in enumerate(passes):
+            coord_aug, feat_aug = coord, feat
+            if test_transform is not None:
+                coord_aug, feat_aug, _, aug_idx_data = data_load(item, test_transform)
+                aug_fragments = plan_fragments(coord_aug, aug_idx_data)
+            votes = np.bincount(np.concatenate(aug_fragments), minlength=coord.shape[0])
+            for i, idx_sub in enumerate(aug_fragments):
+                coord_sub, feat_sub = input_normalize(coord_aug[idx_sub], feat_aug[idx_sub])
+                yield aug_id, i + 1, len(aug_fragments), weight / votes[idx_sub], idx_sub, coord_sub, feat_sub
+
+    items = fragment_iter()
+    while True:
+        part = list(itertools.islice(items, args.batch_size_test))
+        if not part:
+            break
+        aug_id, end, total, weight, idx_part, coord_part, feat_part = list(zip(*part))
+        yield {
+            'aug': (aug_id[0] + 1, aug_id[-1] + 1, len(passes)), 'end': end[-1], 'total': total[-1],
+            'idx': np.concatenate(idx_part), 'weight': np.concatenate(weight).astype(np.float32),
+            'coord': np.concatenate(coord_part).astype(np.float32), 'feat': np.concatenate(feat_part).astype(np.float32),
+            'offset': np.cumsum([x.shape[0] for x in idx_part]).astype(np.int32),
+        }
+
+
+def prepare_batch(batch_data):
+    """ Host side of a test batch: tensors, batch index and neighbors (on CPU, as in training), pinned for async copies """
+    coord_part = torch.from_numpy(batch_data['coord'])
+    offset_part = torch.from_numpy(batch_data['offset'])
+    batch = offset2batch(offset_part)
+
+    sigma = 1.0
+    radius = 2.5 * args.grid_size * sigma
+    neighbor_idx = radius_neighbors(coord_part, offset_part, radius, args.max_num_neighbors, backend=args.get('neighbor_backend', 'tp'))
+
+    tensors = {'coord': coord_part, 'feat': torch.from_numpy(batch_data['feat']), 'offset': offset_part, 'batch': batch, 'neighbor_idx': neighbor_idx,
+               'idx': torch.from_numpy(batch_data['idx']), 'weight': torch.from_numpy(batch_data['weight'])}
+    if torch.cuda.is_available():
+        tensors = {k: v.pin_memory() for k, v in tensors.items()}
+    batch_data.update(tensors)
+    return batch_data
+
+
+def prefetch(generator, size):
+    """ Run a generator in a background thread, at most size items ahead of the consumer (synchronous if size <= 0) """
+    if size <= 0:
+        yield from generator
+        return
+    items, done = queue.Queue(maxsize=size), object()
+
+    def producer():
+        try:
+            for item in generator:
+                items.put(item)
+            items.put(done)
+        except BaseException as e:
+            items.put(e)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+    thread.join()
+
+
+def run_batch(model, batch_data):
+    coord_part = batch_data['coord'].cuda(non_blocking=True)
+    feat_part = batch_data['feat'].cuda(non_blocking=True)
+    offset_part = batch_data['offset'].cuda(non_blocking=True)
+    batch = batch_data['batch'].cuda(non_blocking=True)
+    neighbor_idx = batch_data['neighbor_idx'].cuda(non_blocking=True)
+    with torch.no_grad():
+        if args.concat_xyz:
+            feat_part = torch.cat([feat_part, coord_part], 1)
+
+        pred_part = model(feat_part, coord_part, offset_part, batch, neighbor_idx)
+        pred_part = F.softmax(pred_part, -1) # Add softmax
+    return pred_part
+
+
 def test(model, criterion, names, test_transform_set):
     logger.info('>>>>>>>>>>>>>>>> Start Evaluation >>>>>>>>>>>>>>>>')
     batch_time = AverageMeter()
@@ -211,71 +338,24 @@ def test(model, criterion, names, test_transform_set):
             logger.info('{}/{}: {}, loaded pred and label.'.format(idx + 1, len(data_list), item))
             pred, label = np.load(pred_save_path), np.load(label_save_path)
         else:
-            # ensemble output
-            pred_all = 0
-            for aug_id in range(len(test_transform_set)):
-                test_transform = test_transform_set[aug_id]
-                    
-                if os.path.isfile(pred_save_path) and os.path.isfile(label_save_path):
-                    logger.info('{}/{}: {}, loaded pred and label.'.format(idx + 1, len(data_list), item))
-                    pred, label = np.load(pred_save_path), np.load(label_save_path)
-                else:
-                    coord, feat, label, idx_data = data_load(item, test_transform)
-                    pred = torch.zeros((label.size, args.classes)).cuda()
-                    idx_size = len(idx_data)
-                    idx_list, coord_list, feat_list, offset_list  = [], [], [], []
-                    for i in range(idx_size):
-                        logger.info('{}/{}: {}/{}/{}, {}'.format(idx + 1, len(data_list), i + 1, idx_size, idx_data[0].shape[0], item))
-                        idx_part = idx_data[i]
-                        coord_part, feat_part = coord[idx_part], feat[idx_part]
-                        if args.voxel_max and coord_part.shape[0] > args.voxel_max:
-                            coord_p, idx_uni, cnt = np.random.rand(coord_part.shape[0]) * 1e-3, np.array([]), 0
-                            while idx_uni.size != idx_part.shape[0]:
-                                init_idx = np.argmin(coord_p)
-                                dist = np.sum(np.power(coord_part - coord_part[init_idx], 2), 1)
-                                idx_crop = np.argsort(dist)[:args.voxel_max]
-                                coord_sub, feat_sub, idx_sub = coord_part[idx_crop], feat_part[idx_crop], idx_part[idx_crop]
-                                dist = dist[idx_crop]
-                                delta = np.square(1 - dist / np.max(dist))
-                                coord_p[idx_crop] += delta
-                                coord_sub, feat_sub = input_normalize(coord_sub, feat_sub)
-                                idx_list.append(idx_sub), coord_list.append(coord_sub), feat_list.append(feat_sub), offset_list.append(idx_sub.size)
-                                idx_uni = np.unique(np.concatenate((idx_uni, idx_sub)))
-                                # cnt += 1; logger.info('cnt={}, idx_sub/idx={}/{}'.format(cnt, idx_uni.size, idx_part.shape[0]))
-                        else:
-                            coord_part, feat_part = input_normalize(coord_part, feat_part)
-                            idx_list.append(idx_part), coord_list.append(coord_part), feat_list.append(feat_part), offset_list.append(idx_part.size)
-                    batch_num = int(np.ceil(len(idx_list) / args.batch_size_test))
-                    for i in range(batch_num):
-                        s_i, e_i = i * args.batch_size_test, min((i + 1) * args.batch_size_test, len(idx_list))
-                        idx_part, coord_part, feat_part, offset_part = idx_list[s_i:e_i], coord_list[s_i:e_i], feat_list[s_i:e_i], offset_list[s_i:e_i]
-                        idx_part = np.concatenate(idx_part)
-                        coord_part = torch.FloatTensor(np.concatenate(coord_part)).cuda(non_blocking=True)
-                        feat_part = torch.FloatTensor(np.concatenate(feat_part)).cuda(non_blocking=True)
-                        offset_part = torch.IntTensor(np.cumsum(offset_part)).cuda(non_blocking=True)
-                        with torch.no_grad():
-                            
-                            offset_ = offset_part.clone()
-                            offset_[1:] = offset_[1:] - offset_[:-1]
-                            batch = torch.cat([torch.tensor([ii]*o) for ii,o in enumerate(offset_)], 0).long().cuda(non_blocking=True)
-
-                            sigma = 1.0
-                            radius = 2.5 * args.grid_size * sigma
-                            neighbor_idx = tp.ball_query(radius, args.max_num_neighbors, coord_part, coord_part, mode="partial_dense", batch_x=batch, batch_y=batch)[0]
-                            neighbor_idx = neighbor_idx.cuda(non_blocking=True)
-
-                            if args.concat_xyz:
-                                feat_part = torch.cat([feat_part, coord_part], 1)
-
-                            pred_part = model(feat_part, coord_part, offset_part, batch, neighbor_idx)
-                            pred_part = F.softmax(pred_part, -1) # Add softmax
-
-                        torch.cuda.empty_cache()
-                        pred[idx_part, :] += pred_part
-                        logger.info('Test: {}/{}, {}/{}, {}/{}, {}/{}'.format(aug_id+1, len(test_transform_set), idx + 1, len(data_list), e_i, len(idx_list), args.voxel_max, idx_part.shape[0]))
-                pred = pred / (pred.sum(-1)[:, None]+1e-8)
-                pred_all += pred
-            pred = pred_all / len(test_transform_set)
+            # ensemble output: softmax votes of all augmentations accumulate in one buffer
+            coord, feat, label, idx_data = data_load(item, None)
+            fragments = plan_fragments(coord, idx_data)
+            logger.info('{}/{}: {}, {} parts, {} fragments, {} augmentations'.format(idx + 1, len(data_list), item, len(idx_data), len(fragments), len(test_transform_set)))
+            pred = torch.zeros((label.size, args.classes)).cuda()
+            # the next batches (fragments, batch index, neighbors) are prepared in a background thread
+            batches = (prepare_batch(batch_data) for batch_data in tta_batches(item, coord, feat, idx_data, fragments, test_transform_set))
+            for batch_data in prefetch(batches, args.get('test_prefetch', 2)):
+                pred_part = run_batch(model, batch_data)
+                torch.cuda.empty_cache()
+                idx_part = batch_data['idx'].cuda(non_blocking=True)
+                weight = batch_data['weight'].cuda(non_blocking=True)
+                # index_add_ also counts the votes of crops overlapping inside one batch
+                pred.index_add_(0, idx_part, pred_part * weight[:, None])
+                logger.info('Test: {}-{}/{}, {}/{}, {}/{}, {}/{}'.format(*batch_data['aug'], idx + 1, len(data_list), batch_data['end'], batch_data['total'], args.voxel_max, idx_part.shape[0]))
+            # the votes are weighted by the inverse coverage of their pass (tta_batches), so normalizing
+            # the sum once equals averaging the per-augmentation normalized predictions
+            pred = pred / (pred.sum(-1)[:, None]+1e-8)
             loss = criterion(pred, torch.LongTensor(label).cuda(non_blocking=True))  # for reference
             pred = pred.max(1)[1].data.cpu().numpy()
 
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import torch
+
+from util.neighbor import radius_neighbors
+
+
+def room_scene(sizes, seed=0):
+    """ Samples of points on the floor, two walls and some clutter """
+    rng = np.random.RandomState(seed)
+    coord = []
+    for n in sizes:
+        xyz = rng.rand(n, 3) * np.array([1.5, 1.5, 1.0])
+        surface = rng.randint(0, 4, n)
+        xyz[surface == 0, 2] = 0.0
+        xyz[surface == 1, 0] = 0.0
+        xyz[surface == 2, 1] = 0.0
+        coord.append(xyz)
+    return torch.from_numpy(np.concatenate(coord).astype(np.float32)), torch.IntTensor(np.cumsum(sizes))
+
+
+def brute_force_neighbors(coord, offset, radius, max_num_neighbors):
+    coord = coord.numpy().astype(np.float64)
+    n = coord.shape[0]
+    neighbor_idx = np.full((n, max_num_neighbors), n, dtype=np.int64)
+    start = 0
+    for end in offset.tolist():
+        dist = np.sum(np.square(coord[start:end, None] - coord[None, start:end]), -1)
+        for i in range(end - start):
+            idx = np.flatnonzero(dist[i] < radius * radius)
+            idx = idx[np.argsort(dist[i, idx], kind='stable')][:max_num_neighbors]
+            neighbor_idx[start + i, :idx.shape[0]] = idx + start
+        start = end
+    return torch.from_numpy(neighbor_idx)
+
+
+@pytest.mark.parametrize('backend', ['kdtree', 'voxel_hash', 'tp'])
+def test_backend_matches_brute_force(backend):
+    if backend == 'tp':
+        pytest.importorskip('torch_points_kernels')
+    coord, offset = room_scene([1500, 10, 2500])
+    radius, max_num_neighbors = 0.1, 16
+    ref = brute_force_neighbors(coord, offset, radius, max_num_neighbors)
+    neighbor_idx = radius_neighbors(coord, offset, radius, max_num_neighbors, backend)
+    n = coord.shape[0]
+    assert neighbor_idx.shape == ref.shape and neighbor_idx.dtype == torch.long
+    count, ref_count = (neighbor_idx < n).sum(1), (ref < n).sum(1)
+    assert (count == ref_count).all()
+    # padding (n) only after the neighbors
+    assert ((neighbor_idx < n).long().diff(dim=1) <= 0).all()
+    assert (ref_count == max_num_neighbors).any() and (ref_count < max_num_neighbors).any()
+    if backend == 'tp':
+        # tp keeps an arbitrary max_num_neighbors of the points within radius, rows that are not full are exact
+        not_full = ref_count < max_num_neighbors
+        assert (neighbor_idx[not_full].sort(1)[0] == ref[not_full].sort(1)[0]).all()
+    else:
+        assert (neighbor_idx.sort(1)[0] == ref.sort(1)[0]).all()
+
+
+def test_voxel_hash_chunks_and_threads():
+    from util.neighbor import voxel_hash_neighbors
+    coord, offset = room_scene([3000, 1000], seed=1)
+    ref = voxel_hash_neighbors(coord, offset, 0.1, 16, num_threads=1)
+    neighbor_idx = voxel_hash_neighbors(coord, offset, 0.1, 16, chunk_size=500, num_threads=3)
+    assert (neighbor_idx == ref).all()
+
+
+def test_unknown_backend():
+    coord, offset = room_scene([10])
+    with pytest.raises(ValueError):
+        radius_neighbors(coord, offset, 0.1, 4, 'octree')
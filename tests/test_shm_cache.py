@@ -0,0 +1,86 @@
+import os
+import uuid
+
+import numpy as np
+import pytest
+
+SA = pytest.importorskip('SharedArray')
+from util import shm_cache
+from util.shm_cache import SharedSceneCache
+
+
+@pytest.fixture
+def make_cache(monkeypatch):
+    """ Caches under a unique prefix with a controllable MemAvailable, removed after the test """
+    avail = {'bytes': 1 << 40}
+    monkeypatch.setattr(shm_cache, 'mem_available', lambda: avail['bytes'])
+    prefix, caches = 'regionpvt_test_{}'.format(uuid.uuid4().hex[:8]), []
+
+    def make(**kwargs):
+        caches.append(SharedSceneCache(prefix, reserve_gb=1.0, **kwargs))
+        return caches[-1]
+
+    yield make, avail
+    caches[0].cleanup()
+    for suffix in ('.lock', '.owner'):
+        path = os.path.join(shm_cache.SHM_DIR, prefix + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def scene(n, seed):
+    rng = np.random.RandomState(seed)
+    coord = rng.rand(n, 3).astype(np.float32)
+    color = rng.randint(0, 256, (n, 3)).astype(np.float32)
+    label = rng.randint(0, 13, n).astype(np.float32)
+    label[:5] = 255
+    return coord, color, label
+
+
+def test_stores_the_scene_store_dtypes(make_cache):
+    make, _ = make_cache
+    cache = make()
+    scenes = {'a': scene(1000, 0), 'b': scene(500, 1)}
+    cache.populate(sorted(scenes), scenes.get)
+    stored = [SA.attach('shm://' + cache._name('a', c)) for c in shm_cache.COLUMNS]
+    assert [x.dtype for x in stored] == [np.float32, np.uint8, np.uint8]
+    coord, feat, label = cache.get('a')
+    assert np.array_equal(coord, scenes['a'][0]) and np.array_equal(feat, scenes['a'][1]) and np.array_equal(label, scenes['a'][2])
+    # get() returns writable copies, the shared segments stay untouched
+    coord += 1
+    assert np.array_equal(cache.get('a')[0], scenes['a'][0])
+
+
+def test_populate_evicts_when_already_ready(make_cache):
+    make, avail = make_cache
+    cache = make()
+    scenes = {k: scene(100000, i) for i, k in enumerate('abc')}
+    cache.populate(sorted(scenes), scenes.get)
+    assert os.path.exists(cache.ready_path)
+    # a later run finds the cache ready while the node is short of 1 MB below the reserve
+    avail['bytes'] = cache.reserve - (1 << 20)
+    make().populate(sorted(scenes), scenes.get)
+    assert [cache._exists(k) for k in 'abc'] == [True, True, False]
+
+
+def test_one_owner_evicts_and_workers_drop_mappings(make_cache):
+    make, avail = make_cache
+    owner, worker = make(check_interval=3600.0), make(check_interval=0.0)
+    scenes = {k: scene(100000, i) for i, k in enumerate('abc')}
+    owner.populate(sorted(scenes), scenes.get)
+    assert owner.start_monitor() and not worker.start_monitor()
+    assert worker.get('c') is not None and 'c' in worker._attached
+    avail['bytes'] = owner.reserve - (1 << 20)
+    assert owner.check_memory() > 0
+    assert worker.get('c') is None and 'c' not in worker._attached
+    assert worker.get('a') is not None
+
+
+def test_cleanup_keeps_the_lock_files(make_cache):
+    make, _ = make_cache
+    cache = make()
+    cache.populate(['a'], lambda item: scene(100, 0))
+    cache.start_monitor()
+    cache.cleanup()
+    assert cache.segments() == [] and not os.path.exists(cache.ready_path)
+    assert os.path.exists(cache.lock_path) and os.path.exists(cache.owner_path)
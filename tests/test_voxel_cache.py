@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from util.voxel_cache import VoxelCache, voxel_index
+
+
+def test_entries_are_checked_against_voxel_size_and_content(tmp_path):
+    rng = np.random.RandomState(0)
+    coord = rng.rand(5000, 3).astype(np.float32) * 2
+    cache = VoxelCache(str(tmp_path), 0.04)
+    cache.put('scene', coord)
+    idx_sort, count = cache.get('scene', coord)
+    ref_sort, ref_count = voxel_index(coord, 0.04)
+    assert np.array_equal(idx_sort, ref_sort) and np.array_equal(count, ref_count)
+    # same point count, other content: stale for a fresh process
+    moved = coord.copy()
+    moved[0] += 0.5
+    assert VoxelCache(str(tmp_path), 0.04).get('scene', moved) is None
+    # an entry copied under another voxel_size folder is not used for that size
+    other = VoxelCache(str(tmp_path), 0.02)
+    (tmp_path / 'voxel_0.02').mkdir()
+    (tmp_path / 'voxel_0.04' / 'scene.npz').rename(tmp_path / 'voxel_0.02' / 'scene.npz')
+    assert other.get('scene', coord) is None
+    assert VoxelCache(str(tmp_path), 0.04).get('missing', coord) is None
+
+
+def test_entries_without_a_digest_are_stale(tmp_path):
+    coord = np.random.RandomState(0).rand(100, 3).astype(np.float32)
+    (tmp_path / 'voxel_0.04').mkdir()
+    idx_sort, count = voxel_index(coord, 0.04)
+    np.savez(tmp_path / 'voxel_0.04' / 'scene.npz', idx_sort=idx_sort, count=count, num_points=np.int64(100))
+    assert VoxelCache(str(tmp_path), 0.04).get('scene', coord) is None
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from util.voxelize import fnv_hash_vec, ravel_hash_vec, radix_argsort, voxel_counts, voxelize
+
+
+def voxelize_reference(coord, voxel_size, hash_type):
+    """ The previous implementation: per-column hash updates, np.argsort and np.unique """
+    discrete_coord = np.floor(coord / np.array(voxel_size))
+    if hash_type == 'ravel':
+        arr = discrete_coord.copy()
+        arr -= arr.min(0)
+        arr = arr.astype(np.uint64, copy=False)
+        arr_max = arr.max(0).astype(np.uint64) + 1
+        key = np.zeros(arr.shape[0], dtype=np.uint64)
+        for j in range(arr.shape[1] - 1):
+            key += arr[:, j]
+            key *= arr_max[j + 1]
+        key += arr[:, -1]
+    else:
+        arr = discrete_coord.copy().astype(np.uint64, copy=False)
+        key = np.uint64(14695981039346656037) * np.ones(arr.shape[0], dtype=np.uint64)
+        for j in range(arr.shape[1]):
+            key *= np.uint64(1099511628211)
+            key = np.bitwise_xor(key, arr[:, j])
+    idx_sort = np.argsort(key)
+    _, count = np.unique(key[idx_sort], return_counts=True)
+    return key, idx_sort, count
+
+
+@pytest.mark.parametrize('keys', ['fnv', 'small', 'ties', 'single', 'empty'])
+def test_radix_argsort_matches_stable_argsort(keys):
+    rng = np.random.RandomState(0)
+    key = {
+        'fnv': lambda: rng.randint(0, 1 << 63, 20000, dtype=np.int64).astype(np.uint64) * np.uint64(3),
+        'small': lambda: rng.randint(0, 1000, 20000).astype(np.uint64),
+        'ties': lambda: rng.randint(0, 5, 20000).astype(np.uint64) << np.uint64(40),
+        'single': lambda: np.zeros(1, dtype=np.uint64),
+        'empty': lambda: np.zeros(0, dtype=np.uint64),
+    }[keys]()
+    perm = radix_argsort(key) if key.size else np.zeros(0, dtype=np.int64)
+    assert np.array_equal(perm, np.argsort(key, kind='stable'))
+
+
+def test_voxel_counts_matches_unique():
+    key_sort = np.sort(np.random.RandomState(1).randint(0, 50, 1000).astype(np.uint64))
+    assert np.array_equal(voxel_counts(key_sort), np.unique(key_sort, return_counts=True)[1])
+
+
+@pytest.mark.parametrize('hash_type', ['fnv', 'ravel'])
+@pytest.mark.parametrize('sort', ['quick', 'radix'])
+def test_voxelize_matches_previous_implementation(hash_type, sort):
+    coord = np.random.RandomState(2).rand(50000, 3).astype(np.float32) * np.array([4.0, 4.0, 1.0], dtype=np.float32)
+    key_ref, idx_ref, count_ref = voxelize_reference(coord, 0.04, hash_type)
+    discrete = np.floor(coord / np.array(0.04))
+    key = fnv_hash_vec(discrete) if hash_type == 'fnv' else ravel_hash_vec(discrete)
+    assert np.array_equal(key, key_ref)
+    idx_sort, count = voxelize(coord, 0.04, hash_type, mode=1, sort=sort)
+    assert np.array_equal(key[idx_sort], key_ref[idx_ref]) and np.array_equal(count, count_ref)
+    # same points in every voxel, the order inside a voxel is not defined by np.argsort
+    start = np.cumsum(count) - count
+    assert np.array_equal(np.minimum.reduceat(idx_sort, start), np.minimum.reduceat(idx_ref, start))
+    assert np.array_equal(np.add.reduceat(idx_sort, start), np.add.reduceat(idx_ref, start))
+    if sort == 'radix':
+        # stable: the points of a voxel keep their input order
+        assert np.array_equal(idx_sort, np.argsort(key, kind='stable'))
+    # mode 0 draws one point of every voxel
+    uniq = voxelize(coord, 0.04, hash_type, mode=0, sort=sort)
+    assert np.array_equal(np.sort(key[uniq]), np.unique(key_ref))
@@ -20,14 +20,14 @@ from tensorboardX import SummaryWriter
 from util import dataset, config
 from util.s3dis import S3DIS
 from util.scannet_v2 import Scannetv2
-from util.common_util import AverageMeter, intersectionAndUnionGPU, find_free_port, poly_learning_rate, smooth_loss
+from util.common_util import AverageMeter, SyncCounter, intersectionAndUnionGPU, find_free_port, poly_learning_rate, smooth_loss
 from util.data_util import collate_fn, collate_fn_limit
+from util.neighbor import radius_neighbors
 from util import transform
 from util.logger import get_logger
 
 from functools import partial
 from util.lr import MultiStepWithWarmup, PolyLR, PolyLRwithWarmup
-import torch_points_kernels as tp
 
 def get_parser():
     parser = argparse.ArgumentParser(description='PyTorch Point Cloud Semantic Segmentation')
@@ -109,7 +109,8 @@ def main_worker(gpu, ngpus_per_node, argss):
             args.window_sizes, args.up_k, args.grid_sizes, args.quant_sizes, rel_query=args.rel_query, \
             rel_key=args.rel_key, rel_value=args.rel_value, drop_path_rate=args.drop_path_rate, \
             concat_xyz=args.concat_xyz, num_classes=args.classes, \
-            ratio=args.ratio, k=args.k, prev_grid_size=args.grid_size, sigma=1.0, num_layers=args.num_layers, stem_transformer=args.stem_transformer)
+            ratio=args.ratio, k=args.k, prev_grid_size=args.grid_size, sigma=1.0, num_layers=args.num_layers, stem_transformer=args.stem_transformer, \
+            fused_rpe=args.get('fused_rpe', False), checkpoint_stages=args.get('checkpoint_stages', None) or ())
 
     else:
         raise Exception('architecture {} not supported yet'.format(args.arch))
@@ -199,7 +200,7 @@ def main_worker(gpu, ngpus_per_node, argss):
                 transform.RandomJitter(sigma=jitter_sigma, clip=jitter_clip),
                 transform.RandomDropColor(color_augment=args.get('color_augment', 0.0))
             ])
-        train_data = S3DIS(split='train', data_root=args.data_root, test_area=args.test_area, voxel_size=args.voxel_size, voxel_max=args.voxel_max, transform=train_transform, shuffle_index=True, loop=args.loop)
+        train_data = S3DIS(split='train', data_root=args.data_root, test_area=args.test_area, voxel_size=args.voxel_size, voxel_max=args.voxel_max, transform=train_transform, shuffle_index=True, loop=args.loop, store_root=args.get('store_root', None), shm_cache=args.get('shm_cache', False), shm_reserve_gb=args.get('shm_reserve_gb', 8.0), voxel_cache=args.get('voxel_cache', None), voxel_cache_before_aug=args.get('voxel_cache_before_aug', False))
     elif args.data_name == 'scannetv2':
         train_transform = None
         if args.aug:
@@ -215,25 +216,28 @@ def main_worker(gpu, ngpus_per_node, argss):
         if main_process():
             logger.info("scannet. train_split: {}".format(train_split))
 
-        train_data = Scannetv2(split=train_split, data_root=args.data_root, voxel_size=args.voxel_size, voxel_max=args.voxel_max, transform=train_transform, shuffle_index=True, loop=args.loop)
+        train_data = Scannetv2(split=train_split, data_root=args.data_root, voxel_size=args.voxel_size, voxel_max=args.voxel_max, transform=train_transform, shuffle_index=True, loop=args.loop, store_root=args.get('store_root', None), shm_cache=args.get('shm_cache', False), shm_reserve_gb=args.get('shm_reserve_gb', 8.0), voxel_cache=args.get('voxel_cache', None), voxel_cache_before_aug=args.get('voxel_cache_before_aug', False))
     else:
         raise ValueError("The dataset {} is not supported.".format(args.data_name))
 
     if main_process():
             logger.info("train_data samples: '{}'".format(len(train_data)))
+    # radius neighbors of the KPConv stem, computed in the collate_fn of the DataLoader workers
+    sigma = 1.0
+    neighbor_fn = partial(radius_neighbors, radius=2.5 * args.grid_size * sigma, max_num_neighbors=args.max_num_neighbors, backend=args.get('neighbor_backend', 'tp'))
     if args.distributed:
         train_sampler = torch.utils.data.distributed.DistributedSampler(train_data)
     else:
         train_sampler = None
     train_loader = torch.utils.data.DataLoader(train_data, batch_size=args.batch_size, shuffle=(train_sampler is None), num_workers=args.workers, \
-        pin_memory=True, sampler=train_sampler, drop_last=True, collate_fn=partial(collate_fn_limit, max_batch_points=args.max_batch_points, logger=logger if main_process() else None))
+        pin_memory=True, sampler=train_sampler, drop_last=True, collate_fn=partial(collate_fn_limit, max_batch_points=args.max_batch_points, logger=logger if main_process() else None, neighbor_fn=neighbor_fn))
 
     val_transform = None
     if args.data_name == 's3dis':
-        val_data = S3DIS(split='val', data_root=args.data_root, test_area=args.test_area, voxel_size=args.voxel_size, voxel_max=800000, transform=val_transform)
+        val_data = S3DIS(split='val', data_root=args.data_root, test_area=args.test_area, voxel_size=args.voxel_size, voxel_max=800000, transform=val_transform, store_root=args.get('store_root', None), shm_cache=args.get('shm_cache', False), shm_reserve_gb=args.get('shm_reserve_gb', 8.0), voxel_cache=args.get('voxel_cache', None), voxel_cache_before_aug=args.get('voxel_cache_before_aug', False))
         # val_data = S3DIS(split='val', data_root=args.data_root, test_area=args.test_area, voxel_size=args.voxel_size, voxel_max=args.voxel_max, transform=val_transform)      # voxel_max=5000 for calcualte FLOPs, Params and Memeory
     elif args.data_name == 'scannetv2':
-        val_data = Scannetv2(split='val', data_root=args.data_root, voxel_size=args.voxel_size, voxel_max=800000, transform=val_transform)
+        val_data = Scannetv2(split='val', data_root=args.data_root, voxel_size=args.voxel_size, voxel_max=800000, transform=val_transform, store_root=args.get('store_root', None), shm_cache=args.get('shm_cache', False), shm_reserve_gb=args.get('shm_reserve_gb', 8.0), voxel_cache=args.get('voxel_cache', None), voxel_cache_before_aug=args.get('voxel_cache_before_aug', False))
     else:
         raise ValueError("The dataset {} is not supported.".format(args.data_name))
 
@@ -242,7 +246,7 @@ def main_worker(gpu, ngpus_per_node, argss):
     else:
         val_sampler = None
     val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batch_size_val, shuffle=False, num_workers=args.workers, \
-            pin_memory=True, sampler=val_sampler, collate_fn=collate_fn)
+            pin_memory=True, sampler=val_sampler, collate_fn=partial(collate_fn, neighbor_fn=neighbor_fn))
     
     # set scheduler
     if args.scheduler == "MultiStepWithWarmup":
@@ -340,20 +344,15 @@ def train(train_loader, model, criterion, optimizer, epoch, scaler, scheduler):
     intersection_meter = AverageMeter()
     union_meter = AverageMeter()
     target_meter = AverageMeter()
+    sync_meter = AverageMeter()
+    sync_counter = SyncCounter(args.get('sync_debug_mode', False))
     model.train()
     end = time.time()
     max_iter = args.epochs * len(train_loader)
-    for i, (coord, feat, target, offset) in enumerate(train_loader):  # (n, 3), (n, c), (n), (b)
+    for i, (coord, feat, target, offset, batch, neighbor_idx) in enumerate(train_loader):  # (n, 3), (n, c), (n), (b), (n), (n, k)
         data_time.update(time.time() - end)
 
-        offset_ = offset.clone()
-        offset_[1:] = offset_[1:] - offset_[:-1]
-        batch = torch.cat([torch.tensor([ii]*o) for ii,o in enumerate(offset_)], 0).long()
-
-        sigma = 1.0
-        radius = 2.5 * args.grid_size * sigma
-        neighbor_idx = tp.ball_query(radius, args.max_num_neighbors, coord, coord, mode="partial_dense", batch_x=batch, batch_y=batch)[0]
-    
+        # batch and the KPConv neighbors come from the collate_fn in the DataLoader workers
         coord, feat, target, offset = coord.cuda(non_blocking=True), feat.cuda(non_blocking=True), target.cuda(non_blocking=True), offset.cuda(non_blocking=True)
         batch = batch.cuda(non_blocking=True)
         neighbor_idx = neighbor_idx.cuda(non_blocking=True)
@@ -363,22 +362,25 @@ def train(train_loader, model, criterion, optimizer, epoch, scaler, scheduler):
             feat = torch.cat([feat, coord], 1)
 
         use_amp = args.use_amp
-        with torch.cuda.amp.autocast(enabled=use_amp):
-            output = model(feat, coord, offset, batch, neighbor_idx)
-            assert output.shape[1] == args.classes
-            if target.shape[-1] == 1:
-                target = target[:, 0]  # for cls
-            loss = criterion(output, target)
+        # host-device syncs of the forward, backward and optimizer step (sync_debug_mode)
+        with sync_counter:
+            with torch.cuda.amp.autocast(enabled=use_amp):
+                output = model(feat, coord, offset, batch, neighbor_idx)
+                assert output.shape[1] == args.classes
+                if target.shape[-1] == 1:
+                    target = target[:, 0]  # for cls
+                loss = criterion(output, target)
+                
+            optimizer.zero_grad()
             
-        optimizer.zero_grad()
-        
-        if use_amp:
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
-        else:
-            loss.backward()
-            optimizer.step()
+            if use_amp:
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                loss.backward()
+                optimizer.step()
+        sync_meter.update(sync_counter.count)
 
         if args.scheduler_update == 'step':
             scheduler.step()
@@ -428,11 +430,15 @@ def train(train_loader, model, criterion, optimizer, epoch, scaler, scheduler):
                                                           loss_meter=loss_meter,
                                                           lr=lr,
                                                           accuracy=accuracy))
+            if sync_counter.enabled:
+                logger.info('Host syncs {sync_meter.val:.0f} ({sync_meter.avg:.1f}) per step.'.format(sync_meter=sync_meter))
         if main_process():
             writer.add_scalar('loss_train_batch', loss_meter.val, current_iter)
             writer.add_scalar('mIoU_train_batch', np.mean(intersection / (union + 1e-10)), current_iter)
             writer.add_scalar('mAcc_train_batch', np.mean(intersection / (target + 1e-10)), current_iter)
             writer.add_scalar('allAcc_train_batch', accuracy, current_iter)
+            if sync_counter.enabled:
+                writer.add_scalar('syncs_train_batch', sync_meter.val, current_iter)
 
     iou_class = intersection_meter.sum / (union_meter.sum + 1e-10)
     accuracy_class = intersection_meter.sum / (target_meter.sum + 1e-10)
@@ -458,17 +464,10 @@ def validate(val_loader, model, criterion):
 
     model.eval()
     end = time.time()
-    for i, (coord, feat, target, offset) in enumerate(val_loader):
+    for i, (coord, feat, target, offset, batch, neighbor_idx) in enumerate(val_loader):  # (n, 3), (n, c), (n), (b), (n), (n, k)
         data_time.update(time.time() - end)
-    
-        offset_ = offset.clone()
-        offset_[1:] = offset_[1:] - offset_[:-1]
-        batch = torch.cat([torch.tensor([ii]*o) for ii,o in enumerate(offset_)], 0).long()
 
-        sigma = 1.0
-        radius = 2.5 * args.grid_size * sigma
-        neighbor_idx = tp.ball_query(radius, args.max_num_neighbors, coord, coord, mode="partial_dense", batch_x=batch, batch_y=batch)[0]
-    
+        # batch and the KPConv neighbors come from the collate_fn in the DataLoader workers
         coord, feat, target, offset = coord.cuda(non_blocking=True), feat.cuda(non_blocking=True), target.cuda(non_blocking=True), offset.cuda(non_blocking=True)
         batch = batch.cuda(non_blocking=True)
         neighbor_idx = neighbor_idx.cuda(non_blocking=True)
@@ -0,0 +1,47 @@
+import threading
+import collections
+
+import torch
+
+
+_CACHE_SIZE = 8
+_cache = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def offset2batch(offset):
+    """ Per-point batch index of a batch given as cumulative offsets.
+
+    Args:
+        offset: int tensor [B], end of every sample (e.g. [n0, n0 + n1, ...]).
+    Returns:
+        long tensor [N] on the device of offset, [0] * n0 + [1] * n1 + ...
+
+        The result of the last few offset tensors is cached. The cache holds a reference to
+        the offset tensor, so the key (id, version counter) cannot be reused by another tensor,
+        and an in-place change of the offsets bumps the version and misses.
+    """
+    try:
+        key = (id(offset), offset._version)
+    except RuntimeError:  # inference-mode tensors have no version counter
+        key = None
+    if key is not None:
+        with _lock:
+            hit = _cache.get(key)
+        if hit is not None and hit[0] is offset:
+            return hit[1]
+
+    count = torch.diff(offset.long(), prepend=offset.new_zeros(1, dtype=torch.long))
+    batch = torch.repeat_interleave(torch.arange(count.shape[0], device=offset.device), count)
+
+    if key is not None:
+        with _lock:
+            _cache[key] = (offset, batch)
+            while len(_cache) > _CACHE_SIZE:
+                _cache.popitem(last=False)
+    return batch
+
+
+def batch2offset(batch):
+    """ Inverse of offset2batch for a sorted batch index """
+    return torch.cumsum(batch.bincount(), dim=0).int()
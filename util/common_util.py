@@ -1,4 +1,5 @@
 import os
+import warnings
 import numpy as np
 from PIL import Image
 
@@ -28,6 +29,29 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
+class SyncCounter(object):
+    """Counts the host-device synchronizations of the CUDA ops run in the context (torch.cuda.set_sync_debug_mode)"""
+    def __init__(self, enabled=True):
+        self.enabled = enabled and torch.cuda.is_available()
+        self.count = 0
+
+    def __enter__(self):
+        self.count = 0
+        if self.enabled:
+            self._catcher = warnings.catch_warnings(record=True)
+            self._records = self._catcher.__enter__()
+            warnings.simplefilter('always')
+            torch.cuda.set_sync_debug_mode('warn')
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            torch.cuda.set_sync_debug_mode('default')
+            self._catcher.__exit__(*exc)
+            self.count = sum('synchronizing CUDA operation' in str(w.message) for w in self._records)
+        return False
+
+
 def step_learning_rate(optimizer, base_lr, epoch, step_epoch, multiplier=0.1, clip=1e-6):
     """Sets the learning rate to the base LR decayed by 10 every step epochs"""
     lr = max(base_lr * (multiplier ** (epoch // step_epoch)), clip)
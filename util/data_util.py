@@ -1,10 +1,12 @@
 import numpy as np
 import random
 import SharedArray as SA
+from scipy.spatial import cKDTree
 
 import torch
 
-from util.voxelize import voxelize
+from util.voxelize import voxelize, voxel_sample
+from util.batch_util import offset2batch
 # from voxelize import voxelize
 
 
@@ -59,7 +61,7 @@ def collate_fn_limit_mix3d(batch, max_batch_points, logger, p):
     # return torch.cat(coord_mix3d), torch.cat(feat_mix3d), torch.cat(label_mix3d), torch.IntTensor(offset_mix3d)
 
 
-def collate_fn_limit(batch, max_batch_points, logger):
+def collate_fn_limit(batch, max_batch_points, logger, neighbor_fn=None):
     coord, feat, label = list(zip(*batch))
     offset, count = [], 0
     # print("coord:", len(coord))
@@ -77,10 +79,13 @@ def collate_fn_limit(batch, max_batch_points, logger):
         s_now = sum([x.shape[0] for x in coord[:k]])
         logger.warning("batch_size shortened from {} to {}, points from {} to {}".format(len(batch), k, s, s_now))
 
-    return torch.cat(coord[:k]), torch.cat(feat[:k]), torch.cat(label[:k]), torch.IntTensor(offset[:k])
+    coord, feat, label, offset = torch.cat(coord[:k]), torch.cat(feat[:k]), torch.cat(label[:k]), torch.IntTensor(offset[:k])
+    if neighbor_fn is not None:
+        return coord, feat, label, offset, offset2batch(offset), neighbor_fn(coord, offset)
+    return coord, feat, label, offset
     # return torch.cat(coord), torch.cat(feat), torch.cat(label), torch.IntTensor(offset)
 
-def collate_fn(batch):
+def collate_fn(batch, neighbor_fn=None):
     coord, feat, label = list(zip(*batch))
     offset, count = [], 0
     # print("coord:", len(coord))
@@ -88,7 +93,47 @@ def collate_fn(batch):
         # print("item shape:",item.shape)
         count += item.shape[0]
         offset.append(count)
-    return torch.cat(coord), torch.cat(feat), torch.cat(label), torch.IntTensor(offset)
+    coord, feat, label, offset = torch.cat(coord), torch.cat(feat), torch.cat(label), torch.IntTensor(offset)
+    if neighbor_fn is not None:
+        # neighbors of the KPConv stem, computed in the DataLoader workers (see util/neighbor.py)
+        return coord, feat, label, offset, offset2batch(offset), neighbor_fn(coord, offset)
+    return coord, feat, label, offset
+
+
+def crop_nearest(coord, init_idx, voxel_max):
+    """ Indices of the voxel_max points closest to coord[init_idx], ordered by distance.
+        Same result as np.argsort(dist)[:voxel_max] (up to ties), with an O(N) partition instead of a full sort.
+    """
+    dist = np.sum(np.square(coord - coord[init_idx]), 1)
+    if voxel_max >= dist.shape[0]:
+        return np.argsort(dist)
+    crop_idx = np.argpartition(dist, voxel_max - 1)[:voxel_max]
+    return crop_idx[np.argsort(dist[crop_idx])]
+
+
+def plan_crops(coord, voxel_max):
+    """ Covering crops of a test fragment with more than voxel_max points.
+
+        Each crop is the voxel_max nearest points of the point with the lowest score, the score of
+        the cropped points then grows with their closeness to the crop center, until every point is
+        covered. The kd-tree is built once per fragment and coverage is a boolean mask, so a crop
+        costs one k-nearest query instead of a full sort and a unique of all crops so far.
+    Returns:
+        list of index arrays into coord, each sorted by distance to its center.
+    """
+    tree = cKDTree(coord)
+    score = np.random.rand(coord.shape[0]) * 1e-3
+    covered = np.zeros(coord.shape[0], dtype=bool)
+    num_covered, crops = 0, []
+    while num_covered < coord.shape[0]:
+        init_idx = np.argmin(score)
+        dist, idx_crop = tree.query(coord[init_idx], k=voxel_max)
+        dist = np.square(dist)
+        score[idx_crop] += np.square(1 - dist / np.max(dist))
+        num_covered += np.count_nonzero(~covered[idx_crop])
+        covered[idx_crop] = True
+        crops.append(idx_crop)
+    return crops
 
 
 def area_crop(coord, area_rate, split='train'):
@@ -131,7 +176,7 @@ def data_prepare(coord, feat, label, split='train', voxel_size=0.04, voxel_max=N
         coord, feat, label = coord[uniq_idx], feat[uniq_idx], label[uniq_idx]
     if voxel_max and label.shape[0] > voxel_max:
         init_idx = np.random.randint(label.shape[0]) if 'train' in split else label.shape[0] // 2
-        crop_idx = np.argsort(np.sum(np.square(coord - coord[init_idx]), 1))[:voxel_max]
+        crop_idx = crop_nearest(coord, init_idx, voxel_max)
         coord, feat, label = coord[crop_idx], feat[crop_idx], label[crop_idx]
     if shuffle_index:
         shuf_idx = np.arange(coord.shape[0])
@@ -146,7 +191,13 @@ def data_prepare(coord, feat, label, split='train', voxel_size=0.04, voxel_max=N
     return coord, feat, label
 
 
-def data_prepare_v101(coord, feat, label, split='train', voxel_size=0.04, voxel_max=None, transform=None, shuffle_index=False):
+def data_prepare_v101(coord, feat, label, split='train', voxel_size=0.04, voxel_max=None, transform=None, shuffle_index=False, voxel_index=None):
+    if voxel_size and voxel_index is not None:
+        # (idx_sort, count) of the raw scene precomputed by util/voxel_cache.py: only the per-voxel draw
+        # is left, and the transform is applied to the voxelized points
+        uniq_idx = voxel_sample(*voxel_index)
+        coord, feat, label = coord[uniq_idx], feat[uniq_idx], label[uniq_idx]
+        voxel_size = None
     if transform:
         # coord, feat, label = transform(coord, feat, label)
         coord, feat = transform(coord, feat)
@@ -157,7 +208,7 @@ def data_prepare_v101(coord, feat, label, split='train', voxel_size=0.04, voxel_
         coord, feat, label = coord[uniq_idx], feat[uniq_idx], label[uniq_idx]
     if voxel_max and label.shape[0] > voxel_max:
         init_idx = np.random.randint(label.shape[0]) if 'train' in split else label.shape[0] // 2
-        crop_idx = np.argsort(np.sum(np.square(coord - coord[init_idx]), 1))[:voxel_max]
+        crop_idx = crop_nearest(coord, init_idx, voxel_max)
         coord, feat, label = coord[crop_idx], feat[crop_idx], label[crop_idx]
     if shuffle_index:
         shuf_idx = np.arange(coord.shape[0])
@@ -172,7 +223,13 @@ def data_prepare_v101(coord, feat, label, split='train', voxel_size=0.04, voxel_
     return coord, feat, label
 
 
-def data_prepare_scannet(coord, feat, label, split='train', voxel_size=0.04, voxel_max=None, transform=None, shuffle_index=False):
+def data_prepare_scannet(coord, feat, label, split='train', voxel_size=0.04, voxel_max=None, transform=None, shuffle_index=False, voxel_index=None):
+    if voxel_size and voxel_index is not None:
+        # (idx_sort, count) of the raw scene precomputed by util/voxel_cache.py: only the per-voxel draw
+        # is left, and the transform is applied to the voxelized points
+        uniq_idx = voxel_sample(*voxel_index)
+        coord, feat, label = coord[uniq_idx], feat[uniq_idx], label[uniq_idx]
+        voxel_size = None
     if transform:
         # coord, feat, label = transform(coord, feat, label)
         coord, feat = transform(coord, feat)
@@ -183,7 +240,7 @@ def data_prepare_scannet(coord, feat, label, split='train', voxel_size=0.04, vox
         coord, feat, label = coord[uniq_idx], feat[uniq_idx], label[uniq_idx]
     if voxel_max and label.shape[0] > voxel_max:
         init_idx = np.random.randint(label.shape[0]) if 'train' in split else label.shape[0] // 2
-        crop_idx = np.argsort(np.sum(np.square(coord - coord[init_idx]), 1))[:voxel_max]
+        crop_idx = crop_nearest(coord, init_idx, voxel_max)
         coord, feat, label = coord[crop_idx], feat[crop_idx], label[crop_idx]
     if shuffle_index:
         shuf_idx = np.arange(coord.shape[0])
@@ -252,7 +309,7 @@ def data_prepare_v103(coord, feat, label, split='train', voxel_size=0.04, voxel_
             crop_idx = np.where((coord[:, 0] >= x_s) & (coord[:, 0] <= x_e) & (coord[:, 1] >= y_s) & (coord[:, 1] <= y_e))[0]
             if crop_idx.shape[0] > 0:
                 init_idx = crop_idx[np.random.randint(crop_idx.shape[0])] if 'train' in split else label.shape[0] // 2
-                crop_idx = np.argsort(np.sum(np.square(coord - coord[init_idx]), 1))[:voxel_max]
+                crop_idx = crop_nearest(coord, init_idx, voxel_max)
                 coord, feat, label = coord[crop_idx], feat[crop_idx], label[crop_idx]
                 break
     if shuffle_index:
@@ -287,7 +344,7 @@ def data_prepare_v104(coord, feat, label, split='train', voxel_size=0.04, voxel_
             crop_idx = np.where((coord[:, 0] >= x_s) & (coord[:, 0] <= x_e) & (coord[:, 1] >= y_s) & (coord[:, 1] <= y_e))[0]
             if crop_idx.shape[0] > 0:
                 init_idx = crop_idx[np.random.randint(crop_idx.shape[0])] if 'train' in split else label.shape[0] // 2
-                crop_idx = np.argsort(np.sum(np.square(coord - coord[init_idx]), 1))[:voxel_max]
+                crop_idx = crop_nearest(coord, init_idx, voxel_max)
                 coord, feat, label = coord[crop_idx], feat[crop_idx], label[crop_idx]
                 break
     if shuffle_index:
@@ -313,7 +370,7 @@ def data_prepare_v105(coord, feat, label, split='train', voxel_size=0.04, voxel_
         coord, feat, label = coord[uniq_idx], feat[uniq_idx], label[uniq_idx]
     if voxel_max and label.shape[0] > voxel_max:
         init_idx = np.random.randint(label.shape[0]) if 'train' in split else label.shape[0] // 2
-        crop_idx = np.argsort(np.sum(np.square(coord - coord[init_idx]), 1))[:voxel_max]
+        crop_idx = crop_nearest(coord, init_idx, voxel_max)
         coord, feat, label = coord[crop_idx], feat[crop_idx], label[crop_idx]
     if shuffle_index:
         shuf_idx = np.arange(coord.shape[0])
@@ -0,0 +1,139 @@
+import os
+import itertools
+import numpy as np
+import torch
+from multiprocessing.pool import ThreadPool
+from scipy.spatial import cKDTree
+
+from util.batch_util import offset2batch
+
+
+def tp_neighbors(coord, offset, radius, max_num_neighbors):
+    import torch_points_kernels as tp
+    batch = offset2batch(offset)
+    return tp.ball_query(radius, max_num_neighbors, coord, coord, mode="partial_dense", batch_x=batch, batch_y=batch)[0]
+
+
+def kdtree_neighbors(coord, offset, radius, max_num_neighbors):
+    """ cKDTree per sample, nearest max_num_neighbors within radius """
+    coord = coord.numpy()
+    n = coord.shape[0]
+    neighbor_idx = np.full((n, max_num_neighbors), n, dtype=np.int64)
+    start = 0
+    for end in offset.tolist():
+        tree = cKDTree(coord[start:end])
+        _, idx = tree.query(coord[start:end], k=max_num_neighbors, distance_upper_bound=radius, workers=-1)
+        idx = idx.reshape(end - start, max_num_neighbors)
+        # missing neighbors come back as end - start
+        neighbor_idx[start:end] = np.where(idx < end - start, idx + start, n)
+        start = end
+    return torch.from_numpy(neighbor_idx)
+
+
+def voxel_hash_neighbors(coord, offset, radius, max_num_neighbors, chunk_size=16384, num_threads=None):
+    """ Radius search on a hash grid with cells of size radius.
+
+        Points are sorted by (sample, cell) key, the candidates of a query are the points of the 27
+        cells around it (9 ranges found with searchsorted), and the nearest max_num_neighbors within
+        radius are kept. Queries are processed in chunks on a thread pool (NumPy releases the GIL).
+    """
+    coord = coord.numpy()
+    n = coord.shape[0]
+    neighbor_idx = np.full((n, max_num_neighbors), n, dtype=np.int64)
+    if n == 0:
+        return torch.from_numpy(neighbor_idx)
+    batch = offset2batch(offset).numpy()
+    cell = np.floor((coord - coord.min(0)) / radius).astype(np.int64) + 1  # + 1: the -1 neighbor cell stays >= 0
+    dims = cell.max(0) + 2
+    key = ((batch * dims[0] + cell[:, 0]) * dims[1] + cell[:, 1]) * dims[2] + cell[:, 2]
+    order = np.argsort(key, kind='stable')
+    key_sort = key[order]
+    # the 3 cells (z - 1, z, z + 1) of an (x, y) column are consecutive keys, so the 27 neighbor
+    # cells are 9 contiguous ranges of the sorted keys
+    shifts = np.array([(dx * dims[1] + dy) * dims[2] for dx, dy in itertools.product((-1, 0, 1), repeat=2)], dtype=np.int64)
+    radius2 = radius * radius
+    num_threads = min(4, os.cpu_count() or 1) if num_threads is None else num_threads
+
+    def search(start):
+        query = np.arange(start, min(start + chunk_size, n))
+        column_key = key[query][:, None] + shifts[None, :]  # [m, 9]
+        lo = np.searchsorted(key_sort, column_key - 1, 'left').ravel()
+        length = np.searchsorted(key_sort, column_key + 1, 'right').ravel() - lo
+        # flatten the candidate ranges of all (query, column) pairs
+        query_id = np.repeat(np.repeat(query, shifts.shape[0]), length)
+        pos = np.arange(length.sum()) + np.repeat(lo - (np.cumsum(length) - length), length)
+        candidate = order[pos]
+        dist = np.sum(np.square(coord[candidate] - coord[query_id]), 1)
+        mask = dist < radius2
+        query_id, candidate, dist = query_id[mask], candidate[mask], dist[mask]
+        # pairs are grouped by query; only queries with more than max_num_neighbors candidates
+        # need their group sorted by distance (nearest first) before the cut
+        count = np.bincount(query_id - start, minlength=query.shape[0])
+        over = np.flatnonzero(count[query_id - start] > max_num_neighbors)
+        if over.size:
+            idx = np.lexsort((dist[over], query_id[over]))
+            candidate[over] = candidate[over[idx]]
+        rank = np.arange(query_id.shape[0]) - np.repeat(np.cumsum(count) - count, count)
+        mask = rank < max_num_neighbors
+        neighbor_idx[query_id[mask], rank[mask]] = candidate[mask]
+
+    starts = range(0, n, chunk_size)
+    if num_threads > 1 and len(starts) > 1:
+        with ThreadPool(num_threads) as pool:
+            pool.map(search, starts)
+    else:
+        for start in starts:
+            search(start)
+    return torch.from_numpy(neighbor_idx)
+
+
+# fn(coord [N, 3] float cpu, offset [B] int cpu, radius, max_num_neighbors) -> [N, max_num_neighbors] long,
+# the tp.ball_query partial_dense layout: global indices, padded with N (the KPConv shadow point)
+NEIGHBOR_BACKENDS = {
+    'tp': tp_neighbors,
+    'kdtree': kdtree_neighbors,
+    'voxel_hash': voxel_hash_neighbors,
+}
+
+
+def radius_neighbors(coord, offset, radius, max_num_neighbors, backend='tp'):
+    if backend not in NEIGHBOR_BACKENDS:
+        raise ValueError("neighbor backend {} is not supported, use one of {}".format(backend, list(NEIGHBOR_BACKENDS)))
+    return NEIGHBOR_BACKENDS[backend](coord, offset, radius, max_num_neighbors)
+
+
+if __name__ == '__main__':
+    # benchmark of the backends on voxelized scenes (parity: tests/test_neighbor.py)
+    import time
+    from util.voxelize import voxelize
+
+    grid_size, max_num_neighbors = 0.04, 34
+    radius = 2.5 * grid_size
+    print('{} cpu cores'.format(os.cpu_count()))
+    for num_points in [40000, 160000]:
+        coord, offset, count = [], [], 0
+        while count < num_points:
+            # room-like samples: points on the floor, walls and some clutter, voxelized at grid_size
+            n = 400000
+            xyz = np.random.rand(n, 3) * np.array([6.0, 6.0, 3.0])
+            surface = np.random.randint(0, 4, n)
+            xyz[surface == 0, 2] = 0.0
+            xyz[surface == 1, 0] = 0.0
+            xyz[surface == 2, 1] = 0.0
+            xyz = xyz[voxelize(xyz, grid_size)]
+            xyz = xyz[:min(xyz.shape[0], num_points - count)]
+            coord.append(xyz), offset.append(count + xyz.shape[0])
+            count += xyz.shape[0]
+        coord = torch.from_numpy(np.concatenate(coord).astype(np.float32))
+        offset = torch.IntTensor(offset)
+
+        for backend in NEIGHBOR_BACKENDS:
+            try:
+                times = []
+                for _ in range(3):
+                    t = time.time()
+                    radius_neighbors(coord, offset, radius, max_num_neighbors, backend)
+                    times.append(time.time() - t)
+                print('n={} ({} samples) backend={}: {:.3f}s (best of 3)'.format(coord.shape[0], offset.shape[0], backend, min(times)))
+            except ImportError as e:
+                print('n={} backend={}: not available ({})'.format(coord.shape[0], backend, e))
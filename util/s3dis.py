@@ -8,6 +8,9 @@ from torch.utils.data import Dataset
 from util.voxelize import voxelize
 from util.data_util import sa_create, collate_fn
 from util.data_util import data_prepare_v101 as data_prepare
+from util.scene_store import SceneStore
+from util.shm_cache import SharedSceneCache, cache_prefix
+from util.voxel_cache import VoxelCache
 
 # from voxelize import voxelize
 # from data_util import sa_create, collate_fn
@@ -15,34 +18,53 @@ from util.data_util import data_prepare_v101 as data_prepare
 
 
 class S3DIS(Dataset):
-    def __init__(self, split='train', data_root='trainval', test_area=5, voxel_size=0.04, voxel_max=None, transform=None, shuffle_index=False, loop=1):
+    def __init__(self, split='train', data_root='trainval', test_area=5, voxel_size=0.04, voxel_max=None, transform=None, shuffle_index=False, loop=1, store_root=None, shm_cache=False, shm_reserve_gb=8.0, voxel_cache=None, voxel_cache_before_aug=False):
         super().__init__()
         self.split, self.voxel_size, self.transform, self.voxel_max, self.shuffle_index, self.loop = split, voxel_size, transform, voxel_max, shuffle_index, loop
-        data_list = sorted(os.listdir(data_root))
-        data_list = [item[:-4] for item in data_list if 'Area_' in item]
+        # packed store (util/scene_store.py), read with zero-copy slices instead of one np.load per sample
+        self.store = SceneStore(store_root) if store_root else None
+        if self.store is not None:
+            data_list = sorted(self.store.names)
+        else:
+            data_list = sorted(os.listdir(data_root))
+            data_list = [item[:-4] for item in data_list if 'Area_' in item]
         if split == 'train':
             self.data_list = [item for item in data_list if not 'Area_{}'.format(test_area) in item]
         else:
             self.data_list = [item for item in data_list if 'Area_{}'.format(test_area) in item]
         self.data_root = data_root
-        # for item in self.data_list:
-        #     if not os.path.exists("/dev/shm/{}".format(item)):
-        #         data_path = os.path.join(data_root, item + '.npy')
-        #         data = np.load(data_path)  # xyzrgbl, N*7
-        #         sa_create("shm://{}".format(item), data)
+        # opt-in: rooms staged once per node in /dev/shm and attached read-only by all ranks and workers
+        self.cache = None
+        if shm_cache:
+            self.cache = SharedSceneCache(cache_prefix('s3dis', store_root or data_root, split, test_area), reserve_gb=shm_reserve_gb, color_mode='rgb', ignore_label=255)
+            self.cache.populate(self.data_list, self.load_scene)
+            self.cache.start_monitor()
+        # keys of util/shm_cache.py and util/voxel_cache.py, and the matching arguments of load_scene
+        self.data_keys = self.load_args = self.data_list
+        # the cached voxelization is of the raw scene: with a transform it is only used if the points may be
+        # voxelized before the augmentation (voxel_cache_before_aug), which changes the training samples
+        self.voxel_cache = VoxelCache(voxel_cache, voxel_size) if voxel_cache and (transform is None or voxel_cache_before_aug) else None
         self.data_idx = np.arange(len(self.data_list))
         print("Totally {} samples in {} set.".format(len(self.data_idx), split))
 
+    def load_scene(self, item):
+        if self.store is not None:
+            return self.store.load(item)
+        data_path = os.path.join(self.data_root, item + '.npy')
+        data = np.load(data_path)  # xyzrgbl, N*7
+        return data[:, 0:3], data[:, 3:6], data[:, 6]
+
     def __getitem__(self, idx):
         data_idx = self.data_idx[idx % len(self.data_idx)]
 
-        # data = SA.attach("shm://{}".format(self.data_list[data_idx])).copy()
         item = self.data_list[data_idx]
-        data_path = os.path.join(self.data_root, item + '.npy')
-        data = np.load(data_path)
-
-        coord, feat, label = data[:, 0:3], data[:, 3:6], data[:, 6]
-        coord, feat, label = data_prepare(coord, feat, label, self.split, self.voxel_size, self.voxel_max, self.transform, self.shuffle_index)
+        data = self.cache.get(item) if self.cache is not None else None
+        if data is not None:
+            coord, feat, label = data
+        else:
+            coord, feat, label = self.load_scene(item)
+        voxel_index = self.voxel_cache.get(item, coord) if self.voxel_cache is not None else None
+        coord, feat, label = data_prepare(coord, feat, label, self.split, self.voxel_size, self.voxel_max, self.transform, self.shuffle_index, voxel_index)
         return coord, feat, label
 
     def __len__(self):
@@ -8,10 +8,13 @@ from torch.utils.data import Dataset
 from util.voxelize import voxelize
 from util.data_util import sa_create, collate_fn
 from util.data_util import data_prepare_scannet as data_prepare
+from util.scene_store import SceneStore
+from util.shm_cache import SharedSceneCache, cache_prefix
+from util.voxel_cache import VoxelCache
 import glob
 
 class Scannetv2(Dataset):
-    def __init__(self, split='train', data_root='trainval', voxel_size=0.04, voxel_max=None, transform=None, shuffle_index=False, loop=1):
+    def __init__(self, split='train', data_root='trainval', voxel_size=0.04, voxel_max=None, transform=None, shuffle_index=False, loop=1, store_root=None, shm_cache=False, shm_reserve_gb=8.0, voxel_cache=None, voxel_cache_before_aug=False):
         super().__init__()
 
         self.split = split
@@ -23,28 +26,63 @@ class Scannetv2(Dataset):
         self.loop = loop
 
         if split == "train" or split == 'val':
-            self.data_list = glob.glob(os.path.join(data_root, split, "*.pth"))
+            sub_splits = [split]
         elif split == 'trainval':
-            self.data_list = glob.glob(os.path.join(data_root, "train", "*.pth")) + glob.glob(os.path.join(data_root, "val", "*.pth"))
+            sub_splits = ["train", "val"]
         else:
             raise ValueError("no such split: {}".format(split))
+
+        # packed stores (util/scene_store.py) mirror the train/val folders of data_root
+        self.stores = {}
+        if store_root:
+            self.stores = {s: SceneStore(os.path.join(store_root, s)) for s in sub_splits}
+            self.data_list = [(s, name) for s in sub_splits for name in self.stores[s].names]
+        else:
+            self.data_list = []
+            for s in sub_splits:
+                self.data_list += glob.glob(os.path.join(data_root, s, "*.pth"))
+
+        # opt-in: scenes staged once per node in /dev/shm and attached read-only by all ranks and workers
+        self.data_keys = [self.scene_key(i) for i in range(len(self.data_list))]
+        self.load_args = list(range(len(self.data_list)))
+        self.cache = None
+        if shm_cache:
+            key2idx = {key: i for i, key in enumerate(self.data_keys)}
+            self.cache = SharedSceneCache(cache_prefix('scannetv2', store_root or data_root, split), reserve_gb=shm_reserve_gb, color_mode='centered', ignore_label=-100)
+            self.cache.populate(self.data_keys, lambda key: self.load_scene(key2idx[key]))
+            self.cache.start_monitor()
+        # the cached voxelization is of the raw scene: with a transform it is only used if the points may be
+        # voxelized before the augmentation (voxel_cache_before_aug), which changes the training samples
+        self.voxel_cache = VoxelCache(voxel_cache, voxel_size) if voxel_cache and (transform is None or voxel_cache_before_aug) else None
             
         print("voxel_size: ", voxel_size)
         print("Totally {} samples in {} set.".format(len(self.data_list), split))
 
-    def __getitem__(self, idx):
-        # data_idx = self.data_idx[idx % len(self.data_idx)]
+    def scene_key(self, data_idx):
+        if self.stores:
+            return '{}_{}'.format(*self.data_list[data_idx])
+        return os.path.basename(self.data_list[data_idx])[:-4]
 
-        # data = SA.attach("shm://{}".format(self.data_list[data_idx])).copy()
-        data_idx = idx % len(self.data_list)
+    def load_scene(self, data_idx):
+        if self.stores:
+            sub_split, name = self.data_list[data_idx]
+            return self.stores[sub_split].load(name)
         data_path = self.data_list[data_idx]
         data = torch.load(data_path)
+        return data[0], data[1], data[2]
 
-        coord, feat = data[0], data[1]
-        if self.split != 'test':
-            label = data[2]
+    def __getitem__(self, idx):
+        # data_idx = self.data_idx[idx % len(self.data_idx)]
+
+        data_idx = idx % len(self.data_list)
+        data = self.cache.get(self.data_keys[data_idx]) if self.cache is not None else None
+        if data is not None:
+            coord, feat, label = data
+        else:
+            coord, feat, label = self.load_scene(data_idx)
+        voxel_index = self.voxel_cache.get(self.data_keys[data_idx], coord) if self.voxel_cache is not None else None
 
-        coord, feat, label = data_prepare(coord, feat, label, self.split, self.voxel_size, self.voxel_max, self.transform, self.shuffle_index)
+        coord, feat, label = data_prepare(coord, feat, label, self.split, self.voxel_size, self.voxel_max, self.transform, self.shuffle_index, voxel_index)
         return coord, feat, label
 
     def __len__(self):
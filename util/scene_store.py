@@ -0,0 +1,160 @@
+import os
+import glob
+import json
+import argparse
+import numpy as np
+
+import torch
+
+
+# columns of a packed store, all written as plain .npy files so that they can be opened with mmap
+COORD_FILE, COLOR_FILE, LABEL_FILE = 'coord.npy', 'color.npy', 'label.npy'
+OFFSET_FILE, NAME_FILE, META_FILE = 'offsets.npy', 'names.txt', 'meta.json'
+
+# label value used in the uint8 label column for ignored points
+STORE_IGNORE = 255
+
+
+def load_raw_scene(data_path):
+    """ Load one preprocessed scene as (coord, color, label).
+        s3dis: xyzrgbl .npy (N*7), color in [0, 255]
+        scannetv2: (coord, feat, label) .pth tuple, color in [-1, 1]
+    """
+    if data_path.endswith('.npy'):
+        data = np.load(data_path)
+        return data[:, 0:3], data[:, 3:6], data[:, 6]
+    data = torch.load(data_path)
+    return data[0], data[1], data[2]
+
+
+def encode_scene(coord, color, label, color_mode='rgb', ignore_label=255):
+    """ (coord, color, label) in the value range of the raw files -> float32 coord, uint8 color, uint8 label """
+    if color_mode == 'centered':
+        color = (color + 1.0) * 127.5
+    label = np.where(label == ignore_label, STORE_IGNORE, label)
+    assert label.min() >= 0 and label.max() <= STORE_IGNORE, 'labels do not fit in uint8'
+    return np.ascontiguousarray(coord, dtype=np.float32), np.clip(np.rint(color), 0, 255).astype(np.uint8), label.astype(np.uint8)
+
+
+def decode_scene(coord, color, label, color_mode='rgb', ignore_label=255):
+    """ Inverse of encode_scene, as writable float32 coord / feat and int64 label """
+    coord = np.array(coord, dtype=np.float32)
+    if color_mode == 'centered':
+        feat = color.astype(np.float32) / 127.5 - 1.0
+    else:
+        feat = color.astype(np.float32)
+    label = label.astype(np.int64)
+    label[label == STORE_IGNORE] = ignore_label
+    return coord, feat, label
+
+
+def pack_scenes(data_paths, store_root, color_mode='rgb', ignore_label=255):
+    """ Pack a list of scenes into a single columnar store.
+
+    Args:
+        data_paths: list of .npy / .pth scene files.
+        store_root: output directory.
+        color_mode: 'rgb' if colors are stored in [0, 255], 'centered' if in [-1, 1] (scannetv2).
+        ignore_label: label of ignored points in the source data, stored as 255.
+    """
+    assert color_mode in ['rgb', 'centered']
+    if not os.path.exists(store_root):
+        os.makedirs(store_root)
+    names = [os.path.basename(p)[:-4] for p in data_paths]
+
+    # first pass: scene sizes, to allocate the columns once
+    counts = []
+    for data_path in data_paths:
+        if data_path.endswith('.npy'):
+            counts.append(np.load(data_path, mmap_mode='r').shape[0])
+        else:
+            counts.append(load_raw_scene(data_path)[0].shape[0])
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    n = int(offsets[-1])
+
+    coord_all = np.lib.format.open_memmap(os.path.join(store_root, COORD_FILE), mode='w+', dtype=np.float32, shape=(n, 3))
+    color_all = np.lib.format.open_memmap(os.path.join(store_root, COLOR_FILE), mode='w+', dtype=np.uint8, shape=(n, 3))
+    label_all = np.lib.format.open_memmap(os.path.join(store_root, LABEL_FILE), mode='w+', dtype=np.uint8, shape=(n,))
+
+    # second pass: stream every scene into its slice
+    for i, data_path in enumerate(data_paths):
+        print('{}/{}: {}'.format(i + 1, len(data_paths), data_path))
+        coord, color, label = encode_scene(*load_raw_scene(data_path), color_mode=color_mode, ignore_label=ignore_label)
+        s, e = offsets[i], offsets[i + 1]
+        coord_all[s:e] = coord
+        color_all[s:e] = color
+        label_all[s:e] = label
+    coord_all.flush(), color_all.flush(), label_all.flush()
+    del coord_all, color_all, label_all
+
+    np.save(os.path.join(store_root, OFFSET_FILE), offsets)
+    with open(os.path.join(store_root, NAME_FILE), 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    with open(os.path.join(store_root, META_FILE), 'w') as f:
+        json.dump({'color_mode': color_mode, 'ignore_label': ignore_label, 'num_scenes': len(names), 'num_points': n}, f)
+    print("Packed {} scenes ({} points) into {}.".format(len(names), n, store_root))
+
+
+class SceneStore(object):
+    """ Read-only, memory-mapped view of a store written by pack_scenes.
+
+        The columns are opened lazily so that every DataLoader worker maps the files
+        after fork instead of inheriting file handles from the parent process.
+    """
+    def __init__(self, store_root):
+        self.store_root = store_root
+        self.names = [line.rstrip('\n') for line in open(os.path.join(store_root, NAME_FILE)) if line.strip()]
+        self.name2idx = {name: i for i, name in enumerate(self.names)}
+        self.offsets = np.load(os.path.join(store_root, OFFSET_FILE))
+        with open(os.path.join(store_root, META_FILE)) as f:
+            self.meta = json.load(f)
+        self._columns = None
+
+    def _open(self):
+        if self._columns is None:
+            self._columns = [np.load(os.path.join(self.store_root, name), mmap_mode='r') for name in (COORD_FILE, COLOR_FILE, LABEL_FILE)]
+        return self._columns
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.name2idx
+
+    def slices(self, name):
+        """ Zero-copy (read-only) coord / color / label views of one scene. """
+        idx = self.name2idx[name]
+        s, e = self.offsets[idx], self.offsets[idx + 1]
+        coord, color, label = self._open()
+        return coord[s:e], color[s:e], label[s:e]
+
+    def load(self, name):
+        """ Scene as writable arrays in the value range of the raw files. """
+        return decode_scene(*self.slices(name), color_mode=self.meta['color_mode'], ignore_label=self.meta['ignore_label'])
+
+    def __getstate__(self):
+        # never pickle the mmaps into DataLoader workers
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        return state
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Pack preprocessed S3DIS / ScanNetv2 scenes into a memory-mapped store')
+    parser.add_argument('--data_name', type=str, default='s3dis', choices=['s3dis', 'scannetv2'])
+    parser.add_argument('--data_root', type=str, required=True, help='s3dis: folder of .npy rooms, scannetv2: folder with train/val/... sub-folders of .pth scenes')
+    parser.add_argument('--store_root', type=str, required=True, help='output folder')
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val'], help='scannetv2 sub-folders to pack')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    if args.data_name == 's3dis':
+        data_paths = sorted(glob.glob(os.path.join(args.data_root, 'Area_*.npy')))
+        pack_scenes(data_paths, args.store_root, color_mode='rgb', ignore_label=255)
+    else:
+        for split in args.splits:
+            data_paths = sorted(glob.glob(os.path.join(args.data_root, split, '*.pth')))
+            pack_scenes(data_paths, os.path.join(args.store_root, split), color_mode='centered', ignore_label=-100)
@@ -0,0 +1,193 @@
+import os
+import time
+import fcntl
+import hashlib
+import argparse
+import threading
+import numpy as np
+import SharedArray as SA
+
+from util.scene_store import encode_scene, decode_scene
+
+
+SHM_DIR = '/dev/shm'
+# bumped when the stored columns change, so that caches of an older layout are never attached
+CACHE_VERSION = 2
+# the columns of util/scene_store.py: float32 coord, uint8 color, uint8 label
+COLUMNS = ('coord', 'color', 'label')
+
+
+def mem_available():
+    """ MemAvailable of the node in bytes (falls back to the free space of /dev/shm). """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    st = os.statvfs(SHM_DIR)
+    return st.f_bavail * st.f_frsize
+
+
+def cache_prefix(data_name, *keys):
+    """ Node-wide name of a cache, stable across the DDP ranks of one run. """
+    digest = hashlib.md5('|'.join(str(k) for k in (CACHE_VERSION,) + keys).encode()).hexdigest()[:8]
+    return 'regionpvt_{}_{}'.format(data_name, digest)
+
+
+class SharedSceneCache(object):
+    """ Scenes staged once per node in /dev/shm and attached read-only by every process.
+
+        The scenes are stored in the encoding of the packed scene store (float32 coord, uint8 color
+        and label) and decoded by get(). The first process to take the node-wide file lock copies the
+        scenes into shared memory, the other DDP ranks block on the lock and then only attach. Scenes
+        that do not fit above the RAM reserve are not cached and are read from disk by the dataset.
+
+        While training, one process per node (start_monitor) checks the free RAM every check_interval
+        seconds and evicts scenes when it falls below the reserve; get() drops the mappings of this
+        process to evicted scenes at the same interval so that their pages are freed.
+    """
+    def __init__(self, prefix, reserve_gb=8.0, color_mode='rgb', ignore_label=255, check_interval=60.0):
+        self.prefix = prefix
+        self.reserve = int(reserve_gb * 1024 ** 3)
+        self.color_mode, self.ignore_label = color_mode, ignore_label
+        self.check_interval = check_interval
+        self.lock_path = os.path.join(SHM_DIR, prefix + '.lock')
+        self.ready_path = os.path.join(SHM_DIR, prefix + '.ready')
+        self.owner_path = os.path.join(SHM_DIR, prefix + '.owner')
+        self._attached = {}
+        self._last_prune = time.time()
+        self._owner = None
+
+    def __getstate__(self):
+        # the owner lock and the mappings stay in the process that made them
+        state = self.__dict__.copy()
+        state['_attached'], state['_owner'] = {}, None
+        return state
+
+    def _name(self, item, column):
+        return '{}_{}_{}'.format(self.prefix, item, column)
+
+    def _exists(self, item):
+        return all(os.path.exists(os.path.join(SHM_DIR, self._name(item, c))) for c in COLUMNS)
+
+    def populate(self, items, load_fn):
+        """ Stage items into shm once per node. load_fn(item) -> (coord, feat, label) as read from disk. """
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.evict()
+                if os.path.exists(self.ready_path):
+                    return
+                staged = 0
+                for item in items:
+                    if self._exists(item):
+                        staged += 1
+                        continue
+                    arrays = encode_scene(*load_fn(item), color_mode=self.color_mode, ignore_label=self.ignore_label)
+                    if mem_available() - sum(x.nbytes for x in arrays) < self.reserve:
+                        print("shm cache {}: RAM reserve reached, {}/{} scenes cached.".format(self.prefix, staged, len(items)))
+                        break
+                    for column, x in zip(COLUMNS, arrays):
+                        SA.create('shm://' + self._name(item, column), x.shape, dtype=x.dtype)[...] = x
+                    staged += 1
+                open(self.ready_path, 'w').close()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, item):
+        """ Writable (coord, feat, label) of a cached item, or None if it is not (or no longer) cached. """
+        if time.time() - self._last_prune > self.check_interval:
+            self._last_prune = time.time()
+            self._attached = {k: data for k, data in self._attached.items() if self._exists(k)}
+        if item not in self._attached:
+            if not self._exists(item):
+                return None
+            try:
+                self._attached[item] = tuple(SA.attach('shm://' + self._name(item, c), ro=True) for c in COLUMNS)
+            except OSError:
+                return None
+        return decode_scene(*self._attached[item], color_mode=self.color_mode, ignore_label=self.ignore_label)
+
+    def segments(self):
+        return sorted(x.name.decode() for x in SA.list() if x.name.decode().startswith(self.prefix + '_'))
+
+    def start_monitor(self):
+        """ Become the process of the node that evicts scenes while training, if no other process is.
+            The .owner lock is held until this process exits (its DataLoader workers only inherit it),
+            the check runs in a daemon thread. Returns True if this process is the owner. """
+        owner = open(self.owner_path, 'a')
+        try:
+            fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            owner.close()
+            return False
+        self._owner = owner
+        threading.Thread(target=self._monitor, daemon=True).start()
+        return True
+
+    def _monitor(self):
+        while True:
+            time.sleep(self.check_interval)
+            if self.check_memory():
+                # the pages are only freed once every worker dropped its mappings (get), which takes up to
+                # check_interval: wait for it before measuring the free RAM again
+                time.sleep(self.check_interval)
+
+    def check_memory(self):
+        """ Evict scenes if the node is below the RAM reserve. Returns the evicted bytes. """
+        if mem_available() >= self.reserve:
+            return 0
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self.evict()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def evict(self):
+        """ Delete cached scenes, most recently staged first, until the deleted segments cover the
+            missing RAM reserve. The caller holds the lock. The pages are freed once the processes
+            that attached a scene drop their mapping (get), until then it stays valid.
+            Returns the evicted bytes. """
+        missing = self.reserve - mem_available()
+        if missing <= 0:
+            return 0
+        segments = self.segments()
+        items = set(s[len(self.prefix) + 1:].rsplit('_', 1)[0] for s in segments)
+        items = sorted(items, key=lambda item: os.path.getmtime(os.path.join(SHM_DIR, self._name(item, COLUMNS[0]))) if self._exists(item) else 0)
+        freed = 0
+        while items and freed < missing:
+            item = items.pop()
+            for column in COLUMNS:
+                if self._name(item, column) in segments:
+                    freed += os.path.getsize(os.path.join(SHM_DIR, self._name(item, column)))
+                    SA.delete('shm://' + self._name(item, column))
+        if freed:
+            print("shm cache {}: RAM reserve not met, evicted {:.1f} GB.".format(self.prefix, freed / 1024 ** 3))
+            if os.path.exists(self.ready_path):
+                os.remove(self.ready_path)
+        return freed
+
+    def cleanup(self):
+        """ Remove every segment of this cache from the node. The lock files stay, other ranks may
+            hold or wait on them. """
+        for name in self.segments():
+            SA.delete('shm://' + name)
+        if os.path.exists(self.ready_path):
+            os.remove(self.ready_path)
+        self._attached = {}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or remove the shared-memory scene caches of this node')
+    parser.add_argument('--cleanup', type=str, nargs='*', default=None, help='cache prefixes to remove (all regionpvt caches if empty)')
+    args = parser.parse_args()
+    prefixes = sorted(set('_'.join(x.name.decode().split('_')[:3]) for x in SA.list() if x.name.decode().startswith('regionpvt_')))
+    for prefix in prefixes:
+        cache = SharedSceneCache(prefix)
+        print('{}: {} segments'.format(prefix, len(cache.segments())))
+        if args.cleanup is not None and (not args.cleanup or prefix in args.cleanup):
+            cache.cleanup()
+            print('{}: removed'.format(prefix))
@@ -1,6 +1,7 @@
 import os
 import sys
 import numpy as np
+from multiprocessing import Pool
 import matplotlib.pyplot as pyplot
 
 colors = {'ceiling':[0,255,0],
@@ -29,72 +30,141 @@ colors40 = [[88,170,108], [174,105,226], [78,194,83], [198,62,165], [133,188,52]
         [175,58,119], [81,175,144], [184,70,74], [40,116,79], [184,134,219], [130,137,46], [110,89,164], [92,135,74], [220,140,190], [94,103,39],
         [144,154,219], [160,86,40], [67,107,165], [194,170,104], [162,95,150], [143,110,44], [146,72,105], [225,142,106], [162,83,86], [227,124,143]]
 
-def write_ply_color(points, labels, out_filename, num_classes=None):
-    """ Color (N,3) points with labels (N) within range 0 ~ num_classes-1 as OBJ file """
-    labels = labels.astype(int)
+def label_colors(labels, palette, modulo=False):
+    """ (N) int labels -> (N,3) uint8 colors from a palette list """
+    labels = np.asarray(labels).astype(np.int64)
+    palette = np.asarray(palette, dtype=np.uint8)
+    return palette[labels % len(palette)] if modulo else palette[labels]
+
+
+def write_obj(points, rgb, out_filename, chunk_size=100000):
+    """ Text OBJ with one 'v x y z r g b' line per point, formatted in chunks instead of per point """
+    data = np.concatenate([np.asarray(points, dtype=np.float64)[:, 0:3], np.asarray(rgb, dtype=np.float64)[:, 0:3]], 1)
+    row_fmt = 'v %f %f %f %d %d %d\n'
+    with open(out_filename, 'w') as fout:
+        for s in range(0, data.shape[0], chunk_size):
+            chunk = data[s:s + chunk_size]
+            fout.write((row_fmt * chunk.shape[0]) % tuple(chunk.ravel().tolist()))
+
+
+def write_ply_binary(points, rgb, out_filename, labels=None):
+    """ Binary little-endian PLY (float32 xyz, uint8 rgb, optional int32 label), body written with one tofile call """
     N = points.shape[0]
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    if labels is not None:
+        fields.append(('label', '<i4'))
+    vertex = np.empty(N, dtype=fields)
+    vertex['x'], vertex['y'], vertex['z'] = points[:, 0], points[:, 1], points[:, 2]
+    rgb = np.clip(np.asarray(rgb), 0, 255).astype(np.uint8)
+    vertex['red'], vertex['green'], vertex['blue'] = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    if labels is not None:
+        vertex['label'] = labels
+    ply_types = {'<f4': 'float', 'u1': 'uchar', '<i4': 'int'}
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex {}'.format(N)]
+    header += ['property {} {}'.format(ply_types[t], name) for name, t in fields]
+    header += ['end_header']
+    with open(out_filename, 'wb') as fout:
+        fout.write(('\n'.join(header) + '\n').encode('ascii'))
+        vertex.tofile(fout)
+
+
+def write_points(points, rgb, out_filename, labels=None):
+    """ Dispatch on the extension: binary PLY for .ply, text OBJ otherwise """
+    if out_filename.endswith('.ply'):
+        write_ply_binary(points, rgb, out_filename, labels)
+    else:
+        write_obj(points, rgb, out_filename)
+
+
+def write_ply_color(points, labels, out_filename, num_classes=None, binary=False):
+    """ Color (N,3) points with labels (N) within range 0 ~ num_classes-1 as OBJ file (binary PLY if binary) """
+    labels = labels.astype(int)
     if num_classes is None:
         num_classes = np.max(labels) + 1
     else:
         assert (num_classes > np.max(labels))
-    fout = open(out_filename, 'w')
     # colors = [pyplot.cm.hsv(i/float(num_classes)) for i in range(num_classes)]
     # colors = [pyplot.cm.jet(i / float(num_classes)) for i in range(num_classes)]
-    for i in range(N):
-        #c = colors[labels[i]]
-        #c = [int(x * 255) for x in c]
-        c = colors[labels[i]]
-        fout.write('v %f %f %f %d %d %d\n' % (points[i, 0], points[i, 1], points[i, 2], c[0], c[1], c[2]))
-    fout.close()
+    c = label_colors(labels, colors)
+    if binary:
+        write_ply_binary(points, c, out_filename, labels)
+    else:
+        write_obj(points, c, out_filename)
 
 
-def write_ply_rgb(points, rgb, out_filename, num_classes=None):
-    """ Color (N,3) points with labels (N) within range 0 ~ num_classes-1 as OBJ file """
-    N = points.shape[0]
-    fout = open(out_filename, 'w')
-    # colors = [pyplot.cm.hsv(i/float(num_classes)) for i in range(num_classes)]
-    # colors = [pyplot.cm.jet(i / float(num_classes)) for i in range(num_classes)]
-    for i in range(N):
-        #c = colors[labels[i]]
-        #c = [int(x * 255) for x in c]
-        c = rgb[i]
-        fout.write('v %f %f %f %d %d %d\n' % (points[i, 0], points[i, 1], points[i, 2], c[0], c[1], c[2]))
-    fout.close()
+def write_ply_rgb(points, rgb, out_filename, num_classes=None, binary=False):
+    """ Color (N,3) points with rgb (N,3) as OBJ file (binary PLY if binary) """
+    if binary:
+        write_ply_binary(points, rgb, out_filename)
+    else:
+        write_obj(points, rgb, out_filename)
 
 
-def write_ply_color_modelnet40(points, out_filename, num_classes=None):
-    """ Color (N,3) points with labels (N) within range 0 ~ num_classes-1 as OBJ file """
-    #labels = labels.astype(int)
-    N = points.shape[0]
-    #if num_classes is None:
-    #    num_classes = np.max(labels) + 1
-    #else:
-    #    assert (num_classes > np.max(labels))
-    fout = open(out_filename, 'w')
-    # colors = [pyplot.cm.hsv(i/float(num_classes)) for i in range(num_classes)]
-    # colors = [pyplot.cm.jet(i / float(num_classes)) for i in range(num_classes)]
-    for i in range(N):
-        #c = colors[labels[i]]
-        #c = [int(x * 255) for x in c]
-        c = colors2[0]
-        fout.write('v %f %f %f %d %d %d\n' % (points[i, 0], points[i, 1], points[i, 2], c[0], c[1], c[2]))
-    fout.close()
+def write_ply_color_modelnet40(points, out_filename, num_classes=None, binary=False):
+    """ Color (N,3) points with a single color as OBJ file (binary PLY if binary) """
+    c = np.tile(np.asarray(colors2[0], dtype=np.uint8), (points.shape[0], 1))
+    if binary:
+        write_ply_binary(points, c, out_filename)
+    else:
+        write_obj(points, c, out_filename)
 
 
-def write_ply_color_shapenet(points, labels, out_filename, num_classes=None):
-    """ Color (N,3) points with labels (N) within range 0 ~ num_classes-1 as OBJ file """
+def write_ply_color_shapenet(points, labels, out_filename, num_classes=None, binary=False):
+    """ Color (N,3) points with labels (N) within range 0 ~ num_classes-1 as OBJ file (binary PLY if binary) """
     labels = labels.astype(int)
-    N = points.shape[0]
     if num_classes is None:
         num_classes = np.max(labels) + 1
     else:
         assert (num_classes > np.max(labels))
-    fout = open(out_filename, 'w')
-    # colors = [pyplot.cm.hsv(i/float(num_classes)) for i in range(num_classes)]
-    # colors = [pyplot.cm.jet(i / float(num_classes)) for i in range(num_classes)]
-    for i in range(N):
-        #c = colors[labels[i]]
-        #c = [int(x * 255) for x in c]
-        c = colors7[labels[i]%7]
-        fout.write('v %f %f %f %d %d %d\n' % (points[i, 0], points[i, 1], points[i, 2], c[0], c[1], c[2]))
-    fout.close()
\ No newline at end of file
+    c = label_colors(labels, colors7, modulo=True)
+    if binary:
+        write_ply_binary(points, c, out_filename, labels)
+    else:
+        write_obj(points, c, out_filename)
+
+
+def _export_scene(job):
+    points, colors_or_labels, out_filename = job
+    if isinstance(points, str):
+        # xyzrgbl .npy file, e.g. a room written by data_utils/collect_indoor3d_data.py
+        data = np.load(points, mmap_mode='r')
+        points, colors_or_labels = np.asarray(data[:, 0:3]), np.asarray(data[:, 3:6])
+    colors_or_labels = np.asarray(colors_or_labels)
+    if colors_or_labels.ndim == 1:
+        labels = colors_or_labels.astype(int)
+        write_points(points, label_colors(labels, colors), out_filename, labels)
+    else:
+        write_points(points, colors_or_labels, out_filename)
+    return out_filename
+
+
+def export_scenes(jobs, workers=8):
+    """ Export many scenes through a process pool.
+
+    Args:
+        jobs: list of (points, colors_or_labels, out_filename). points is a (N,3) array or the path of
+            an xyzrgbl .npy file (colors_or_labels is then ignored), colors_or_labels is (N,3) rgb or
+            (N) labels colored with the S3DIS palette. The format follows the extension of out_filename.
+        workers: number of processes.
+    """
+    if workers <= 1:
+        return [_export_scene(job) for job in jobs]
+    with Pool(workers) as pool:
+        return pool.map(_export_scene, jobs)
+
+
+if __name__ == '__main__':
+    import time
+    import argparse
+    parser = argparse.ArgumentParser(description='Export xyzrgbl .npy scenes as binary PLY / text OBJ')
+    parser.add_argument('inputs', type=str, nargs='+')
+    parser.add_argument('--output_folder', type=str, required=True)
+    parser.add_argument('--format', type=str, default='ply', choices=['ply', 'obj'])
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    if not os.path.exists(args.output_folder):
+        os.makedirs(args.output_folder)
+    jobs = [(p, None, os.path.join(args.output_folder, os.path.basename(p)[:-4] + '.' + args.format)) for p in args.inputs]
+    start = time.time()
+    export_scenes(jobs, args.workers)
+    print('Exported {} scenes in {:.1f}s.'.format(len(jobs), time.time() - start))
@@ -0,0 +1,105 @@
+import os
+import hashlib
+import argparse
+import numpy as np
+from multiprocessing import Pool
+
+from util.voxelize import voxelize
+
+
+def voxel_index(coord, voxel_size):
+    """ (idx_sort, count) of a raw scene, exactly as computed inside data_prepare (coord shifted to its min) """
+    coord = coord - np.min(coord, 0)
+    idx_sort, count = voxelize(coord, voxel_size, mode=1)
+    return idx_sort.astype(np.int32), count.astype(np.int32)
+
+
+def scene_digest(coord):
+    """ Content hash of the coordinates of a raw scene """
+    return hashlib.md5(np.ascontiguousarray(coord, dtype=np.float32).tobytes()).hexdigest()
+
+
+class VoxelCache(object):
+    """ Per-scene voxelization computed offline, one .npz per (scene, voxel_size).
+
+        With the cache the datasets skip the hash and the O(N log N) argsort of the raw scene and only
+        draw the random point of every voxel, which is O(#voxels). Every entry records its voxel_size
+        and the content hash of the scene coordinates; an entry is checked against the scene once per
+        process, and scenes missing from the cache or whose entry does not match return None and are
+        voxelized as before.
+    """
+    def __init__(self, cache_root, voxel_size):
+        self.cache_root = os.path.join(cache_root, 'voxel_{:g}'.format(voxel_size))
+        self.voxel_size = voxel_size
+        self._valid = {}
+
+    def path(self, key):
+        return os.path.join(self.cache_root, key + '.npz')
+
+    def get(self, key, coord):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        if key not in self._valid:
+            self._valid[key] = 'digest' in data.files and float(data['voxel_size']) == self.voxel_size and str(data['digest']) == scene_digest(coord)
+            if not self._valid[key]:
+                print("voxel cache: stale entry {}, voxelizing the scene instead.".format(path))
+        if not self._valid[key]:
+            return None
+        return data['idx_sort'], data['count']
+
+    def put(self, key, coord):
+        if not os.path.exists(self.cache_root):
+            os.makedirs(self.cache_root, exist_ok=True)
+        idx_sort, count = voxel_index(coord, self.voxel_size)
+        tmp_path = self.path(key) + '.part.npz'
+        np.savez(tmp_path, idx_sort=idx_sort, count=count, voxel_size=np.float64(self.voxel_size), digest=np.str_(scene_digest(coord)))
+        os.replace(tmp_path, self.path(key))
+        return idx_sort.shape[0], count.shape[0]
+
+
+_dataset, _cache = None, None
+
+
+def _build_one(job):
+    key, load_arg = job
+    coord = _dataset.load_scene(load_arg)[0]
+    return key, _cache.put(key, coord)
+
+
+def build_cache(dataset, cache_root, workers=8, overwrite=False):
+    """ Fill the cache for every scene of a S3DIS / Scannetv2 dataset, keyed like the dataset looks them up """
+    global _dataset, _cache
+    _dataset, _cache = dataset, VoxelCache(cache_root, dataset.voxel_size)
+    jobs = [(key, load_arg) for key, load_arg in zip(dataset.data_keys, dataset.load_args) if overwrite or not os.path.exists(_cache.path(key))]
+    print('{} scenes to voxelize at {}, {} already cached.'.format(len(jobs), dataset.voxel_size, len(dataset.data_keys) - len(jobs)))
+    with Pool(max(1, workers)) as pool:
+        for i, (key, (n, m)) in enumerate(pool.imap_unordered(_build_one, jobs)):
+            print('{}/{}: {} ({} points, {} voxels)'.format(i + 1, len(jobs), key, n, m))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Precompute the voxelization of every scene for the voxel_cache option')
+    parser.add_argument('--data_name', type=str, default='s3dis', choices=['s3dis', 'scannetv2'])
+    parser.add_argument('--data_root', type=str, required=True)
+    parser.add_argument('--store_root', type=str, default=None)
+    parser.add_argument('--cache_root', type=str, required=True)
+    parser.add_argument('--voxel_size', type=float, default=0.04)
+    parser.add_argument('--test_area', type=int, default=5)
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'val'])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--overwrite', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_parser()
+    for split in args.splits:
+        if args.data_name == 's3dis':
+            from util.s3dis import S3DIS
+            dataset = S3DIS(split=split, data_root=args.data_root, test_area=args.test_area, voxel_size=args.voxel_size, store_root=args.store_root)
+        else:
+            from util.scannet_v2 import Scannetv2
+            dataset = Scannetv2(split=split, data_root=args.data_root, voxel_size=args.voxel_size, store_root=args.store_root)
+        build_cache(dataset, args.cache_root, args.workers, args.overwrite)
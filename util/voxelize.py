@@ -1,9 +1,11 @@
 import numpy as np
-from collections import Sequence
+from collections.abc import Sequence
 import torch
-from torch_geometric.nn import voxel_grid
 
 def grid_sample(pos, batch_index, size, start=None, return_p2v=True):
+    # torch_geometric is only needed here, the numpy voxelization below is used without it by the data loading
+    from torch_geometric.nn import voxel_grid
+
     # pos: float [N, 3]
     # batch_szie: long int
     # size: float [3, ]
@@ -49,12 +51,12 @@ def fnv_hash_vec(arr):
     """
     assert arr.ndim == 2
     # Floor first for negative coordinates
-    arr = arr.copy()
-    arr = arr.astype(np.uint64, copy=False)
-    hashed_arr = np.uint64(14695981039346656037) * np.ones(arr.shape[0], dtype=np.uint64)
+    arr = arr.astype(np.uint64)  # the only copy, the hash is updated in place
+    hashed_arr = np.full(arr.shape[0], 14695981039346656037, dtype=np.uint64)
+    prime = np.uint64(1099511628211)
     for j in range(arr.shape[1]):
-        hashed_arr *= np.uint64(1099511628211)
-        hashed_arr = np.bitwise_xor(hashed_arr, arr[:, j])
+        np.multiply(hashed_arr, prime, out=hashed_arr)
+        np.bitwise_xor(hashed_arr, arr[:, j], out=hashed_arr)
     return hashed_arr
 
 
@@ -63,9 +65,7 @@ def ravel_hash_vec(arr):
     Ravel the coordinates after subtracting the min coordinates.
     """
     assert arr.ndim == 2
-    arr = arr.copy()
-    arr -= arr.min(0)
-    arr = arr.astype(np.uint64, copy=False)
+    arr = (arr - arr.min(0)).astype(np.uint64)
     arr_max = arr.max(0).astype(np.uint64) + 1
 
     keys = np.zeros(arr.shape[0], dtype=np.uint64)
@@ -77,20 +77,45 @@ def ravel_hash_vec(arr):
     return keys
 
 
-def voxelize(coord, voxel_size=0.05, hash_type='fnv', mode=0):
+def radix_argsort(key, digit_bits=16):
+    """
+    Stable LSD radix argsort of uint64 keys, one stable (counting) sort per 16-bit digit.
+    Only the digits below the largest key are visited, so small ravel keys take fewer passes.
+    """
+    mask = np.uint64((1 << digit_bits) - 1)
+    num_bits = max(int(key.max()).bit_length(), 1) if key.size else 1
+    perm = None
+    for shift in range(0, num_bits, digit_bits):
+        digit = ((key if perm is None else key[perm]) >> np.uint64(shift)) & mask
+        order = np.argsort(digit.astype(np.uint16), kind='stable')
+        perm = order if perm is None else perm[order]
+    return perm
+
+
+def voxel_counts(key_sort):
+    """ Points per voxel of sorted keys (np.unique(key_sort, return_counts=True)[1] without re-sorting) """
+    if key_sort.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    boundary = np.flatnonzero(key_sort[1:] != key_sort[:-1]) + 1
+    return np.diff(np.concatenate([[0], boundary, [key_sort.size]]))
+
+
+def voxelize(coord, voxel_size=0.05, hash_type='fnv', mode=0, sort='quick'):
+    """
+    sort: 'quick' (np.argsort) or 'radix' (stable, points of a voxel stay in input order).
+        Both give the same key order and counts, only the order inside a voxel may differ.
+    """
     discrete_coord = np.floor(coord / np.array(voxel_size))
     if hash_type == 'ravel':
         key = ravel_hash_vec(discrete_coord)
     else:
         key = fnv_hash_vec(discrete_coord)
 
-    idx_sort = np.argsort(key)
+    idx_sort = radix_argsort(key) if sort == 'radix' else np.argsort(key)
     key_sort = key[idx_sort]
-    _, count = np.unique(key_sort, return_counts=True)
+    count = voxel_counts(key_sort)
     if mode == 0:  # train mode
-        idx_select = np.cumsum(np.insert(count, 0, 0)[0:-1]) + np.random.randint(0, count.max(), count.size) % count
-        idx_unique = idx_sort[idx_select]
-        return idx_unique
+        return voxel_sample(idx_sort, count)
     else:  # val mode
         return idx_sort, count
 
@@ -104,3 +129,50 @@ def voxelize(coord, voxel_size=0.05, hash_type='fnv', mode=0):
     idx_list = np.split(idx_sort, idx_start[1:])
     return idx_list
     '''
+
+
+def voxel_sample(idx_sort, count):
+    """ One random point per voxel from the (idx_sort, count) returned by voxelize(..., mode=1) """
+    idx_select = np.cumsum(np.insert(count, 0, 0)[0:-1]) + np.random.randint(0, count.max(), count.size) % count
+    idx_unique = idx_sort[idx_select]
+    return idx_unique
+
+
+if __name__ == '__main__':
+    # micro-benchmark against the previous implementation (parity: tests/test_voxelize.py)
+    import time
+
+    def voxelize_reference(coord, voxel_size=0.05, hash_type='fnv'):
+        discrete_coord = np.floor(coord / np.array(voxel_size))
+        arr = discrete_coord.copy().astype(np.uint64, copy=False)
+        if hash_type == 'ravel':
+            arr = discrete_coord.copy()
+            arr -= arr.min(0)
+            arr = arr.astype(np.uint64, copy=False)
+            arr_max = arr.max(0).astype(np.uint64) + 1
+            key = np.zeros(arr.shape[0], dtype=np.uint64)
+            for j in range(arr.shape[1] - 1):
+                key += arr[:, j]
+                key *= arr_max[j + 1]
+            key += arr[:, -1]
+        else:
+            key = np.uint64(14695981039346656037) * np.ones(arr.shape[0], dtype=np.uint64)
+            for j in range(arr.shape[1]):
+                key *= np.uint64(1099511628211)
+                key = np.bitwise_xor(key, arr[:, j])
+        idx_sort = np.argsort(key)
+        key_sort = key[idx_sort]
+        _, count = np.unique(key_sort, return_counts=True)
+        return key, idx_sort, count
+
+    np.random.seed(0)
+    for n in [1000000, 10000000]:
+        coord = np.random.rand(n, 3).astype(np.float32) * np.array([20.0, 20.0, 4.0], dtype=np.float32)
+        for hash_type in ['fnv', 'ravel']:
+            t = time.time()
+            voxelize_reference(coord, 0.04, hash_type)
+            t_ref = time.time() - t
+            for sort in ['quick', 'radix']:
+                t = time.time()
+                voxelize(coord, 0.04, hash_type, mode=1, sort=sort)
+                print('n={} hash={} sort={}: reference {:.3f}s, new {:.3f}s'.format(n, hash_type, sort, t_ref, time.time() - t))